@@ -0,0 +1,191 @@
+import asyncio
+import os
+import random
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Configuration du pool de connexions et des retries (variables d'environnement)
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", "0.5"))
+HTTP_BACKOFF_JITTER = float(os.environ.get("HTTP_BACKOFF_JITTER", "0.5"))
+
+# Réponses temporaires après lesquelles une requête idempotente est rejouée
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Méthodes rejouées sur les erreurs de lecture et les statuts RETRY_STATUSES
+IDEMPOTENT_METHODS = frozenset(Retry.DEFAULT_ALLOWED_METHODS)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+class PooledSession(requests.Session):
+    """
+    Session requests avec un timeout par défaut sur chaque requête.
+
+    Les connexions sont gardées ouvertes (keep-alive) et réutilisées d'un
+    appel à l'autre par le pool de l'adapter HTTP.
+    """
+
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(
+    pool_connections: int = HTTP_POOL_CONNECTIONS,
+    pool_maxsize: int = HTTP_POOL_MAXSIZE,
+    retries: int = HTTP_RETRIES,
+    backoff_factor: float = HTTP_BACKOFF_FACTOR,
+    backoff_jitter: float = HTTP_BACKOFF_JITTER,
+) -> requests.Session:
+    """
+    Crée une session HTTP avec pool de connexions et retries.
+
+    Les échecs de connexion sont rejoués pour toutes les méthodes (la requête
+    n'est pas partie). Les erreurs de lecture et les statuts RETRY_STATUSES ne
+    sont rejoués que pour les méthodes idempotentes (GET, PUT, DELETE...), jamais
+    pour un POST. Délai entre deux essais : backoff_factor * 2^n secondes, plus
+    un aléa de 0 à backoff_jitter secondes.
+
+    Args:
+        pool_connections: Nombre d'hôtes dont les connexions sont gardées
+        pool_maxsize: Nombre de connexions gardées par hôte
+        retries: Nombre maximal de nouvelles tentatives
+        backoff_factor: Base du backoff exponentiel, en secondes
+        backoff_jitter: Aléa maximal ajouté à chaque délai, en secondes
+
+    Returns:
+        La session configurée
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_jitter,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = PooledSession()
+    # Aucun cookie n'est conservé : la session est partagée par tous les clients
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Retourne la session partagée par tous les clients HTTP du processus.
+
+    Le pool de connexions d'urllib3 est thread-safe et la session ne garde
+    aucun cookie : elle peut être partagée entre threads.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def create_async_client(
+    pool_maxsize: int = HTTP_POOL_MAXSIZE,
+    retries: int = HTTP_RETRIES,
+) -> httpx.AsyncClient:
+    """
+    Crée un client HTTP asynchrone (httpx) avec pool de connexions keep-alive.
+
+    Le transport rejoue les échecs de connexion ; les autres retries sont faits
+    par send_with_retries.
+
+    Args:
+        pool_maxsize: Nombre maximal de connexions ouvertes
+        retries: Nombre maximal de nouvelles tentatives de connexion
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+        transport=httpx.AsyncHTTPTransport(retries=retries),
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Retourne le client asynchrone partagé du processus.
+
+    Il est lié à la boucle d'événements qui l'utilise : close_async_client doit
+    être appelé à l'arrêt de l'application.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = create_async_client()
+    return _async_client
+
+
+async def close_async_client():
+    """Ferme les connexions du client asynchrone partagé."""
+    global _async_client
+    if _async_client is not None:
+        client, _async_client = _async_client, None
+        await client.aclose()
+
+
+async def send_with_retries(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    retries: int = HTTP_RETRIES,
+    backoff_factor: float = HTTP_BACKOFF_FACTOR,
+    backoff_jitter: float = HTTP_BACKOFF_JITTER,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Envoie une requête avec les mêmes règles de retry que la session synchrone :
+    une méthode idempotente est rejouée sur une erreur réseau ou un statut
+    RETRY_STATUSES, avec backoff exponentiel et aléa (Retry-After respecté).
+    """
+    attempt = 0
+    while True:
+        retryable = method.upper() in IDEMPOTENT_METHODS and attempt < retries
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if not retryable:
+                raise
+            delay = None
+        else:
+            if not retryable or response.status_code not in RETRY_STATUSES:
+                return response
+            delay = _retry_after(response)
+            await response.aclose()
+
+        if delay is None:
+            delay = backoff_factor * (2 ** attempt) + random.uniform(0, backoff_jitter)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
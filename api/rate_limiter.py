@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+
+class AsyncRateLimiter:
+    """
+    Limite le débit des appels à `rate` par seconde (seau à jetons).
+
+    Jusqu'à `burst` appels peuvent partir immédiatement, les suivants sont
+    espacés de 1/rate seconde. Chaque appelant réserve son créneau avant
+    d'attendre : des appels concurrents ne peuvent pas dépasser le débit.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate: Nombre maximal d'appels par seconde (0 ou moins : pas de limite)
+            burst: Nombre d'appels pouvant partir sans attendre
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        """Attend le créneau de l'appel suivant."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
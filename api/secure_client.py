@@ -1,7 +1,10 @@
 import requests
+import httpx
 from typing import Optional, Dict, Any
 import logging
-from auth.token import AuthToken
+from auth.token import AsyncAuthToken, AuthToken
+from auth.token_manager import AsyncTokenManager, TokenManager
+from api.http_session import get_async_client, get_session, send_with_retries
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +20,8 @@ class SecureAPIClient:
         self,
         base_url: str,
         client_prefix: Optional[str] = None,
-        verify_ssl: bool = True
+        verify_ssl: bool = True,
+        session: Optional[requests.Session] = None
     ):
         """
         Initialise le client API sécurisé.
@@ -26,23 +30,30 @@ class SecureAPIClient:
             base_url: URL de base de l'API (ex: "https://api.example.com")
             client_prefix: Préfixe pour les variables d'environnement Keycloak
             verify_ssl: Vérifier les certificats SSL (True en production)
+            session: Session HTTP à utiliser (par défaut la session partagée,
+                     qui réutilise les connexions)
         """
         self.base_url = base_url.rstrip("/")
         self.verify_ssl = verify_ssl
-        self.auth_token = AuthToken(client_prefix)
-        self._token: Optional[str] = None
+        self.session = session or get_session()
+        self.auth_token = AuthToken(client_prefix, session=self.session)
+        self.token_manager = TokenManager(self.auth_token)
 
     def _get_token(self) -> str:
-        """Obtient ou réutilise le token d'accès."""
-        if not self._token:
-            self._token = self.auth_token.get_access_token()
-        return self._token
-
-    def _refresh_token(self):
-        """Force le renouvellement du token."""
-        self._token = None
+        """Obtient ou réutilise le token d'accès (renouvelé avant son expiration)."""
+        return self.token_manager.get_token()
+
+    def _refresh_token(self, rejected_token: Optional[str] = None):
+        """Force le renouvellement du token refusé par l'API."""
+        self.token_manager.invalidate(rejected_token)
         return self._get_token()
 
+    @staticmethod
+    def _sent_token(response: requests.Response) -> Optional[str]:
+        """Token envoyé avec la requête de cette réponse."""
+        authorization = response.request.headers.get("Authorization", "")
+        return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+
     def _build_headers(self, extra_headers: Optional[Dict] = None) -> Dict[str, str]:
         """
         Construit les headers HTTP avec le token Bearer.
@@ -82,7 +93,7 @@ class SecureAPIClient:
         """
         url = f"{self.base_url}{endpoint}"
 
-        response = requests.get(
+        response = self.session.get(
             url,
             params=params,
             headers=self._build_headers(headers),
@@ -92,8 +103,8 @@ class SecureAPIClient:
         # Si 401, tenter un refresh du token et réessayer
         if response.status_code == 401:
             logger.warning("Token expired, refreshing...")
-            self._refresh_token()
-            response = requests.get(
+            self._refresh_token(self._sent_token(response))
+            response = self.session.get(
                 url,
                 params=params,
                 headers=self._build_headers(headers),
@@ -127,7 +138,7 @@ class SecureAPIClient:
         if json_data:
             request_headers["Content-Type"] = "application/json"
 
-        response = requests.post(
+        response = self.session.post(
             url,
             json=json_data,
             data=data,
@@ -138,8 +149,8 @@ class SecureAPIClient:
         # Si 401, tenter un refresh du token et réessayer
         if response.status_code == 401:
             logger.warning("Token expired, refreshing...")
-            self._refresh_token()
-            response = requests.post(
+            self._refresh_token(self._sent_token(response))
+            response = self.session.post(
                 url,
                 json=json_data,
                 data=data,
@@ -148,3 +159,111 @@ class SecureAPIClient:
             )
 
         return response
+
+
+class AsyncSecureAPIClient:
+    """
+    Variante asynchrone de SecureAPIClient (httpx) : les appels réseau ne
+    bloquent jamais la boucle d'événements et réutilisent les connexions du
+    client asynchrone partagé.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        client_prefix: Optional[str] = None,
+        client: Optional[httpx.AsyncClient] = None
+    ):
+        """
+        Initialise le client API sécurisé asynchrone.
+
+        Args:
+            base_url: URL de base de l'API (ex: "https://api.example.com")
+            client_prefix: Préfixe pour les variables d'environnement Keycloak
+            client: Client httpx à utiliser (par défaut le client asynchrone partagé)
+        """
+        self.base_url = base_url.rstrip("/")
+        self._client = client
+        self.auth_token = AsyncAuthToken(client_prefix, client=client)
+        self.token_manager = AsyncTokenManager(self.auth_token)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client or get_async_client()
+
+    async def _build_headers(self, extra_headers: Optional[Dict] = None) -> Dict[str, str]:
+        """Construit les headers HTTP avec le token Bearer."""
+        headers = {
+            "Authorization": f"Bearer {await self.token_manager.get_token()}",
+            "Accept": "application/json",
+        }
+
+        if extra_headers:
+            headers.update(extra_headers)
+
+        return headers
+
+    async def _request(self, method: str, endpoint: str, headers: Optional[Dict] = None, **kwargs) -> httpx.Response:
+        url = f"{self.base_url}{endpoint}"
+
+        response = await send_with_retries(
+            self.client, method, url, headers=await self._build_headers(headers), **kwargs
+        )
+
+        # Si 401, tenter un refresh du token et réessayer
+        if response.status_code == 401:
+            logger.warning("Token expired, refreshing...")
+            sent = response.request.headers.get("Authorization", "")
+            self.token_manager.invalidate(sent[len("Bearer "):] if sent.startswith("Bearer ") else None)
+            response = await send_with_retries(
+                self.client, method, url, headers=await self._build_headers(headers), **kwargs
+            )
+
+        return response
+
+    async def get(
+        self,
+        endpoint: str,
+        params: Optional[Dict] = None,
+        headers: Optional[Dict] = None
+    ) -> httpx.Response:
+        """
+        Effectue une requête GET authentifiée.
+
+        Args:
+            endpoint: Chemin de l'endpoint (ex: "/api/users")
+            params: Paramètres de requête
+            headers: Headers additionnels
+
+        Returns:
+            Response object
+        """
+        return await self._request("GET", endpoint, headers=headers, params=params)
+
+    async def post(
+        self,
+        endpoint: str,
+        json_data: Optional[Dict] = None,
+        data: Optional[Any] = None,
+        headers: Optional[Dict] = None
+    ) -> httpx.Response:
+        """
+        Effectue une requête POST authentifiée.
+
+        Args:
+            endpoint: Chemin de l'endpoint
+            json_data: Données JSON à envoyer
+            data: Données brutes à envoyer
+            headers: Headers additionnels
+
+        Returns:
+            Response object
+        """
+        kwargs = {}
+        if json_data is not None:
+            kwargs["json"] = json_data
+        elif isinstance(data, (str, bytes)):
+            kwargs["content"] = data
+        elif data is not None:
+            kwargs["data"] = data
+        return await self._request("POST", endpoint, headers=headers, **kwargs)
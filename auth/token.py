@@ -1,7 +1,9 @@
 import os
 import requests
-from typing import Optional
+from typing import Optional, Tuple
 import logging
+import httpx
+from api.http_session import get_async_client, get_session
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +15,7 @@ class AuthToken:
     Utilise le Client Credentials Flow pour l'authentification service-to-service.
     """
 
-    def __init__(self, client_prefix: Optional[str] = None):
+    def __init__(self, client_prefix: Optional[str] = None, session: Optional[requests.Session] = None):
         """
         Initialise le gestionnaire de token.
         
@@ -21,8 +23,10 @@ class AuthToken:
             client_prefix: Préfixe pour les variables d'environnement (ex: "ADHEO").
                           Si fourni, cherche {PREFIX}_KEYCLOAK_SERVER_URL, etc.
                           Sinon, utilise KEYCLOAK_SERVER_URL directement.
+            session: Session HTTP à utiliser (par défaut la session partagée)
         """
         self.client_prefix = client_prefix
+        self.session = session or get_session()
         self._load_config()
 
     def _get_env(self, key: str) -> str:
@@ -57,6 +61,27 @@ class AuthToken:
         """Construit l'URL du endpoint token."""
         return f"{self.server_url}/realms/{self.realm_name}/protocol/openid-connect/token"
 
+    def _mock_token(self) -> Optional[dict]:
+        """Token factice quand la configuration Keycloak est absente (tests)."""
+        if not all([self.server_url, self.realm_name, self.client_id, self.client_secret]):
+            # Mock for testing if env vars are missing
+            logger.warning("Keycloak env vars missing, returning mock token")
+            return {"access_token": "mock_token", "expires_in": 3600}
+        return None
+
+    def _token_request(self) -> Tuple[dict, dict]:
+        """Corps et headers de la demande de token (Client Credentials Flow)."""
+        payload = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        return payload, headers
+
     def get_token(self) -> dict:
         """
         Obtient un access token via Client Credentials Flow.
@@ -71,24 +96,15 @@ class AuthToken:
         Raises:
             requests.exceptions.HTTPError: Si la requête échoue
         """
-        if not all([self.server_url, self.realm_name, self.client_id, self.client_secret]):
-             # Mock for testing if env vars are missing
-             logger.warning("Keycloak env vars missing, returning mock token")
-             return {"access_token": "mock_token", "expires_in": 3600}
+        mock_token = self._mock_token()
+        if mock_token:
+            return mock_token
 
-        payload = {
-            "grant_type": "client_credentials",
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-        }
-
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
+        payload, headers = self._token_request()
 
         logger.debug(f"Requesting token from {self.token_endpoint}")
 
-        response = requests.post(
+        response = self.session.post(
             self.token_endpoint,
             data=payload,
             headers=headers,
@@ -110,3 +126,53 @@ class AuthToken:
             str: Le JWT access token
         """
         return self.get_token()["access_token"]
+
+
+class AsyncAuthToken(AuthToken):
+    """
+    Variante asynchrone d'AuthToken : la demande de token passe par httpx et
+    ne bloque pas la boucle d'événements.
+    """
+
+    def __init__(self, client_prefix: Optional[str] = None, client: Optional[httpx.AsyncClient] = None):
+        """
+        Args:
+            client_prefix: Préfixe pour les variables d'environnement (voir AuthToken)
+            client: Client httpx à utiliser (par défaut le client asynchrone partagé)
+        """
+        super().__init__(client_prefix)
+        self.client = client
+
+    async def get_token(self) -> dict:
+        """
+        Obtient un access token via Client Credentials Flow (voir AuthToken.get_token).
+
+        Raises:
+            httpx.HTTPStatusError: Si la requête échoue
+        """
+        mock_token = self._mock_token()
+        if mock_token:
+            return mock_token
+
+        payload, headers = self._token_request()
+
+        logger.debug(f"Requesting token from {self.token_endpoint}")
+
+        client = self.client or get_async_client()
+        response = await client.post(self.token_endpoint, data=payload, headers=headers)
+
+        response.raise_for_status()
+
+        token_data = response.json()
+        logger.info(f"Token obtained, expires in {token_data.get('expires_in')} seconds")
+
+        return token_data
+
+    async def get_access_token(self) -> str:
+        """
+        Raccourci pour obtenir uniquement l'access_token.
+
+        Returns:
+            str: Le JWT access token
+        """
+        return (await self.get_token())["access_token"]
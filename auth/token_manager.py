@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de partage entre processus
+    fcntl = None
+
+from auth.token import AsyncAuthToken, AuthToken
+
+logger = logging.getLogger(__name__)
+
+# Le token est renouvelé quand il lui reste moins de TOKEN_REFRESH_MARGIN secondes
+TOKEN_REFRESH_MARGIN = float(os.environ.get("TOKEN_REFRESH_MARGIN", "60"))
+# Répertoire du cache de token partagé entre processus (workers uvicorn). Vide : désactivé
+TOKEN_CACHE_DIR = os.environ.get("TOKEN_CACHE_DIR", "")
+
+# Durée de validité supposée quand Keycloak ne renvoie pas expires_in
+DEFAULT_EXPIRES_IN = 60
+
+
+class TokenManager:
+    """
+    Cache du token d'accès Keycloak, renouvelé avant son expiration.
+
+    - L'expiration est calculée depuis expires_in.
+    - Le renouvellement commence refresh_margin secondes avant l'expiration :
+      un seul appelant renouvelle (single-flight), les autres continuent avec le
+      token courant, encore valide. Une fois le token expiré, les appelants
+      attendent le renouvellement en cours au lieu d'en lancer un chacun.
+    - Avec cache_dir, le token est partagé entre processus par un fichier :
+      un seul processus à la fois appelle Keycloak (verrou fcntl), les autres
+      relisent le token qu'il a obtenu.
+    """
+
+    def __init__(
+        self,
+        auth_token: AuthToken,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        cache_dir: Optional[str] = TOKEN_CACHE_DIR,
+    ):
+        """
+        Args:
+            auth_token: Client Keycloak utilisé pour obtenir les tokens
+            refresh_margin: Avance du renouvellement sur l'expiration, en secondes
+            cache_dir: Répertoire du cache partagé entre processus (None ou vide : désactivé)
+        """
+        self.auth_token = auth_token
+        self.refresh_margin = refresh_margin
+        self._access_token: Optional[str] = None
+        self._expires_at = 0.0
+        # Dernier token refusé par l'API : à ne pas relire dans le cache partagé
+        self._rejected: Optional[str] = None
+        self._lock = threading.Lock()
+
+        self.cache_path: Optional[str] = None
+        if cache_dir and fcntl is None:
+            logger.warning("fcntl unavailable, token cache not shared between processes")
+        elif cache_dir:
+            # Un fichier par client Keycloak
+            key = f"{auth_token.token_endpoint}|{auth_token.client_id}"
+            digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+            self.cache_path = os.path.join(cache_dir, f"token-{digest}.json")
+
+    def _needs_refresh(self, expires_at: float) -> bool:
+        return time.time() >= expires_at - self.refresh_margin
+
+    def get_token(self) -> str:
+        """
+        Retourne un token d'accès valide, en le renouvelant si nécessaire.
+
+        Raises:
+            requests.exceptions.HTTPError: Si Keycloak refuse la demande de token
+        """
+        token, expires_at = self._access_token, self._expires_at
+        if token and not self._needs_refresh(expires_at):
+            return token
+
+        still_valid = token is not None and time.time() < expires_at
+        # Token encore valide : seul l'appelant qui obtient le verrou renouvelle
+        if not self._lock.acquire(blocking=not still_valid):
+            return token
+        try:
+            # Un autre appelant a pu renouveler pendant l'attente du verrou
+            if self._access_token and not self._needs_refresh(self._expires_at):
+                return self._access_token
+            self._refresh()
+            return self._access_token
+        except Exception:
+            if still_valid:
+                logger.warning("Token refresh failed, keeping the current token until it expires", exc_info=True)
+                return token
+            raise
+        finally:
+            self._lock.release()
+
+    def invalidate(self, token: Optional[str] = None):
+        """
+        Oublie le token (après une réponse 401).
+
+        Args:
+            token: Le token refusé ; s'il a déjà été remplacé, rien n'est fait,
+                   pour que des 401 simultanés ne provoquent qu'un renouvellement
+        """
+        with self._lock:
+            if token is None or token == self._access_token:
+                self._rejected = self._access_token
+                self._access_token = None
+                self._expires_at = 0.0
+
+    def _refresh(self):
+        with self._shared_lock():
+            if self._use_shared():
+                return
+            self._store(self.auth_token.get_token())
+
+    def _use_shared(self) -> bool:
+        """Reprend le token du cache partagé s'il a été renouvelé par un autre processus."""
+        shared = self._read_shared()
+        if (shared and not self._needs_refresh(shared["expires_at"])
+                and shared["access_token"] != self._rejected):
+            self._access_token, self._expires_at = shared["access_token"], shared["expires_at"]
+            return True
+        return False
+
+    def _store(self, token_data: dict):
+        expires_in = token_data.get("expires_in") or DEFAULT_EXPIRES_IN
+        self._access_token = token_data["access_token"]
+        self._expires_at = time.time() + float(expires_in)
+        self._write_shared()
+
+    def _acquire_shared(self):
+        """Prend le verrou inter-processus ; retourne le fichier verrou (None sans cache partagé)."""
+        if not self.cache_path:
+            return None
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        lock_file = open(f"{self.cache_path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+
+    @staticmethod
+    def _release_shared(lock_file):
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    @contextmanager
+    def _shared_lock(self) -> Iterator[None]:
+        lock_file = self._acquire_shared()
+        try:
+            yield
+        finally:
+            self._release_shared(lock_file)
+
+    def _read_shared(self) -> Optional[dict]:
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return {"access_token": str(data["access_token"]), "expires_at": float(data["expires_at"])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_shared(self):
+        if not self.cache_path:
+            return
+        # Écrit à côté puis renommé, lisible par le seul utilisateur du service
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path) or ".", prefix=".token-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": self._access_token, "expires_at": self._expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            logger.warning("Could not write the shared token cache", exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class AsyncTokenManager(TokenManager):
+    """
+    Variante asynchrone de TokenManager, pour AsyncAuthToken : mêmes règles
+    de renouvellement, le single-flight passant par un verrou asyncio.
+    """
+
+    def __init__(
+        self,
+        auth_token: AsyncAuthToken,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        cache_dir: Optional[str] = TOKEN_CACHE_DIR,
+    ):
+        super().__init__(auth_token, refresh_margin, cache_dir)
+        # Créé dans la boucle d'événements qui l'utilise (Python 3.9)
+        self._async_lock: Optional[asyncio.Lock] = None
+
+    async def get_token(self) -> str:
+        """
+        Retourne un token d'accès valide, en le renouvelant si nécessaire.
+
+        Raises:
+            httpx.HTTPStatusError: Si Keycloak refuse la demande de token
+        """
+        token, expires_at = self._access_token, self._expires_at
+        if token and not self._needs_refresh(expires_at):
+            return token
+
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        still_valid = token is not None and time.time() < expires_at
+        # Token encore valide : les autres appelants n'attendent pas le renouvellement en cours
+        if still_valid and self._async_lock.locked():
+            return token
+
+        async with self._async_lock:
+            if self._access_token and not self._needs_refresh(self._expires_at):
+                return self._access_token
+            try:
+                await self._refresh_async()
+            except Exception:
+                if still_valid:
+                    logger.warning("Token refresh failed, keeping the current token until it expires", exc_info=True)
+                    return token
+                raise
+            return self._access_token
+
+    def invalidate(self, token: Optional[str] = None):
+        # Pas de verrou à prendre : tout se passe dans la boucle d'événements
+        if token is None or token == self._access_token:
+            self._rejected = self._access_token
+            self._access_token = None
+            self._expires_at = 0.0
+
+    async def _acquire_shared_async(self):
+        """
+        Prend le verrou inter-processus, qu'un autre processus peut tenir : attendu
+        hors de la boucle. Si l'appelant est annulé pendant l'attente, le thread
+        continue et le verrou obtenu est relâché dès qu'il l'a pris.
+        """
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self._acquire_shared))
+        try:
+            return await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(self._release_acquired)
+            raise
+
+    def _release_acquired(self, acquiring: asyncio.Future):
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self._release_shared(acquiring.result())
+
+    async def _refresh_async(self):
+        lock_file = await self._acquire_shared_async()
+        try:
+            if self._use_shared():
+                return
+            self._store(await self.auth_token.get_token())
+        finally:
+            self._release_shared(lock_file)
@@ -0,0 +1,433 @@
+"""
+Batch operations streaming one NDJSON status line per invoice as it completes.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import ExitStack
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from pydantic import ValidationError
+
+import outbox
+import placeholders
+import render_pool
+from cii_validation import InvalidInvoiceError, check_stored_invoice
+from invoice_generator import build_invoice_metadata, generate_invoice_pdf
+from invoice_sender import invoice_date_from_metadata
+from models import InvoiceRequest
+from storage import get_storage
+from upload_pipeline import SpooledUpload, UploadError, get_upload_type, process_upload
+
+logger = logging.getLogger(__name__)
+
+# Rendered invoices are written to storage in groups of at most this size
+BATCH_COMMIT_SIZE = int(os.environ.get("BATCH_COMMIT_SIZE", "50"))
+
+# Page size used to walk the invoices matching a filter
+_SEND_PAGE_SIZE = 500
+
+_DONE = object()
+
+
+def _status_line(
+    index: int, invoice_id: Optional[str], error: Optional[str] = None, file: Optional[str] = None,
+    send_status: Optional[str] = None, **timings
+) -> bytes:
+    line = {"index": index}
+    if file is not None:
+        line["file"] = file
+    line.update(id=invoice_id, status="error" if error else "ok")
+    if error:
+        line["error"] = error
+    if send_status is not None:
+        line["send_status"] = send_status
+    line.update({name: round(value, 1) for name, value in timings.items()})
+    return (json.dumps(line) + "\n").encode("utf-8")
+
+
+async def iter_json_list(items: list) -> AsyncIterator[dict]:
+    for item in items:
+        yield item
+
+
+async def iter_ndjson(body: bytes) -> AsyncIterator[dict]:
+    """
+    Yields the objects of an NDJSON body, one per non-empty line.
+    A line that is not valid JSON is yielded as None so it gets reported.
+    """
+    for line in body.splitlines():
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in err['loc']) or 'invoice'}: {err['msg']}" for err in error.errors())
+
+
+async def render_batch(items: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    """
+    Render and store a batch of invoices.
+
+    Invoices are rendered in parallel in the render pool and saved in groups of
+    BATCH_COMMIT_SIZE. One NDJSON status line is yielded per invoice once it is
+    stored (or has failed): a failing invoice never aborts the others. When
+    the client reads the status lines slowly or storage lags, rendering waits:
+    at most one group of rendered invoices is queued.
+    """
+    started = time.perf_counter()
+    # Rendered invoices waiting to be stored: a full queue holds up the render
+    # tasks, which keep their in_flight slot until their result is queued
+    results: asyncio.Queue = asyncio.Queue(max(BATCH_COMMIT_SIZE, 1))
+    # Bound the number of invoices parsed and queued for rendering at once
+    in_flight = asyncio.Semaphore(max(render_pool.pool_size(), 1) * 2)
+
+    def elapsed_ms() -> float:
+        return (time.perf_counter() - started) * 1000
+
+    async def render(index: int, invoice: InvoiceRequest):
+        render_start = time.perf_counter()
+        try:
+            pdf_bytes, xml_content = await render_pool.run(generate_invoice_pdf, invoice)
+            await results.put((index, invoice, (pdf_bytes, xml_content), None, render_start))
+        except InvalidInvoiceError as e:
+            await results.put((index, invoice, None, f"Invoice XML is not valid EN16931: {e}", render_start))
+        except Exception as e:
+            await results.put((index, invoice, None, str(e), render_start))
+        finally:
+            in_flight.release()
+
+    tasks = []
+
+    async def produce():
+        index = 0
+        try:
+            async for raw in items:
+                await in_flight.acquire()
+                try:
+                    invoice = InvoiceRequest.model_validate(raw)
+                except ValidationError as e:
+                    in_flight.release()
+                    invoice_id = raw.get("invoice_number") if isinstance(raw, dict) else None
+                    await results.put((index, invoice_id, None, f"Invalid invoice: {_format_validation_error(e)}", None))
+                else:
+                    tasks.append(asyncio.create_task(render(index, invoice)))
+                index += 1
+        except Exception as e:
+            await results.put((index, None, None, f"Invalid batch input: {e}", None))
+        finally:
+            await asyncio.gather(*tasks)
+            await results.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    storage = get_storage()
+    rendered = []
+    done = False
+    try:
+        while not done:
+            result = await results.get()
+            if result is _DONE:
+                done = True
+            else:
+                index, invoice, output, error, render_start = result
+                if error:
+                    invoice_id = invoice.invoice_number if isinstance(invoice, InvoiceRequest) else invoice
+                    timings = {"render_ms": (time.perf_counter() - render_start) * 1000} if render_start else {}
+                    yield _status_line(index, invoice_id, error, elapsed_ms=elapsed_ms(), **timings)
+                else:
+                    render_ms = (time.perf_counter() - render_start) * 1000
+                    rendered.append((index, invoice, output, render_ms))
+
+            # Commit when the group is full, or when nothing else is ready right now
+            if rendered and (done or len(rendered) >= BATCH_COMMIT_SIZE or results.empty()):
+                entries = [
+                    (invoice.invoice_number, pdf_bytes, xml_content, build_invoice_metadata(invoice))
+                    for _, invoice, (pdf_bytes, xml_content), _ in rendered
+                ]
+                try:
+                    await asyncio.to_thread(storage.save_invoices, entries)
+                    error = None
+                except Exception as e:
+                    logger.error(f"Failed to save batch of {len(entries)} invoices: {e}")
+                    error = f"Failed to save invoice: {e}"
+                for index, invoice, _, render_ms in rendered:
+                    yield _status_line(index, invoice.invoice_number, error, render_ms=render_ms, elapsed_ms=elapsed_ms())
+                rendered = []
+        await producer
+    finally:
+        # Client went away: stop reading the input and rendering
+        if not producer.done():
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+async def iter_send_targets(
+    invoice_numbers: Optional[List[str]] = None,
+    filters: Optional[Dict] = None,
+) -> AsyncIterator[Tuple[str, Optional[dict]]]:
+    """
+    Yields (invoice_number, metadata) for each invoice to send: the given
+    invoice numbers (metadata None when the invoice does not exist), or every
+    invoice matching the filters, by date.
+    """
+    storage = get_storage()
+    if invoice_numbers is not None:
+        for invoice_number in invoice_numbers:
+            try:
+                metadata = storage.get_invoice_metadata(invoice_number)
+            except ValueError:
+                metadata = None
+            yield invoice_number, metadata
+        return
+
+    cursor = None
+    while True:
+        page, cursor = storage.query_invoices(
+            limit=_SEND_PAGE_SIZE, cursor=cursor, filters=filters, sort="date", descending=False
+        )
+        for metadata in page:
+            yield metadata["id"], metadata
+        if cursor is None:
+            break
+
+
+async def send_batch(targets: AsyncIterator[Tuple[str, Optional[dict]]]) -> AsyncIterator[bytes]:
+    """
+    Queue a batch of stored invoices in the outbox, to be sent to the remote API.
+
+    Each invoice is checked as by POST /invoices/{id}/send (EN16931, in the
+    render pool), then queued: the outbox dispatcher sends it, with retries,
+    and GET /invoices/{id}/send-status follows it. One NDJSON status line is
+    yielded per invoice once it is queued (or has been refused), with the
+    status of its send in "send_status".
+    """
+    started = time.perf_counter()
+    # Bound the number of invoices checked at once, and of status lines waiting for the client
+    concurrency = max(render_pool.pool_size(), 1) * 2
+    results: asyncio.Queue = asyncio.Queue(concurrency)
+    in_flight = asyncio.Semaphore(concurrency)
+
+    def elapsed_ms() -> float:
+        return (time.perf_counter() - started) * 1000
+
+    async def queue(index: int, invoice_number: str, metadata: dict):
+        try:
+            try:
+                await check_stored_invoice(invoice_number)
+                status = await asyncio.to_thread(
+                    outbox.queue_send, invoice_number, invoice_date_from_metadata(metadata)
+                )
+                line = _status_line(index, invoice_number, send_status=status["status"], elapsed_ms=elapsed_ms())
+            except InvalidInvoiceError as e:
+                line = _status_line(index, invoice_number, f"Invoice XML is not valid EN16931: {e}", elapsed_ms=elapsed_ms())
+            except Exception as e:
+                line = _status_line(index, invoice_number, f"Failed to queue invoice: {e}", elapsed_ms=elapsed_ms())
+            await results.put(line)
+        finally:
+            in_flight.release()
+
+    tasks = []
+
+    async def produce():
+        index = 0
+        try:
+            async for invoice_number, metadata in targets:
+                if metadata is None:
+                    await results.put(_status_line(index, invoice_number, "Invoice not found", elapsed_ms=elapsed_ms()))
+                else:
+                    await in_flight.acquire()
+                    tasks.append(asyncio.create_task(queue(index, invoice_number, metadata)))
+                index += 1
+        except Exception as e:
+            await results.put(_status_line(index, None, f"Invalid batch input: {e}", elapsed_ms=elapsed_ms()))
+        finally:
+            await asyncio.gather(*tasks)
+            await results.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            line = await results.get()
+            if line is _DONE:
+                break
+            yield line
+        await producer
+    finally:
+        # Client went away: stop queueing
+        if not producer.done():
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+class _ProcessedUpload:
+    """An uploaded file through the pipeline, waiting to be stored."""
+
+    def __init__(self, index: int, filename: str, upload: SpooledUpload, upload_type: str,
+                 metadata: dict, xml_content: Optional[bytes], process_ms: float):
+        self.index = index
+        self.filename = filename
+        self.upload = upload
+        self.upload_type = upload_type
+        self.metadata = metadata
+        self.xml_content = xml_content
+        self.process_ms = process_ms
+        self.error: Optional[str] = None
+
+
+def _save_uploads(storage, accepted: List[_ProcessedUpload]):
+    """Saves the accepted uploads together, copying the uploaded files from the spool."""
+    with ExitStack() as stack:
+        entries = []
+        for processed in accepted:
+            uploaded = stack.enter_context(processed.upload.open())
+            if processed.upload_type == 'pdf':
+                pdf_content, xml_content = uploaded, processed.xml_content
+            else:
+                pdf_content, xml_content = None, processed.xml_content or uploaded
+            entries.append((processed.metadata['id'], pdf_content, xml_content, processed.metadata))
+        storage.save_invoices(entries)
+
+
+async def upload_batch(
+    files: AsyncIterator[Tuple[Optional[str], Union[SpooledUpload, UploadError]]],
+) -> AsyncIterator[bytes]:
+    """
+    Process and store a batch of uploaded invoice files (Factur-X PDF or CII XML).
+
+    Files go through the upload pipeline in parallel in the render pool. The
+    processed ones are stored in groups of BATCH_COMMIT_SIZE, with one
+    duplicate lookup per group; XML files are stored without a PDF, their
+    placeholder being rendered later (see placeholders). One NDJSON status
+    line is yielded per file once it is stored (or has been rejected): a
+    failing file never aborts the others.
+    """
+    started = time.perf_counter()
+    results: asyncio.Queue = asyncio.Queue()
+    # Bound the number of files spooled and queued for processing at once
+    in_flight = asyncio.Semaphore(max(render_pool.pool_size(), 1) * 2)
+
+    def elapsed_ms() -> float:
+        return (time.perf_counter() - started) * 1000
+
+    async def process(index: int, filename: str, upload: SpooledUpload):
+        process_start = time.perf_counter()
+        try:
+            upload_type = get_upload_type(filename)
+            metadata, xml_content = await render_pool.run(process_upload, filename, upload.source)
+        except Exception as e:
+            upload.close()
+            await results.put((index, filename, e.detail if isinstance(e, UploadError) else str(e)))
+        except asyncio.CancelledError:
+            upload.close()
+            raise
+        else:
+            process_ms = (time.perf_counter() - process_start) * 1000
+            await results.put(_ProcessedUpload(index, filename, upload, upload_type, metadata, xml_content, process_ms))
+        finally:
+            in_flight.release()
+
+    tasks = []
+
+    async def produce():
+        index = 0
+        try:
+            async for filename, upload in files:
+                if isinstance(upload, UploadError):
+                    await results.put((index, filename, upload.detail))
+                else:
+                    await in_flight.acquire()
+                    tasks.append(asyncio.create_task(process(index, filename, upload)))
+                index += 1
+        except Exception as e:
+            await results.put((index, None, f"Invalid batch input: {e}"))
+        finally:
+            await asyncio.gather(*tasks)
+            await results.put(_DONE)
+
+    async def commit(group: List[_ProcessedUpload], seen: set):
+        ids = [processed.metadata['id'] for processed in group]
+        existing = await asyncio.to_thread(storage.existing_invoice_ids, ids)
+
+        accepted = []
+        for processed in group:
+            invoice_id = processed.metadata['id']
+            if invoice_id in existing or invoice_id in seen:
+                processed.error = f"Une facture avec le numero '{invoice_id}' existe deja"
+            else:
+                seen.add(invoice_id)
+                accepted.append(processed)
+
+        try:
+            await asyncio.to_thread(_save_uploads, storage, accepted)
+        except Exception as e:
+            logger.error(f"Failed to save batch of {len(accepted)} uploaded invoices: {e}")
+            if len(accepted) == 1:
+                accepted[0].error = f"Erreur lors de la sauvegarde: {str(e)}"
+            else:
+                # Saved one by one to find out which of them failed
+                for processed in accepted:
+                    try:
+                        await asyncio.to_thread(_save_uploads, storage, [processed])
+                    except Exception as e:
+                        processed.error = f"Erreur lors de la sauvegarde: {str(e)}"
+
+        placeholders.schedule(
+            processed.metadata['id'] for processed in accepted
+            if processed.upload_type == 'xml' and processed.error is None
+        )
+
+    producer = asyncio.create_task(produce())
+    storage = get_storage()
+    # Invoice ids stored by this batch, so that a number repeated in the batch is a duplicate too
+    seen: set = set()
+    group: List[_ProcessedUpload] = []
+    done = False
+    try:
+        while not done:
+            result = await results.get()
+            if result is _DONE:
+                done = True
+            elif isinstance(result, _ProcessedUpload):
+                group.append(result)
+            else:
+                index, filename, error = result
+                yield _status_line(index, None, error, file=filename, elapsed_ms=elapsed_ms())
+
+            # Commit when the group is full, or when nothing else is ready right now
+            if group and (done or len(group) >= BATCH_COMMIT_SIZE or results.empty()):
+                try:
+                    await commit(group, seen)
+                except Exception as e:
+                    logger.error(f"Failed to store batch of {len(group)} uploaded invoices: {e}")
+                    for processed in group:
+                        processed.error = processed.error or f"Erreur lors de la sauvegarde: {str(e)}"
+                finally:
+                    for processed in group:
+                        processed.upload.close()
+                for processed in group:
+                    yield _status_line(
+                        processed.index, processed.metadata['id'], processed.error, file=processed.filename,
+                        process_ms=processed.process_ms, elapsed_ms=elapsed_ms(),
+                    )
+                group = []
+        await producer
+    finally:
+        # Client went away: stop reading the files and processing them
+        if not producer.done():
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+        # Spooled files processed but not stored
+        for processed in group:
+            processed.upload.close()
+        while not results.empty():
+            result = results.get_nowait()
+            if isinstance(result, _ProcessedUpload):
+                result.upload.close()
@@ -0,0 +1,49 @@
+"""
+EN16931 validation of a CII invoice: rules compiled per call vs compiled once vs cached result.
+
+    python -m benchmarks.cii_validation [--items 20] [--repeat 10]
+
+"compiled per call" is what validating with the facturx library costs (the
+XML Schema and the Schematron stylesheet loaded for each document); "compiled
+once" reuses them, as the service does; "cached" is an XML validated before.
+Needs saxonche for the Schematron (CII_VALIDATION=full, the default).
+"""
+import argparse
+import os
+import tempfile
+
+import cii_validation
+from benchmarks.common import measure, report, sample_invoice
+from cii_writer import cii_xml_bytes
+from invoice_generator import compute_totals
+
+
+def compiled_per_call(xml_bytes: bytes):
+    cii_validation._thread_local.schemas = {}
+    cii_validation._stylesheets.clear()
+    return cii_validation._validate(xml_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    cii_validation.check_config()
+
+    invoice = sample_invoice(args.items)
+    xml_bytes = cii_xml_bytes(invoice, compute_totals(invoice))
+    error = cii_validation._validate(xml_bytes)
+    print(f"{args.items} line items, {len(xml_bytes)} bytes of XML ({cii_validation.CII_VALIDATION}): {error or 'valid'}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        cii_validation._cache = cii_validation.ValidationCache(path=os.path.join(directory, "validation.sqlite3"))
+        cii_validation.validate_en16931(xml_bytes)
+
+        report("compiled per call", measure(lambda: compiled_per_call(xml_bytes), repeat=args.repeat, warmup=1))
+        report("compiled once", measure(lambda: cii_validation._validate(xml_bytes), repeat=args.repeat))
+        report("cached", measure(lambda: cii_validation.validate_en16931(xml_bytes), repeat=args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+CII XML generation for large invoices: time and peak memory of the streaming writer.
+
+    python -m benchmarks.cii_writer [--items 10000] [--repeat 5]
+
+"to bytes" keeps the whole document (the size of the output, no tree or
+string copy); "streamed" writes it to a file as it goes and stays flat.
+"""
+import argparse
+import os
+import tracemalloc
+
+from benchmarks.common import measure, report, sample_invoice
+from cii_writer import cii_xml_bytes, write_cii_xml
+from invoice_generator import compute_totals
+
+
+def peak_memory(fn) -> float:
+    """Peak memory allocated by fn, in MB (timings are measured separately)."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    invoice = sample_invoice(args.items)
+    totals = compute_totals(invoice)
+    print(f"{args.items} line items, {len(cii_xml_bytes(invoice, totals))} bytes of XML")
+
+    def streamed():
+        with open(os.devnull, "wb") as f:
+            write_cii_xml(invoice, totals, f)
+
+    for label, fn in (("to bytes", lambda: cii_xml_bytes(invoice, totals)), ("streamed", streamed)):
+        report(label, measure(fn, repeat=args.repeat, warmup=1))
+        print(f"{'':<40} peak {peak_memory(fn):8.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Shared helpers for the benchmarks.
+"""
+import statistics
+import time
+from datetime import date
+from typing import Callable, Dict
+
+from models import Address, InvoiceRequest, LineItem, Party
+
+
+def sample_invoice(n_items: int = 3, invoice_number: str = "BENCH-001") -> InvoiceRequest:
+    """Builds a realistic invoice with n_items line items."""
+    return InvoiceRequest(
+        invoice_number=invoice_number,
+        date=date(2024, 1, 31),
+        seller=Party(
+            name="My Company",
+            address=Address(street="123 Business Rd", zip_code="75001", city="Paris", country_code="FR"),
+            vat_id="FR123456789",
+            siret="12345678900012",
+        ),
+        buyer=Party(
+            name="Client Corp",
+            address=Address(street="456 Client St", zip_code="69002", city="Lyon", country_code="FR"),
+            vat_id="FR987654321",
+        ),
+        items=[
+            LineItem(description=f"Service {i}", quantity=1 + i % 5, unit_price=100.0 + i, vat_rate=20.0)
+            for i in range(n_items)
+        ],
+    )
+
+
+def measure(fn: Callable, repeat: int = 20, warmup: int = 2) -> Dict[str, float]:
+    """Runs fn repeatedly and returns timing statistics in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "min": min(timings),
+    }
+
+
+def report(label: str, stats: Dict[str, float]):
+    print(f"{label:<40} mean {stats['mean']:8.2f} ms   median {stats['median']:8.2f} ms   min {stats['min']:8.2f} ms")
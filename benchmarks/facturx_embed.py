@@ -0,0 +1,37 @@
+"""
+Factur-X embedding latency per invoice: in-memory buffers vs temporary files.
+
+    python -m benchmarks.facturx_embed [--items 20] [--repeat 50]
+
+Set TMPDIR to the container's overlay filesystem to reproduce production numbers.
+"""
+import argparse
+
+from weasyprint import HTML
+
+from benchmarks.common import measure, report, sample_invoice
+from cii_writer import cii_xml_bytes
+from invoice_generator import compute_totals, embed_facturx_xml, render_invoice_html
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    invoice = sample_invoice(args.items)
+    totals = compute_totals(invoice)
+    pdf_bytes = HTML(string=render_invoice_html(invoice, totals)).write_pdf()
+    xml_bytes = cii_xml_bytes(invoice, totals)
+    print(f"PDF {len(pdf_bytes)} bytes, XML {len(xml_bytes)} bytes, {args.items} line items")
+
+    tempfile_stats = measure(lambda: embed_facturx_xml(pdf_bytes, xml_bytes, mode="tempfile"), repeat=args.repeat)
+    memory_stats = measure(lambda: embed_facturx_xml(pdf_bytes, xml_bytes, mode="memory"), repeat=args.repeat)
+    report("tempfile", tempfile_stats)
+    report("memory", memory_stats)
+    print(f"Saved per invoice: {tempfile_stats['mean'] - memory_stats['mean']:.2f} ms (mean)")
+
+
+if __name__ == "__main__":
+    main()
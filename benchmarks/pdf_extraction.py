@@ -0,0 +1,113 @@
+"""
+Factur-X XML extraction from uploaded PDFs: full facturx parser vs targeted attachment reader.
+
+    python -m benchmarks.pdf_extraction [--repeat 10] [--pdf supplier.pdf ...]
+
+The generated corpus covers the shapes of real supplier PDFs: a plain invoice,
+invoices carrying scanned images of 5 and 40 MB, a 2000 page statement, and an
+invoice modified by an incremental update. --pdf adds files of your own. Each
+file is read from disk, the way large uploads are spooled.
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+from io import BytesIO
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+import xml_processor
+from benchmarks.common import measure, report, sample_invoice
+from invoice_generator import generate_invoice_pdf
+
+
+def _with_images(pdf: bytes, megabytes: int) -> bytes:
+    # Incompressible image streams of 5 MB, as scans are
+    writer = PdfWriter(clone_from=PdfReader(BytesIO(pdf)))
+    images = DictionaryObject()
+    for i in range(max(1, megabytes // 5)):
+        image = DecodedStreamObject()
+        image.set_data(os.urandom(5 * 1024 * 1024))
+        image.update({
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Image"),
+            NameObject("/Width"): NumberObject(1280),
+            NameObject("/Height"): NumberObject(1365),
+            NameObject("/ColorSpace"): NameObject("/DeviceRGB"),
+            NameObject("/BitsPerComponent"): NumberObject(8),
+        })
+        images[NameObject(f"/Im{i}")] = writer._add_object(image)
+    writer.pages[0]["/Resources"].get_object()[NameObject("/XObject")] = images
+    return _write(writer)
+
+
+def _with_pages(pdf: bytes, pages: int) -> bytes:
+    writer = PdfWriter(clone_from=PdfReader(BytesIO(pdf)))
+    for _ in range(pages):
+        writer.add_blank_page(595, 842)
+    return _write(writer)
+
+
+def _updated(pdf: bytes) -> bytes:
+    writer = PdfWriter(BytesIO(pdf), incremental=True)
+    writer.add_metadata({"/Title": "Signed invoice"})
+    return _write(writer)
+
+
+def _write(writer: PdfWriter) -> bytes:
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def extract(path: str, mode: str) -> bytes:
+    xml_processor.PDF_EXTRACTION = mode
+    with open(path, "rb") as pdf_file:
+        return xml_processor.extract_xml_bytes_from_pdf(pdf_file)
+
+
+def peak_kib(fn) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--pdf", nargs="*", default=[], help="Factur-X PDFs to add to the corpus")
+    args = parser.parse_args()
+
+    invoice_pdf, _ = generate_invoice_pdf(sample_invoice(20))
+    corpus = {
+        "invoice": invoice_pdf,
+        "invoice + 5 MB of images": _with_images(invoice_pdf, 5),
+        "invoice + 40 MB of images": _with_images(invoice_pdf, 40),
+        "2000 page statement": _with_pages(invoice_pdf, 2000),
+        "incremental update": _updated(invoice_pdf),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        for label, pdf in corpus.items():
+            paths[label] = os.path.join(directory, f"{len(paths)}.pdf")
+            with open(paths[label], "wb") as f:
+                f.write(pdf)
+        paths.update({os.path.basename(path): path for path in args.pdf})
+
+        for label, path in paths.items():
+            assert extract(path, "full") == extract(path, "targeted"), label
+            print(f"{label}, {os.path.getsize(path) // 1024} KiB")
+            full = measure(lambda: extract(path, "full"), repeat=args.repeat)
+            targeted = measure(lambda: extract(path, "targeted"), repeat=args.repeat)
+            report(f"  full parser ({peak_kib(lambda: extract(path, 'full'))} KiB peak)", full)
+            report(f"  targeted reader ({peak_kib(lambda: extract(path, 'targeted'))} KiB peak)", targeted)
+            print(f"  speed-up: x{full['mean'] / targeted['mean']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
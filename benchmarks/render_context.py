@@ -0,0 +1,75 @@
+"""
+Per-invoice render time: rebuilding templates, CSS and fonts on every render vs a reused RenderContext.
+
+    python -m benchmarks.render_context [--items 20] [--repeat 30]
+
+"Per call" reproduces the previous rendering path: a fresh Jinja environment
+for the placeholder, inline CSS parsed with each document, and a new font
+configuration for every PDF.
+"""
+import argparse
+import os
+
+from jinja2 import Environment, FileSystemLoader
+from weasyprint import HTML
+
+from benchmarks.common import measure, report, sample_invoice
+from invoice_generator import build_invoice_metadata, compute_totals, render_invoice_html
+from render_context import TEMPLATES_DIR, RenderContext
+
+env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+
+
+def _inline_css(html: str, stylesheet: str) -> str:
+    with open(os.path.join(TEMPLATES_DIR, stylesheet), encoding="utf-8") as f:
+        return html.replace("</head>", f"<style>{f.read()}</style></head>", 1)
+
+
+def invoice_per_call(invoice) -> bytes:
+    html = env.get_template("invoice.html").render(invoice=invoice, **_totals(invoice))
+    return HTML(string=_inline_css(html, "invoice.css")).write_pdf()
+
+
+def placeholder_per_call(metadata) -> bytes:
+    fresh_env = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+    html = fresh_env.get_template("upload-placeholder.html").render(metadata=metadata)
+    return HTML(string=_inline_css(html, "upload-placeholder.css")).write_pdf()
+
+
+def _totals(invoice) -> dict:
+    total_tax_basis, total_vat, total_with_tax, vat_amounts = compute_totals(invoice)
+    return {"total_tax_basis": total_tax_basis, "total_vat": total_vat,
+            "total_with_tax": total_with_tax, "vat_amounts": vat_amounts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    invoice = sample_invoice(args.items)
+    metadata = build_invoice_metadata(invoice)
+    context = RenderContext()
+    print(f"{args.items} line items")
+
+    before = measure(lambda: invoice_per_call(invoice), repeat=args.repeat)
+    after = measure(lambda: context.write_pdf(render_invoice_html(invoice), "invoice.css"), repeat=args.repeat)
+    report("invoice, per call", before)
+    report("invoice, render context", after)
+    print(f"Saved per invoice: {before['mean'] - after['mean']:.2f} ms (mean)")
+
+    before = measure(lambda: placeholder_per_call(metadata), repeat=args.repeat)
+    after = measure(
+        lambda: context.write_pdf(
+            context.template("upload-placeholder.html").render(metadata=metadata), "upload-placeholder.css"
+        ),
+        repeat=args.repeat,
+    )
+    report("placeholder, per call", before)
+    report("placeholder, render context", after)
+    print(f"Saved per placeholder: {before['mean'] - after['mean']:.2f} ms (mean)")
+
+
+if __name__ == "__main__":
+    main()
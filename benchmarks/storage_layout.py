@@ -0,0 +1,76 @@
+"""
+LocalStorage lookups and directory listing at scale: flat vs sharded layout.
+
+    python -m benchmarks.storage_layout [--files 1000000] [--lookups 10000] [--directory /var/tmp]
+
+Creates --files empty invoice files ({id}.pdf, {id}.xml, {id}.meta.json) in the
+flat layout, measures it, measures the sharded layout reading them before they
+are migrated, migrates them with LocalStorage.migrate_file and measures again.
+"list" is the top directory read by ls or a backup tool, "walk" every file
+under it. Timings are taken with the files in the page cache: on a cold cache
+or a network filesystem, the large flat directory costs more still.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import measure, report
+from storage import LocalStorage
+
+
+def create_files(directory: str, invoices: int):
+    for i in range(invoices):
+        for suffix in (".pdf", ".xml", ".meta.json"):
+            os.close(os.open(os.path.join(directory, f"INV-{i:07d}{suffix}"), os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def walk(directory: str) -> int:
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def measure_layout(label: str, storage: LocalStorage, invoices: int, lookups: int):
+    ids = [f"INV-{random.randrange(invoices):07d}" for _ in range(lookups)]
+    missing = [f"NONE-{i}" for i in range(lookups)]
+    print(label)
+    report("  lookup (found)", measure(lambda: [storage.get_document(i, "pdf") for i in ids], repeat=3, warmup=1))
+    report("  lookup (missing)", measure(lambda: [storage.get_document(i, "pdf") for i in missing], repeat=3, warmup=1))
+    report("  list", measure(lambda: os.listdir(storage.directory), repeat=3, warmup=1))
+    report("  walk", measure(lambda: walk(storage.directory), repeat=3, warmup=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=10000, help="Lookups per timed run")
+    parser.add_argument("--directory", default=None, help="Where to create the files (default: system temp)")
+    args = parser.parse_args()
+
+    invoices = args.files // 3
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        # Created before the files: an existing archive would otherwise be indexed first
+        flat = LocalStorage(directory, layout="flat")
+        start = time.perf_counter()
+        create_files(directory, invoices)
+        print(f"{invoices * 3} files created in {time.perf_counter() - start:.1f} s; lookups per run: {args.lookups}")
+
+        measure_layout("flat", flat, invoices, args.lookups)
+        sharded = LocalStorage(directory, layout="sharded")
+        measure_layout("sharded, before migration", sharded, invoices, args.lookups)
+
+        start = time.perf_counter()
+        moved = sum(sharded.migrate_file(filename) for filename in sharded.flat_files())
+        elapsed = time.perf_counter() - start
+        print(f"migrated {moved} files in {elapsed:.1f} s ({moved / elapsed:.0f} files/s)")
+
+        # As after a restart: no flat file is left to fall back to
+        measure_layout("sharded", LocalStorage(directory, layout="sharded"), invoices, args.lookups)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
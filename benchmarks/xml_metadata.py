@@ -0,0 +1,75 @@
+"""
+Metadata extraction from CII XML: precompiled extraction plan vs the previous
+implementation running one string XPath query (plus a "//" fallback) per field.
+
+    python -m benchmarks.xml_metadata [--repeat 20]
+"""
+import argparse
+
+from lxml import etree
+
+from benchmarks.common import measure, report, sample_invoice
+from cii_writer import cii_xml_bytes
+from invoice_generator import compute_totals
+from xml_processor import NAMESPACES, _AMOUNT_FIELDS, _build_metadata, extract_metadata_from_xml
+
+# Queries of the previous implementation, in order of evaluation
+_LEGACY_QUERIES = {
+    'id': ['//rsm:ExchangedDocument/ram:ID/text()'],
+    'date': ['//rsm:ExchangedDocument/ram:IssueDateTime/udt:DateTimeString/text()',
+             '//ram:IssueDateTime/udt:DateTimeString/text()'],
+}
+for _party in ('Seller', 'Buyer'):
+    for _field, _path in (('name', 'ram:Name'),
+                          ('street', 'ram:PostalTradeAddress/ram:LineOne'),
+                          ('city', 'ram:PostalTradeAddress/ram:CityName'),
+                          ('zip', 'ram:PostalTradeAddress/ram:PostcodeCode'),
+                          ('country', 'ram:PostalTradeAddress/ram:CountryID'),
+                          ('vat', 'ram:SpecifiedTaxRegistration/ram:ID')):
+        _LEGACY_QUERIES[f'{_party.lower()}_{_field}'] = [
+            f'//ram:ApplicableHeaderTradeAgreement/ram:{_party}TradeParty/{_path}/text()',
+            f'//ram:{_party}TradeParty/{_path}/text()',
+        ]
+_LEGACY_QUERIES['currency'] = ['//ram:ApplicableHeaderTradeSettlement/ram:InvoiceCurrencyCode/text()',
+                               '//ram:InvoiceCurrencyCode/text()']
+for _field, _element in (('total_ht', 'TaxBasisTotalAmount'), ('total_ttc', 'GrandTotalAmount'),
+                         ('total_tax', 'TaxTotalAmount')):
+    _LEGACY_QUERIES[_field] = [f'//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:{_element}/text()',
+                               f'//ram:{_element}/text()']
+
+
+def legacy_extract_metadata_from_xml(xml_bytes: bytes) -> dict:
+    root = etree.fromstring(xml_bytes)
+    namespaces = {**NAMESPACES, **{k: v for k, v in root.nsmap.items() if k}}
+    values = {}
+    for field, queries in _LEGACY_QUERIES.items():
+        text = ''
+        for query in queries:
+            result = root.xpath(query, namespaces=namespaces)
+            text = str(result[0]).strip() if result else ''
+            if text and not (field in _AMOUNT_FIELDS and float(text) == 0):
+                break
+        values[field] = text
+    return _build_metadata(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for n_items in (3, 10000):
+        invoice = sample_invoice(n_items)
+        xml_bytes = cii_xml_bytes(invoice, compute_totals(invoice))
+        assert legacy_extract_metadata_from_xml(xml_bytes) == extract_metadata_from_xml(xml_bytes)
+
+        print(f"{n_items} line items, {len(xml_bytes) // 1024} KiB")
+        legacy = measure(lambda: legacy_extract_metadata_from_xml(xml_bytes), repeat=args.repeat)
+        compiled = measure(lambda: extract_metadata_from_xml(xml_bytes), repeat=args.repeat)
+        report("  string XPath queries", legacy)
+        report("  compiled extraction plan", compiled)
+        print(f"  speed-up: x{legacy['mean'] / compiled['mean']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+EN16931 validation of CII invoices: the XML Schema of the Factur-X profile of
+the document, then the EN16931 Schematron business rules (BR-*).
+
+Both come with the facturx library, the Schematron already compiled to XSLT 2.0,
+which is run with SaxonC (saxonche). Compiling the Schematron stylesheet takes
+far longer than validating an invoice, so the schemas and stylesheets are
+compiled once per process (the XML Schemas once per thread: lxml validators
+must not be shared between threads) and reused. Render workers compile them
+when they start.
+
+The XML Schema is checked while the document is streamed, in constant memory.
+The Schematron needs the whole document in memory, and its time grows with it:
+it only runs on documents up to VALIDATION_FULL_MAX_BYTES. Only Factur-X CII
+documents of a known profile are validated; other flavors (ZUGFeRD 1, UBL...)
+are left to the structural checks of the upload pipeline.
+
+Results are kept in a SQLite table shared by the processes, by SHA-256 of the
+document and version of the rules: an XML uploaded or sent again is not
+validated again.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from io import BytesIO
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from lxml import etree
+
+import db
+import render_pool
+from storage import get_storage
+from xml_processor import secure_parser
+
+try:
+    import facturx
+    from facturx.facturx import FACTURX_LEVEL2schematron, FACTURX_LEVEL2xsd, VERSION as FACTURX_VERSION
+    from facturx import get_flavor, get_level
+except ImportError:
+    facturx = None
+
+try:
+    from saxonche import PySaxonProcessor
+except ImportError:
+    PySaxonProcessor = None
+
+logger = logging.getLogger(__name__)
+
+# "full": XML Schema and Schematron; "xsd": XML Schema only; "structure": only
+# the structural checks of the upload pipeline (previous behaviour).
+# The XML Schema is streamed: about 50 ms per MB, in constant memory. The
+# Schematron takes about 2 s and a few tens of MB of memory per MB of XML
+CII_VALIDATION = os.environ.get("CII_VALIDATION", "full").lower()
+# Larger documents only get the XML Schema check, even with CII_VALIDATION=full
+VALIDATION_FULL_MAX_BYTES = int(os.environ.get("VALIDATION_FULL_MAX_BYTES", str(1024 * 1024)))
+VALIDATION_CACHE_DB = os.environ.get("VALIDATION_CACHE_DB", os.path.join("invoices", "validation.sqlite3"))
+# Results kept, the oldest being evicted first (0: no cache)
+VALIDATION_CACHE_MAX = int(os.environ.get("VALIDATION_CACHE_MAX", "100000"))
+
+VALIDATION_MODES = ("structure", "xsd", "full")
+
+# Errors reported per document; the others are counted
+_MAX_REPORTED_ERRORS = 5
+
+VALIDATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS validation_results (
+    digest TEXT NOT NULL,
+    rules TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (digest, rules)
+);
+CREATE INDEX IF NOT EXISTS idx_validation_results_created_at ON validation_results (created_at);
+"""
+
+_SVRL = {"svrl": "http://purl.oclc.org/dsdl/svrl"}
+_SVRL_ERRORS = etree.XPath("//svrl:failed-assert | //svrl:successful-report", namespaces=_SVRL)
+_SVRL_TEXT = etree.XPath("string(svrl:text)", namespaces=_SVRL)
+
+_XML_ENCODING = re.compile(rb"""^(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+_CHUNK_SIZE = 1024 * 1024
+
+Source = Union[bytes, str]
+
+
+class InvalidInvoiceError(Exception):
+    """The XML of an invoice is not valid EN16931."""
+
+
+def check_config():
+    """
+    Raises:
+        ValueError: On an unknown CII_VALIDATION
+        ImportError: If the libraries CII_VALIDATION needs are missing
+    """
+    if CII_VALIDATION not in VALIDATION_MODES:
+        raise ValueError(f"Unknown CII_VALIDATION '{CII_VALIDATION}', expected one of {', '.join(VALIDATION_MODES)}")
+    if CII_VALIDATION != "structure" and facturx is None:
+        raise ImportError("facturx library is required for CII_VALIDATION=xsd or full")
+    if CII_VALIDATION == "full" and PySaxonProcessor is None:
+        raise ImportError("saxonche is required for CII_VALIDATION=full (pip install saxonche)")
+
+
+def _rules_path(name: str) -> str:
+    return os.path.join(os.path.dirname(facturx.__file__), "xsd_and_schematron", name)
+
+
+# XML Schemas, per thread and per profile
+_thread_local = threading.local()
+
+
+def _schema(level: str) -> etree.XMLSchema:
+    schemas = getattr(_thread_local, "schemas", None)
+    if schemas is None:
+        schemas = _thread_local.schemas = {}
+    schema = schemas.get(level)
+    if schema is None:
+        schema = schemas[level] = etree.XMLSchema(file=_rules_path(FACTURX_LEVEL2xsd[level]))
+    return schema
+
+
+# Schematron stylesheets, per process and per profile, compiled by one thread
+# at a time; a compiled stylesheet can then run in several threads
+_saxon_lock = threading.Lock()
+_saxon = None
+_stylesheets: Dict[str, object] = {}
+
+
+def _stylesheet(level: str):
+    global _saxon
+    if _saxon is None:
+        _saxon = PySaxonProcessor(license=False)
+    stylesheet = _stylesheets.get(level)
+    if stylesheet is None:
+        # Compiled from the file, so that the code lists it loads (document()) are found next to it
+        stylesheet = _stylesheets[level] = _saxon.new_xslt30_processor().compile_stylesheet(
+            stylesheet_file=_rules_path(FACTURX_LEVEL2schematron[level])
+        )
+    return stylesheet
+
+
+def _open(source: Source) -> BinaryIO:
+    return BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+
+
+def _size(source: Source) -> int:
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+
+def _digest(source: Source) -> str:
+    digest = hashlib.sha256()
+    with _open(source) as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _iterparse(f: BinaryIO, **kwargs):
+    return etree.iterparse(
+        f, events=("start", "end"), resolve_entities=False, load_dtd=False, no_network=True, huge_tree=False, **kwargs
+    )
+
+
+def profile(source: Source) -> Optional[str]:
+    """
+    Returns the Factur-X profile (level) of a CII document, read from the start
+    of the document only. None for the documents no rules are known for: other
+    flavors (ZUGFeRD 1, UBL...) and unknown profiles.
+
+    Raises:
+        etree.XMLSyntaxError: If the start of the document is not well-formed
+    """
+    root = None
+    with _open(source) as f:
+        depth = 0
+        for event, elem in _iterparse(f):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if depth > 1:
+                continue
+            # The document context is the first block of the root
+            root = elem.getparent() if depth else elem
+            break
+    if root is None:
+        return None
+    try:
+        flavor = get_flavor(root)
+        level = get_level(root, flavor)
+    except Exception:
+        return None
+    if flavor != "factur-x" or level not in FACTURX_LEVEL2xsd:
+        return None
+    return level
+
+
+def schema_error(source: Source, level: str) -> Optional[str]:
+    """Validates a CII document against the XML Schema of its profile, streamed; returns the error, if any."""
+    try:
+        with _open(source) as f:
+            depth = 0
+            for event, elem in _iterparse(f, schema=_schema(level)):
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                # Validated as it is read: the blocks of the document are dropped once read
+                if depth <= 2:
+                    elem.clear(keep_tail=False)
+                    parent = elem.getparent()
+                    while parent is not None and elem.getprevious() is not None:
+                        del parent[0]
+    except etree.XMLSyntaxError as e:
+        error = e.error_log.last_error
+        if error is not None and error.domain_name == "SCHEMASV":
+            # Errors found while streaming have no line number
+            return f"XSD: {error.message}" + (f" (line {error.line})" if error.line else "")
+        return f"XML syntax error: {e}"
+    return None
+
+
+def _xml_text(xml_bytes: bytes) -> str:
+    match = _XML_ENCODING.match(xml_bytes)
+    return xml_bytes.decode(match.group(1).decode("ascii") if match else "utf-8-sig")
+
+
+def schematron_errors(source: Source, level: str) -> List[str]:
+    """Runs the EN16931 Schematron of the profile of a CII document; returns the rules broken."""
+    with _saxon_lock:
+        stylesheet = _stylesheet(level)
+    # Saxon reads the file itself; content in memory is decoded, never re-serialized
+    if isinstance(source, bytes):
+        report = stylesheet.transform_to_string(xdm_node=_saxon.parse_xml(xml_text=_xml_text(source)))
+    else:
+        report = stylesheet.transform_to_string(source_file=os.path.abspath(source))
+
+    errors = []
+    for failure in _SVRL_ERRORS(etree.fromstring(report.encode("utf-8"), secure_parser())):
+        if failure.get("flag") in ("warning", "information"):
+            continue
+        text = " ".join(_SVRL_TEXT(failure).split())
+        rule = failure.get("id")
+        errors.append(text if not rule or text.startswith(f"[{rule}]") else f"[{rule}] {text}")
+    return errors
+
+
+def _validate(source: Source) -> Optional[str]:
+    try:
+        level = profile(source)
+    except etree.XMLSyntaxError as e:
+        return f"XML syntax error: {str(e)}"
+    if level is None:
+        return None
+
+    error = schema_error(source, level)
+    if error or CII_VALIDATION != "full" or _size(source) > VALIDATION_FULL_MAX_BYTES:
+        return error
+
+    errors = schematron_errors(source, level)
+    if not errors:
+        return None
+    message = "; ".join(errors[:_MAX_REPORTED_ERRORS])
+    if len(errors) > _MAX_REPORTED_ERRORS:
+        message += f" (+{len(errors) - _MAX_REPORTED_ERRORS} more)"
+    return message
+
+
+class ValidationCache:
+    """Validation results by SHA-256 of the document, for one version of the rules."""
+
+    def __init__(self, path: str = VALIDATION_CACHE_DB, max_entries: int = VALIDATION_CACHE_MAX):
+        self.path = path
+        self.max_entries = max_entries
+        # Results of another mode, or of other rules, are never reused
+        self.rules = f"{CII_VALIDATION}:{VALIDATION_FULL_MAX_BYTES}:facturx-{FACTURX_VERSION if facturx else '-'}"
+        # Trimming walks the max_entries newest rows: done once every 1% of them
+        # inserted, so the table can exceed max_entries by as much in between
+        self._trim_every = max(max_entries // 100, 1)
+        self._inserts = 0
+        self._lock = threading.Lock()
+        if max_entries > 0:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with db.transaction(self.path) as conn:
+                conn.executescript(VALIDATION_SCHEMA)
+                self._trim(conn)
+
+    def get(self, digest: str) -> Tuple[bool, Optional[str]]:
+        """Returns (found, error)."""
+        if self.max_entries <= 0:
+            return False, None
+        with db.transaction(self.path) as conn:
+            row = conn.execute(
+                "SELECT error FROM validation_results WHERE digest = ? AND rules = ?", (digest, self.rules)
+            ).fetchone()
+        return (True, row["error"]) if row else (False, None)
+
+    def put(self, digest: str, error: Optional[str]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._inserts += 1
+            trim = self._inserts % self._trim_every == 0
+        with db.transaction(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO validation_results (digest, rules, error, created_at) VALUES (?, ?, ?, ?)",
+                (digest, self.rules, error, time.time()),
+            )
+            if trim:
+                self._trim(conn)
+
+    def _trim(self, conn):
+        """Evict the oldest results beyond max_entries."""
+        conn.execute(
+            "DELETE FROM validation_results WHERE rowid IN"
+            " (SELECT rowid FROM validation_results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+
+_cache: Optional[ValidationCache] = None
+
+
+def get_validation_cache() -> ValidationCache:
+    global _cache
+    if _cache is None:
+        _cache = ValidationCache()
+    return _cache
+
+
+def cached_result(source: Source) -> Tuple[bool, Optional[str]]:
+    """Returns (found, error): the cached result of a document, found False if it was never validated."""
+    if CII_VALIDATION == "structure":
+        return True, None
+    return get_validation_cache().get(_digest(source))
+
+
+def validate_en16931(source: Source) -> Optional[str]:
+    """
+    Validate a CII invoice as configured by CII_VALIDATION, unless it was already validated.
+
+    Args:
+        source: The XML content, or the path of the XML file
+
+    Returns:
+        The error message, None if the invoice is valid
+    """
+    if CII_VALIDATION == "structure":
+        return None
+    digest = _digest(source)
+    cache = get_validation_cache()
+    found, error = cache.get(digest)
+    if not found:
+        error = _validate(source)
+        cache.put(digest, error)
+    return error
+
+
+async def check_stored_invoice(invoice_number: str):
+    """
+    Raises:
+        InvalidInvoiceError: If the stored XML of the invoice is not valid EN16931
+    """
+    if CII_VALIDATION == "structure":
+        return
+    document = await asyncio.to_thread(get_storage().get_document, invoice_number, "xml")
+    if document is None:
+        return
+    source = document.path or document.content
+    # Looked up here first: a cached result does not need a render worker
+    found, error = await asyncio.to_thread(cached_result, source)
+    if not found:
+        error = await render_pool.run(validate_en16931, source)
+    if error:
+        raise InvalidInvoiceError(error)
+
+
+def warm_up():
+    """Compile the rules of the EN16931 profile, the one generated and most received."""
+    if CII_VALIDATION == "structure" or facturx is None:
+        return
+    _schema("en16931")
+    if CII_VALIDATION == "full" and PySaxonProcessor is not None:
+        with _saxon_lock:
+            _stylesheet("en16931")
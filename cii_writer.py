@@ -0,0 +1,166 @@
+"""
+Streaming writer of the Factur-X CII XML.
+
+The document is written element by element with lxml's incremental writer
+(etree.xmlfile): no tree and no intermediate string are built, whatever the
+number of line items, and every value is escaped by lxml.
+"""
+import re
+from io import BytesIO
+from typing import BinaryIO, Optional
+
+from lxml import etree
+
+from models import InvoiceRequest, LineItem, Party
+
+RSM_NS = "urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100"
+RAM_NS = "urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100"
+QDT_NS = "urn:un:unece:uncefact:data:standard:QualifiedDataType:100"
+UDT_NS = "urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+NSMAP = {"rsm": RSM_NS, "ram": RAM_NS, "qdt": QDT_NS, "udt": UDT_NS, "xsi": XSI_NS}
+
+GUIDELINE_ID = "urn:cen.eu:en16931:2017"
+
+# Characters XML 1.0 cannot represent, even escaped
+_INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def _rsm(tag: str) -> str:
+    return f"{{{RSM_NS}}}{tag}"
+
+
+def _ram(tag: str) -> str:
+    return f"{{{RAM_NS}}}{tag}"
+
+
+def _text(value) -> str:
+    return _INVALID_XML_CHARS.sub("", str(value))
+
+
+def _amount(value: float) -> str:
+    return "%.2f" % value
+
+
+def _vat_category(rate: float) -> str:
+    """VAT category code of a rate: "Z" (zero rated) for 0 %, "S" (standard rated) otherwise."""
+    return "Z" if rate == 0 else "S"
+
+
+def _leaf(xf, tag: str, value, attrib: Optional[dict] = None):
+    with xf.element(tag, attrib):
+        xf.write(_text(value))
+
+
+def _write_party(xf, tag: str, party: Party):
+    with xf.element(_ram(tag)):
+        _leaf(xf, _ram("Name"), party.name)
+        with xf.element(_ram("PostalTradeAddress")):
+            _leaf(xf, _ram("PostcodeCode"), party.address.zip_code)
+            _leaf(xf, _ram("LineOne"), party.address.street)
+            _leaf(xf, _ram("CityName"), party.address.city)
+            _leaf(xf, _ram("CountryID"), party.address.country_code)
+        if party.vat_id:
+            with xf.element(_ram("SpecifiedTaxRegistration")):
+                _leaf(xf, _ram("ID"), party.vat_id, {"schemeID": "VA"})
+
+
+# Tags of the line items, resolved once: they are written for each of them
+_LINE_ITEM_TAGS = {
+    tag: _ram(tag)
+    for tag in (
+        "IncludedSupplyChainTradeLineItem", "AssociatedDocumentLineDocument", "LineID", "SpecifiedTradeProduct",
+        "Name", "SpecifiedLineTradeAgreement", "NetPriceProductTradePrice", "ChargeAmount",
+        "SpecifiedLineTradeDelivery", "BilledQuantity", "SpecifiedLineTradeSettlement", "ApplicableTradeTax",
+        "TypeCode", "CategoryCode", "RateApplicablePercent", "SpecifiedTradeSettlementLineMonetarySummation",
+        "LineTotalAmount",
+    )
+}
+_UNIT_CODE = {"unitCode": "H87"}
+
+
+def _write_line_item(xf, index: int, item: LineItem):
+    t = _LINE_ITEM_TAGS
+    with xf.element(t["IncludedSupplyChainTradeLineItem"]):
+        with xf.element(t["AssociatedDocumentLineDocument"]):
+            _leaf(xf, t["LineID"], index)
+        with xf.element(t["SpecifiedTradeProduct"]):
+            _leaf(xf, t["Name"], item.description)
+        with xf.element(t["SpecifiedLineTradeAgreement"]):
+            with xf.element(t["NetPriceProductTradePrice"]):
+                _leaf(xf, t["ChargeAmount"], _amount(item.unit_price))
+        with xf.element(t["SpecifiedLineTradeDelivery"]):
+            _leaf(xf, t["BilledQuantity"], _amount(item.quantity), _UNIT_CODE)
+        with xf.element(t["SpecifiedLineTradeSettlement"]):
+            with xf.element(t["ApplicableTradeTax"]):
+                _leaf(xf, t["TypeCode"], "VAT")
+                _leaf(xf, t["CategoryCode"], _vat_category(item.vat_rate))
+                _leaf(xf, t["RateApplicablePercent"], _amount(item.vat_rate))
+            with xf.element(t["SpecifiedTradeSettlementLineMonetarySummation"]):
+                _leaf(xf, t["LineTotalAmount"], _amount(item.quantity * item.unit_price))
+
+
+def write_cii_xml(invoice: InvoiceRequest, totals: tuple, output: BinaryIO):
+    """
+    Write the CII XML of an invoice to a binary file object, as UTF-8.
+
+    Args:
+        invoice: The invoice
+        totals: (total_tax_basis, total_vat, total_with_tax, vat_amounts) from compute_totals
+        output: Binary file object the XML is written to, incrementally
+    """
+    total_tax_basis, total_vat, total_with_tax, vat_amounts = totals
+    # EN16931 only allows the currency on the VAT total (BT-110)
+    currency = {"currencyID": _text(invoice.currency)}
+
+    with etree.xmlfile(output, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(_rsm("CrossIndustryInvoice"), nsmap=NSMAP):
+            with xf.element(_rsm("ExchangedDocumentContext")):
+                with xf.element(_ram("GuidelineSpecifiedDocumentContextParameter")):
+                    _leaf(xf, _ram("ID"), GUIDELINE_ID)
+
+            with xf.element(_rsm("ExchangedDocument")):
+                _leaf(xf, _ram("ID"), invoice.invoice_number)
+                _leaf(xf, _ram("TypeCode"), "380")
+                with xf.element(_ram("IssueDateTime")):
+                    _leaf(xf, f"{{{UDT_NS}}}DateTimeString", invoice.date.strftime("%Y%m%d"), {"format": "102"})
+
+            with xf.element(_rsm("SupplyChainTradeTransaction")):
+                for index, item in enumerate(invoice.items, start=1):
+                    _write_line_item(xf, index, item)
+                    # Hands the line item to the output before building the next one
+                    xf.flush()
+
+                with xf.element(_ram("ApplicableHeaderTradeAgreement")):
+                    _write_party(xf, "SellerTradeParty", invoice.seller)
+                    _write_party(xf, "BuyerTradeParty", invoice.buyer)
+                with xf.element(_ram("ApplicableHeaderTradeDelivery")):
+                    pass
+                with xf.element(_ram("ApplicableHeaderTradeSettlement")):
+                    _leaf(xf, _ram("InvoiceCurrencyCode"), invoice.currency)
+                    basis_by_rate = {}
+                    for item in invoice.items:
+                        basis_by_rate[item.vat_rate] = basis_by_rate.get(item.vat_rate, 0) + item.quantity * item.unit_price
+                    for rate, amount in vat_amounts.items():
+                        with xf.element(_ram("ApplicableTradeTax")):
+                            _leaf(xf, _ram("CalculatedAmount"), _amount(amount))
+                            _leaf(xf, _ram("TypeCode"), "VAT")
+                            _leaf(xf, _ram("BasisAmount"), _amount(basis_by_rate[rate]))
+                            _leaf(xf, _ram("CategoryCode"), _vat_category(rate))
+                            _leaf(xf, _ram("RateApplicablePercent"), _amount(rate))
+                    with xf.element(_ram("SpecifiedTradeSettlementHeaderMonetarySummation")):
+                        # Assuming no global discount
+                        _leaf(xf, _ram("LineTotalAmount"), _amount(total_tax_basis))
+                        _leaf(xf, _ram("TaxBasisTotalAmount"), _amount(total_tax_basis))
+                        _leaf(xf, _ram("TaxTotalAmount"), _amount(total_vat), currency)
+                        _leaf(xf, _ram("GrandTotalAmount"), _amount(total_with_tax))
+                        _leaf(xf, _ram("DuePayableAmount"), _amount(total_with_tax))
+
+
+def cii_xml_bytes(invoice: InvoiceRequest, totals: tuple) -> bytes:
+    """The CII XML of an invoice, as UTF-8 bytes (see write_cii_xml)."""
+    buffer = BytesIO()
+    write_cii_xml(invoice, totals, buffer)
+    return buffer.getvalue()
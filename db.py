@@ -0,0 +1,38 @@
+"""
+Helpers for the embedded SQLite databases used by the service.
+"""
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Open a SQLite connection tuned for a small multi-reader / single-writer workload.
+
+    Args:
+        path: Path of the database file (created if missing)
+
+    Returns:
+        A connection returning sqlite3.Row rows
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers (GET /invoices) run while a writer commits
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def transaction(path: str) -> Iterator[sqlite3.Connection]:
+    """
+    Open a connection, run the block in a single transaction and close it.
+    The transaction is rolled back if the block raises.
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
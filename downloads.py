@@ -0,0 +1,74 @@
+"""
+Responses serving stored invoice files: straight from disk with Range support,
+with ETag / Last-Modified validators, and 304 for conditional requests.
+"""
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+from storage import StoredDocument
+
+
+def _opaque_tag(tag: str) -> str:
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(request: Request, document: StoredDocument) -> bool:
+    """
+    Whether the client's copy is still current (RFC 9110 section 13.2.2):
+    If-None-Match when given, If-Modified-Since otherwise.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(",")}
+        return _opaque_tag(document.etag) in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and document.last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a one second resolution
+        return int(document.last_modified) <= since
+    return False
+
+
+def document_response(
+    request: Request,
+    document: StoredDocument,
+    media_type: str,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """
+    Serve a stored document.
+
+    A file on disk is streamed by FileResponse (sendfile when the server
+    supports it) without being loaded in memory, and honours Range / If-Range.
+    A document cached in memory is sent from memory, except for byte ranges.
+
+    Args:
+        request: The incoming request, for its conditional headers
+        document: The document returned by InvoiceStorage.get_document
+        media_type: Content type of the document
+        headers: Additional response headers
+
+    Returns:
+        A 304 response when the client's copy is current, the document otherwise
+    """
+    headers = dict(headers or {})
+    headers["ETag"] = document.etag
+    if document.last_modified is not None:
+        headers["Last-Modified"] = formatdate(document.last_modified, usegmt=True)
+
+    if is_not_modified(request, document):
+        return Response(status_code=304, headers=headers)
+    if document.path is not None and (document.content is None or "range" in request.headers):
+        return FileResponse(document.path, media_type=media_type, headers=headers, stat_result=document.stat)
+    return Response(content=document.content, media_type=media_type, headers=headers)
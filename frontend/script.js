@@ -14,6 +14,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // Buttons
     const newInvoiceBtn = document.getElementById('newInvoiceBtn');
     const refreshBtn = document.getElementById('refreshBtn');
+    const loadMoreBtn = document.getElementById('loadMoreBtn');
     const backToListBtn = document.getElementById('backToListBtn');
     const downloadPdfBtn = document.getElementById('downloadPdfBtn');
     const downloadXmlBtn = document.getElementById('downloadXmlBtn');
@@ -36,6 +37,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // State
     let currentInvoiceId = null;
     let invoicesData = [];
+    let nextCursor = null;
     let selectedFile = null;
     let currentMode = 'create';
 
@@ -48,6 +50,7 @@ document.addEventListener('DOMContentLoaded', () => {
     addItemBtn.addEventListener('click', addItem);
     newInvoiceBtn.addEventListener('click', showFormView);
     refreshBtn.addEventListener('click', fetchInvoices);
+    loadMoreBtn.addEventListener('click', fetchMoreInvoices);
     backToListBtn.addEventListener('click', showFormView);
     downloadPdfBtn.addEventListener('click', () => downloadInvoice(currentInvoiceId, 'pdf'));
     downloadXmlBtn.addEventListener('click', () => downloadInvoice(currentInvoiceId, 'xml'));
@@ -426,6 +429,21 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/invoices');
             if (response.ok) {
                 invoicesData = await response.json();
+                nextCursor = response.headers.get('X-Next-Cursor');
+                renderInvoiceList(invoicesData);
+            }
+        } catch (e) {
+            console.error("Failed to fetch invoices", e);
+        }
+    }
+
+    async function fetchMoreInvoices() {
+        if (!nextCursor) return;
+        try {
+            const response = await fetch(`/invoices?cursor=${encodeURIComponent(nextCursor)}`);
+            if (response.ok) {
+                invoicesData = invoicesData.concat(await response.json());
+                nextCursor = response.headers.get('X-Next-Cursor');
                 renderInvoiceList(invoicesData);
             }
         } catch (e) {
@@ -478,7 +496,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errData.detail || "Erreur lors de l'envoi");
             }
 
-            showMessage("Facture envoyee avec succes !", "success");
+            showMessage("Facture mise en file d'envoi, elle sera envoyee en arriere-plan.", "success");
         } catch (e) {
             showMessage("Erreur d'envoi: " + e.message, 'error');
         } finally {
@@ -530,6 +548,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // ===== Rendering =====
     function renderInvoiceList(invoices) {
         invoiceList.innerHTML = '';
+        loadMoreBtn.classList.toggle('hidden', !nextCursor);
 
         if (!invoices || invoices.length === 0) {
             noInvoicesMsg.classList.remove('hidden');
@@ -538,9 +557,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         noInvoicesMsg.classList.add('hidden');
 
-        // Sort by date descending
-        invoices.sort((a, b) => new Date(b.created_at || b.date) - new Date(a.created_at || a.date));
-
+        // Pages already come sorted by date descending from the API
         invoices.forEach(inv => {
             const item = document.createElement('div');
             item.className = 'invoice-list-item';
@@ -1,22 +1,23 @@
-from jinja2 import Environment, FileSystemLoader
-from weasyprint import HTML
 from facturx import generate_from_file
 from models import InvoiceRequest
+from cii_validation import InvalidInvoiceError, validate_en16931
+from cii_writer import cii_xml_bytes
+from render_context import get_render_context
 import os
+import hashlib
+import json
 import tempfile
-from datetime import datetime
+from io import BytesIO
 
-# Setup Jinja2 environment
-templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
-env = Environment(loader=FileSystemLoader(templates_dir))
+# "memory" embeds the Factur-X XML without touching the disk, "tempfile" keeps the
+# historical temporary-file path as a fallback
+FACTURX_EMBED_MODE = os.environ.get("FACTURX_EMBED_MODE", "memory")
 
-from typing import Tuple
+from typing import Optional, Tuple
 
-def generate_invoice_pdf(invoice: InvoiceRequest) -> Tuple[bytes, str]:
-    # 1. Render HTML
-    template = env.get_template('invoice.html')
-    
-    # Calculate totals
+
+def compute_totals(invoice: InvoiceRequest) -> Tuple[float, float, float, dict]:
+    """Returns (total_tax_basis, total_vat, total_with_tax, vat_amounts by rate)"""
     total_tax_basis = sum(item.quantity * item.unit_price for item in invoice.items)
     # Group by VAT rate for simple calculation
     vat_amounts = {}
@@ -29,6 +30,42 @@ def generate_invoice_pdf(invoice: InvoiceRequest) -> Tuple[bytes, str]:
     
     total_vat = sum(vat_amounts.values())
     total_with_tax = total_tax_basis + total_vat
+    return total_tax_basis, total_vat, total_with_tax, vat_amounts
+
+
+def request_hash(invoice: InvoiceRequest) -> str:
+    """
+    SHA-256 of the canonical form of an invoice request: defaults filled in,
+    numbers normalised by the model, keys sorted, no whitespace. Two requests
+    rendering the same invoice hash the same.
+    """
+    canonical = json.dumps(invoice.model_dump(mode="json"), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def build_invoice_metadata(invoice: InvoiceRequest) -> dict:
+    """Metadata stored (and listed) alongside a generated invoice"""
+    total_ht = sum(item.quantity * item.unit_price for item in invoice.items)
+    # Approximate tax calculation for metadata display (simplified)
+    total_ttc = sum(item.quantity * item.unit_price * (1 + item.vat_rate/100) for item in invoice.items)
+
+    return {
+        "id": invoice.invoice_number,
+        "date": str(invoice.date),
+        "seller_name": invoice.seller.name,
+        "buyer_name": invoice.buyer.name,
+        "total_ht": round(total_ht, 2),
+        "total_ttc": round(total_ttc, 2),
+        "currency": invoice.currency,
+        "created_at": str(invoice.date),
+        # Lets a retry of the same request reuse this render (see render_cache)
+        "request_hash": request_hash(invoice),
+    }
+
+
+def render_invoice_html(invoice: InvoiceRequest, totals: Optional[tuple] = None) -> str:
+    template = get_render_context().template('invoice.html')
+    total_tax_basis, total_vat, total_with_tax, vat_amounts = totals or compute_totals(invoice)
 
     context = {
         "invoice": invoice,
@@ -38,60 +75,100 @@ def generate_invoice_pdf(invoice: InvoiceRequest) -> Tuple[bytes, str]:
         "vat_amounts": vat_amounts
     }
     
-    html_content = template.render(**context)
-    
-    # 2. Generate PDF
-    # We write to a temporary file because factur-x usually expects file paths or reading bytes
-    pdf_bytes = HTML(string=html_content).write_pdf()
+    return template.render(**context)
+
+
+def generate_invoice_pdf(invoice: InvoiceRequest) -> Tuple[bytes, bytes]:
+    """
+    Render the Factur-X PDF of an invoice.
+
+    Returns:
+        (pdf_bytes, xml_bytes)
+
+    Raises:
+        InvalidInvoiceError: If its CII XML is not valid EN16931 (see CII_VALIDATION):
+                             it could not be sent, so it is not rendered
+    """
+    # 1. Factur-X XML, written as UTF-8 bytes and embedded without a str copy;
+    # checked first, as POST /invoices/{id}/send will check it
+    totals = compute_totals(invoice)
+    xml_content = cii_xml_bytes(invoice, totals)
+    error = validate_en16931(xml_content)
+    if error:
+        raise InvalidInvoiceError(error)
+
+    # 2. Render HTML
+    html_content = render_invoice_html(invoice, totals)
     
-    # 3. Add Factur-X XML
-    xml_content = generate_facturx_xml(invoice, total_tax_basis, total_vat, total_with_tax, vat_amounts)
+    # 3. Generate PDF (stylesheet and fonts reused from the worker's render context)
+    pdf_bytes = get_render_context().write_pdf(html_content, 'invoice.css')
     
     try:
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f_pdf:
-            f_pdf.write(pdf_bytes)
-            f_pdf_path = f_pdf.name
-            
-        with tempfile.NamedTemporaryFile(suffix=".xml", delete=False, mode='w', encoding='utf-8') as f_xml:
-            f_xml.write(xml_content)
-            f_xml_path = f_xml.name
-            
-        output_path = f_pdf_path + "_fx.pdf"
-        generate_from_file(f_pdf_path, f_xml_path, output_pdf_file=output_path)
-        
-        with open(output_path, "rb") as f_out:
-            final_pdf = f_out.read()
-            
-        # Cleanup
-        os.remove(f_pdf_path)
-        os.remove(f_xml_path)
-        os.remove(output_path)
-        
+        final_pdf = embed_facturx_xml(pdf_bytes, xml_content)
         return final_pdf, xml_content
         
     except Exception as e:
         print(f"Error generating Factur-X: {e}")
         # Fallback to just PDF if XML fails (or re-raise)
         return pdf_bytes, xml_content
-        
-    except Exception as e:
-        print(f"Error generating Factur-X: {e}")
-        # Fallback to just PDF if XML fails (or re-raise)
-        return pdf_bytes, xml_content
 
-def generate_facturx_xml(invoice: InvoiceRequest, total_tax_basis, total_vat, total_with_tax, vat_amounts):
-    # This is a VERY simplified XML generator for Factur-X Minimal/Basic profile
-    # In a real app, use a proper templating engine or XML builder for CII
-    
-    # We will use Jinja2 for XML as well for simplicity
-    template = env.get_template('factur-x.xml')
-    
-    context = {
-        "invoice": invoice,
-        "total_tax_basis": total_tax_basis,
-        "total_vat": total_vat,
-        "total_with_tax": total_with_tax,
-        "vat_amounts": vat_amounts,
-        "now": datetime.now()
-    }
-    return template.render(**context)
+
+class _InPlacePdfBuffer(BytesIO):
+    """
+    In-memory PDF handed to facturx.generate_from_file as its input file.
+    facturx reads the PDF from it, then writes the Factur-X PDF back into it:
+    the first write restarts the buffer so the output replaces the input
+    instead of being written over it at the current read position.
+    """
+    _writing = False
+
+    def write(self, data):
+        if not self._writing:
+            self._writing = True
+            self.seek(0)
+            self.truncate()
+        return super().write(data)
+
+
+def embed_facturx_xml(pdf_bytes: bytes, xml_bytes: bytes, mode: Optional[str] = None) -> bytes:
+    """
+    Embed the Factur-X XML into the PDF.
+
+    Args:
+        pdf_bytes: The rendered PDF
+        xml_bytes: The CII XML
+        mode: "memory" (default, from FACTURX_EMBED_MODE) works on buffers only,
+              "tempfile" goes through temporary files on disk
+
+    Returns:
+        The Factur-X PDF bytes
+    """
+    mode = mode or FACTURX_EMBED_MODE
+    if mode == "tempfile":
+        return _embed_facturx_xml_tempfile(pdf_bytes, xml_bytes)
+
+    buffer = _InPlacePdfBuffer(pdf_bytes)
+    generate_from_file(buffer, xml_bytes)
+    return buffer.getvalue()
+
+
+def _embed_facturx_xml_tempfile(pdf_bytes: bytes, xml_bytes: bytes) -> bytes:
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f_pdf:
+        f_pdf.write(pdf_bytes)
+        f_pdf_path = f_pdf.name
+
+    with tempfile.NamedTemporaryFile(suffix=".xml", delete=False) as f_xml:
+        f_xml.write(xml_bytes)
+        f_xml_path = f_xml.name
+
+    output_path = f_pdf_path + "_fx.pdf"
+    try:
+        generate_from_file(f_pdf_path, f_xml_path, output_pdf_file=output_path)
+
+        with open(output_path, "rb") as f_out:
+            return f_out.read()
+    finally:
+        # Cleanup
+        for path in (f_pdf_path, f_xml_path, output_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,18 +1,40 @@
+"""
+Announcement of the invoices to the remote system.
+
+AsyncInvoiceSender, used by the routes and the outbox, delivers the message
+through the transport selected by SEND_TRANSPORT (see send_transport). The
+synchronous InvoiceSender (send_invoice_task) is HTTP only: it always posts to
+the remote API, whatever SEND_TRANSPORT, the broker transports running in the
+event loop.
+"""
 import os
 import json
 import logging
-from datetime import date
+from datetime import date, datetime
 from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-from api.secure_client import SecureAPIClient
+from api.secure_client import AsyncSecureAPIClient, SecureAPIClient
+from cii_validation import check_stored_invoice
 from models_remote import FluxExportDocument, DocumentMessageDTO, RabbitInjectionMessage, RabbitInfoMessage
+from send_transport import get_transport
 
 logger = logging.getLogger(__name__)
 
+def invoice_date_from_metadata(metadata: dict) -> date:
+    """
+    Date of an invoice from its stored metadata (str(date) -> YYYY-MM-DD).
+    Falls back to the current date if missing or malformed.
+    """
+    try:
+        return datetime.strptime(metadata['date'], "%Y-%m-%d").date()
+    except (KeyError, TypeError, ValueError):
+        return datetime.now().date()
+
+
 class InvoiceSender:
     def __init__(self):
         self.remote_api_url = os.environ.get("REMOTE_API_URL", "https://maintenance.example.com") # User should set this
@@ -21,11 +43,15 @@ class InvoiceSender:
         
         # Initialize Secure Client
         # Note: AuthToken inside SecureAPIClient will look for KEYCLOAK_* env vars
-        self.client = SecureAPIClient(base_url=self.remote_api_url)
+        self.client = self._create_client()
 
-    def send_invoice(self, invoice_number: str, invoice_date: date, pdf_filename: str):
+    def _create_client(self):
+        return SecureAPIClient(base_url=self.remote_api_url)
+
+    def build_payload(self, invoice_number: str, invoice_date: date, pdf_filename: str) -> str:
         """
-        Send invoice metadata to the remote RabbitMQ via API.
+        Build the FluxExportDocument announcing an invoice, serialized to JSON:
+        the body of the message consumed from RabbitMQ.
         """
         # 1. Construct the inner DTO (FluxExportDocument)
         # URL to get the PDF. The remote service calls GET {urlV2} to retrieve the file.
@@ -52,7 +78,13 @@ class InvoiceSender:
         )
 
         # 2. Serialize FluxExportDocument to JSON string
-        payload_str = flux_export.model_dump_json()
+        return flux_export.model_dump_json()
+
+    def build_message(self, invoice_number: str, invoice_date: date, pdf_filename: str) -> dict:
+        """
+        Build the RabbitInjectionMessage announcing an invoice to the remote system.
+        """
+        payload_str = self.build_payload(invoice_number, invoice_date, pdf_filename)
 
         # 3. Construct the outer Wrapper (RabbitInjectionMessage)
         rabbit_message = RabbitInjectionMessage(
@@ -62,12 +94,21 @@ class InvoiceSender:
             )
         )
 
+        return rabbit_message.model_dump()
+
+    def send_invoice(self, invoice_number: str, invoice_date: date, pdf_filename: str):
+        """
+        Send invoice metadata to the remote RabbitMQ via API.
+        Always over HTTP: SEND_TRANSPORT only applies to AsyncInvoiceSender.
+        """
+        message = self.build_message(invoice_number, invoice_date, pdf_filename)
+
         # 4. Send to API
         logger.info(f"Sending invoice {invoice_number} to remote API...")
         try:
             response = self.client.post(
                 endpoint="/api/messages?type=nouveau",
-                json_data=rabbit_message.model_dump()
+                json_data=message
             )
             response.raise_for_status()
             logger.info("Invoice sent successfully.")
@@ -76,11 +117,66 @@ class InvoiceSender:
             logger.error(f"Failed to send invoice: {e}")
             raise e
 
+class AsyncInvoiceSender(InvoiceSender):
+    """
+    InvoiceSender for the async routes: the message is sent with httpx and
+    never blocks the event loop.
+    """
+
+    def _create_client(self):
+        return AsyncSecureAPIClient(base_url=self.remote_api_url)
+
+    async def send_invoice(self, invoice_number: str, invoice_date: date, pdf_filename: str):
+        """
+        Send invoice metadata to the remote RabbitMQ, via the API or straight
+        to the broker depending on SEND_TRANSPORT.
+        """
+        transport = get_transport()
+        if transport is not None:
+            return await self._publish(transport, invoice_number, invoice_date, pdf_filename)
+
+        message = self.build_message(invoice_number, invoice_date, pdf_filename)
+
+        logger.info(f"Sending invoice {invoice_number} to remote API...")
+        try:
+            response = await self.client.post(
+                endpoint="/api/messages?type=nouveau",
+                json_data=message
+            )
+            response.raise_for_status()
+            logger.info("Invoice sent successfully.")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to send invoice: {e}")
+            raise e
+
+    async def _publish(self, transport, invoice_number: str, invoice_date: date, pdf_filename: str):
+        # Same payload as through the API, without the HTTP hop and the wrapper
+        payload = self.build_payload(invoice_number, invoice_date, pdf_filename)
+
+        logger.info(f"Publishing invoice {invoice_number} to the broker...")
+        try:
+            await transport.publish(self.routing_key, payload.encode("utf-8"), invoice_number)
+            logger.info("Invoice published and confirmed.")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to publish invoice: {e}")
+            raise e
+
 # Helper instantiation
 sender_service = InvoiceSender()
+async_sender_service = AsyncInvoiceSender()
 
 def send_invoice_task(invoice_number: str, invoice_date: date, pdf_filename: str):
     """
     Wrapper function to be called from API or background task.
     """
     return sender_service.send_invoice(invoice_number, invoice_date, pdf_filename)
+
+async def send_invoice_async(invoice_number: str, invoice_date: date, pdf_filename: str):
+    """
+    Async counterpart of send_invoice_task, for the FastAPI routes.
+    Invoices whose XML is not valid EN16931 are not sent (InvalidInvoiceError).
+    """
+    await check_stored_invoice(invoice_number)
+    return await async_sender_service.send_invoice(invoice_number, invoice_date, pdf_filename)
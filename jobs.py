@@ -0,0 +1,262 @@
+"""
+Asynchronous invoice generation jobs.
+
+POST /invoices with "Prefer: respond-async" stores the request in a local
+SQLite queue and answers 202 with a job id. Worker tasks render and store
+the queued invoices in the background; GET /jobs/{id} reports the progress
+and redirects to the PDF once it is ready.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import db
+import render_pool
+from cii_validation import InvalidInvoiceError
+from invoice_generator import build_invoice_metadata, generate_invoice_pdf
+from models import InvoiceRequest
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join("invoices", "jobs.sqlite3"))
+# Jobs rendered at once; more than RENDER_WORKERS only queues in the render pool
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Jobs waiting at most: beyond, new jobs are refused with 503
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "1000"))
+# The workers check for queued jobs at least this often (seconds)
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+# A running job whose worker died is queued again after this delay (seconds)
+JOB_LEASE = float(os.environ.get("JOB_LEASE", "300"))
+# Finished jobs (done or failed) are deleted this long after they ended (seconds)
+JOB_TTL = float(os.environ.get("JOB_TTL", "86400"))
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    invoice_number TEXT NOT NULL,
+    status TEXT NOT NULL,
+    request TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL,
+    render_ms REAL,
+    store_ms REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at);
+"""
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFullError(Exception):
+    """JOB_QUEUE_MAX jobs are already waiting."""
+
+
+class JobQueue:
+    """The SQLite job queue: submit, claim, complete and report jobs."""
+
+    def __init__(self, path: str = JOBS_DB, max_queued: int = JOB_QUEUE_MAX, ttl: float = JOB_TTL):
+        self.path = path
+        self.max_queued = max_queued
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with db.transaction(self.path) as conn:
+            conn.executescript(JOBS_SCHEMA)
+
+    def submit(self, invoice_data: InvoiceRequest) -> Dict:
+        """
+        Queue the generation of an invoice.
+
+        Returns:
+            The status of the new job (see get_status)
+
+        Raises:
+            QueueFullError: If max_queued jobs are already waiting
+        """
+        job_id = uuid.uuid4().hex
+        with db.transaction(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"{queued} jobs already queued")
+            conn.execute(
+                "INSERT INTO jobs (id, invoice_number, status, request, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, invoice_data.invoice_number, QUEUED, invoice_data.model_dump_json(), time.time()),
+            )
+        return self.get_status(job_id)
+
+    def claim(self) -> Optional[Dict]:
+        """
+        Claim the oldest queued job, or a running job whose worker died
+        (its lease expired). Returns None when there is nothing to do.
+        Jobs finished more than ttl seconds ago are deleted on the way.
+        """
+        now = time.time()
+        with db.transaction(self.path) as conn:
+            # Immediate: two workers never claim the same job
+            conn.execute("BEGIN IMMEDIATE")
+            # Only finished jobs have a finished_at
+            conn.execute("DELETE FROM jobs WHERE finished_at <= ?", (now - self.ttl,))
+            row = conn.execute(
+                "SELECT id, request FROM jobs WHERE status = ? OR (status = ? AND lease_until <= ?)"
+                " ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, lease_until = ? WHERE id = ?",
+                (RUNNING, now, now + JOB_LEASE, row["id"]),
+            )
+        return dict(row)
+
+    def complete(self, job_id: str, error: Optional[str] = None, render_ms: float = None, store_ms: float = None):
+        """Record the end of a job. The request is dropped, keeping the queue small."""
+        with db.transaction(self.path) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, render_ms = ?, store_ms = ?,"
+                " request = NULL, lease_until = NULL WHERE id = ?",
+                (FAILED if error else DONE, error, time.time(), render_ms, store_ms, job_id),
+            )
+
+    def get_status(self, job_id: str) -> Optional[Dict]:
+        """
+        Returns the status of a job, None if unknown:
+        {"id", "invoice_number", "status", "error", "created_at", "started_at",
+         "finished_at", "wait_ms", "render_ms", "store_ms"}
+        """
+        with db.transaction(self.path) as conn:
+            row = conn.execute(
+                "SELECT id, invoice_number, status, error, created_at, started_at, finished_at, render_ms, store_ms"
+                " FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        status = dict(row)
+        # Time spent waiting in the queue
+        status["wait_ms"] = (
+            round((status["started_at"] - status["created_at"]) * 1000, 1) if status["started_at"] else None
+        )
+        return status
+
+    def stats(self) -> Dict[str, int]:
+        """Number of jobs per status"""
+        with db.transaction(self.path) as conn:
+            counts = {row["status"]: row["n"] for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"
+            )}
+        return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)}
+
+
+class JobWorkers:
+    """Background tasks rendering the queued jobs."""
+
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS):
+        self.queue = queue
+        self.workers = max(workers, 1)
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; an interrupted job is queued again when its lease expires."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Wake a worker up: a job was just queued. Safe to call from any thread."""
+        if self._wakeup is not None:
+            # submit_job runs in a worker thread: asyncio.Event is only set from its loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim)
+                if job is not None:
+                    await self._process(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+
+            # Nothing queued: sleep until a job is submitted or the next poll
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, job: Dict):
+        render_ms = store_ms = None
+        try:
+            invoice_data = InvoiceRequest.model_validate_json(job["request"])
+            start = time.perf_counter()
+            pdf_bytes, xml_content = await render_pool.run(generate_invoice_pdf, invoice_data)
+            render_ms = round((time.perf_counter() - start) * 1000, 1)
+
+            start = time.perf_counter()
+            metadata = build_invoice_metadata(invoice_data)
+            await asyncio.to_thread(
+                get_storage().save_invoice, invoice_data.invoice_number, pdf_bytes, xml_content, metadata
+            )
+            store_ms = round((time.perf_counter() - start) * 1000, 1)
+        except InvalidInvoiceError as e:
+            await asyncio.to_thread(
+                self.queue.complete, job["id"], f"Invoice XML is not valid EN16931: {e}", render_ms, store_ms
+            )
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+            await asyncio.to_thread(self.queue.complete, job["id"], str(e) or type(e).__name__, render_ms, store_ms)
+        else:
+            await asyncio.to_thread(self.queue.complete, job["id"], None, render_ms, store_ms)
+
+
+_queue: Optional[JobQueue] = None
+_workers: Optional[JobWorkers] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+def start_workers():
+    """Start the job workers (application startup)."""
+    global _workers
+    _workers = JobWorkers(get_job_queue())
+    _workers.start()
+
+
+async def stop_workers():
+    """Stop the job workers (application shutdown)."""
+    global _workers
+    if _workers is not None:
+        await _workers.stop()
+        _workers = None
+
+
+def submit_job(invoice_data: InvoiceRequest) -> Dict:
+    """Queue an invoice generation and wake a worker up; returns the job status."""
+    status = get_job_queue().submit(invoice_data)
+    if _workers is not None:
+        _workers.notify()
+    return status
@@ -1,19 +1,56 @@
+import asyncio
 import os
-from fastapi import FastAPI, HTTPException, Response, Header, Depends, UploadFile, File
-from fastapi.responses import FileResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response, Header, Depends, UploadFile, File, Query
+from fastapi import Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from models import InvoiceRequest
-from invoice_generator import generate_invoice_pdf
-from storage import get_storage, InvoiceStorage
-from invoice_sender import send_invoice_task
-from xml_processor import extract_xml_from_pdf, validate_cii_xml, extract_metadata_from_xml, create_placeholder_pdf
-from typing import List
-from datetime import datetime
-
-app = FastAPI(title="Factur-X Invoice Generator")
+from models import InvoiceRequest, SendBatchRequest
+from invoice_generator import generate_invoice_pdf, build_invoice_metadata, request_hash
+from render_cache import IdempotencyKeyConflict, get_render_cache
+from storage import get_storage, InvoiceStorage, CachedStorage
+from invoice_sender import invoice_date_from_metadata
+from api.http_session import close_async_client
+from send_transport import close_transport, get_transport
+from downloads import document_response
+from upload_pipeline import (
+    UPLOAD_BULK_MAX_BYTES, UPLOAD_MAX_BYTES, UploadError, get_upload_type, is_archive, iter_bulk_uploads,
+    process_upload, spool_upload,
+)
+import render_pool
+import cii_validation
+import outbox
+import jobs
+import placeholders
+from batch import render_batch, send_batch, upload_batch, iter_json_list, iter_ndjson, iter_send_targets
+from typing import List, Optional
+from datetime import date
+from urllib.parse import quote, urlencode
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fails at startup on an unknown CII_VALIDATION or a missing saxonche
+    cii_validation.check_config()
+    placeholders.check_config()
+    await render_pool.start()
+    # Fails at startup on an unknown SEND_TRANSPORT or a missing aio-pika
+    get_transport()
+    outbox.start_dispatcher()
+    jobs.start_workers()
+    placeholders.start_workers()
+    yield
+    await placeholders.stop_workers()
+    await jobs.stop_workers()
+    await outbox.stop_dispatcher()
+    render_pool.shutdown()
+    await close_transport()
+    await close_async_client()
+
+
+app = FastAPI(title="Factur-X Invoice Generator", lifespan=lifespan)
 
 # Enable CORS
 from fastapi.middleware.cors import CORSMiddleware
@@ -23,6 +60,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link"],
 )
 
 # Serve Frontend
@@ -38,33 +76,104 @@ async def read_root():
         return RedirectResponse(url="/static/index.html")
     return {"message": "Factur-X Generator API"}
 
-@app.post("/invoices", responses={200: {"content": {"application/pdf": {}}}})
-async def create_invoice(invoice_data: InvoiceRequest):
-    try:
-        pdf_bytes, xml_content = generate_invoice_pdf(invoice_data)
-        
-        # Prepare metadata
-        total_ht = sum(item.quantity * item.unit_price for item in invoice_data.items)
-        # Approximate tax calculation for metadata display (simplified)
-        total_ttc = sum(item.quantity * item.unit_price * (1 + item.vat_rate/100) for item in invoice_data.items)
-
-        metadata = {
-            "id": invoice_data.invoice_number,
-            "date": str(invoice_data.date),
-            "seller_name": invoice_data.seller.name,
-            "buyer_name": invoice_data.buyer.name,
-            "total_ht": round(total_ht, 2),
-            "total_ttc": round(total_ttc, 2),
-            "currency": invoice_data.currency,
-            "created_at": str(invoice_data.date) 
-        }
+@app.post("/invoices", responses={200: {"content": {"application/pdf": {}}}, 202: {"description": "Job queued"}})
+async def create_invoice(
+    invoice_data: InvoiceRequest,
+    request: Request,
+    prefer: Optional[str] = Header(default=None),
+    idempotency_key: Optional[str] = Header(default=None),
+):
+    """
+    Generate and store an invoice, and return its PDF.
+    A request identical to the one the stored invoice was rendered from, or
+    repeating an Idempotency-Key, returns the stored PDF without rendering again.
+    With "Prefer: respond-async", the invoice is queued and generated in the
+    background: the response is 202 with the job to follow at GET /jobs/{id}.
+    """
+    if prefer and "respond-async" in prefer.lower():
+        try:
+            job = await asyncio.to_thread(jobs.submit_job, invoice_data)
+        except jobs.QueueFullError:
+            raise HTTPException(status_code=503, detail="Job queue is full", headers={"Retry-After": "30"})
+        location = f"/jobs/{job['id']}"
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job["id"], "status": job["status"], "status_url": location},
+            headers={"Location": location, "Preference-Applied": "respond-async"},
+        )
+
+    render_cache = get_render_cache()
+    digest = request_hash(invoice_data)
+    async with render_cache.exclusive(digest):
+        try:
+            document = await asyncio.to_thread(
+                render_cache.find, invoice_data.invoice_number, digest, idempotency_key
+            )
+        except IdempotencyKeyConflict:
+            raise HTTPException(status_code=422, detail="Idempotency-Key already used for a different request")
+        if document is not None:
+            return document_response(request, document, "application/pdf", headers={"Idempotent-Replayed": "true"})
+
+        try:
+            pdf_bytes, xml_content = await render_pool.run(generate_invoice_pdf, invoice_data)
+
+            metadata = build_invoice_metadata(invoice_data)
+
+            storage = get_storage()
+            await asyncio.to_thread(storage.save_invoice, invoice_data.invoice_number, pdf_bytes, xml_content, metadata)
+            await asyncio.to_thread(render_cache.record_render, invoice_data.invoice_number, digest, idempotency_key)
+
+            return Response(content=pdf_bytes, media_type="application/pdf")
+        except cii_validation.InvalidInvoiceError as e:
+            raise HTTPException(status_code=422, detail=f"Invoice XML is not valid EN16931: {e}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
-        storage = get_storage()
-        storage.save_invoice(invoice_data.invoice_number, pdf_bytes, xml_content, metadata)
-            
-        return Response(content=pdf_bytes, media_type="application/pdf")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/invoices/batch", responses={200: {"content": {"application/x-ndjson": {}}}})
+async def create_invoices_batch(request: Request):
+    """
+    Generate and store a batch of invoices.
+
+    The body is either a JSON array of invoices or an NDJSON stream
+    (Content-Type: application/x-ndjson) with one invoice per line.
+    Invoices are rendered in parallel and one NDJSON line is streamed back per
+    invoice as it completes: {"index", "id", "status": "ok"|"error", "error", "render_ms", "elapsed_ms"}.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type:
+        # The body is read before streaming the response: the response listens
+        # for client disconnects on the same channel as the request body
+        items = iter_ndjson(await request.body())
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of invoices")
+        items = iter_json_list(body)
+
+    return StreamingResponse(render_batch(items), media_type="application/x-ndjson")
+
+
+@app.post("/invoices/send-batch", responses={200: {"content": {"application/x-ndjson": {}}}})
+async def send_invoices_batch(batch_request: SendBatchRequest):
+    """
+    Queue a batch of stored invoices in the outbox, like POST /invoices/{id}/send.
+
+    The invoices are given by `invoice_numbers`, or selected by `filter`
+    (same criteria as GET /invoices). The outbox dispatcher sends them in the
+    background, with retries; one NDJSON line is streamed back per invoice as
+    it is queued: {"index", "id", "status": "ok"|"error", "error", "send_status", "elapsed_ms"}.
+    Follow each send with GET /invoices/{invoice_number}/send-status.
+    """
+    if (batch_request.invoice_numbers is None) == (batch_request.filter is None):
+        raise HTTPException(status_code=400, detail="Expected either invoice_numbers or filter")
+
+    filters = batch_request.filter.model_dump(exclude_none=True) if batch_request.filter else None
+    targets = iter_send_targets(batch_request.invoice_numbers, filters)
+    return StreamingResponse(send_batch(targets), media_type="application/x-ndjson")
 
 
 @app.post("/invoices/upload")
@@ -73,182 +182,224 @@ async def upload_invoice(file: UploadFile = File(...)):
     Upload a Factur-X PDF or CII XML invoice file.
 
     - For PDF files: Extracts the embedded Factur-X XML
-    - For XML files: Validates CII structure and creates a placeholder PDF
+    - For XML files: Validates CII structure; a placeholder PDF is rendered on
+      the first download of the PDF (or in the background, see PLACEHOLDER_PDF)
 
     Returns the extracted metadata on success.
     """
-    # Validate file extension
-    filename = file.filename or ""
-    ext = filename.lower().rsplit('.', 1)[-1] if '.' in filename else ''
-
-    if ext not in ('pdf', 'xml'):
-        raise HTTPException(
-            status_code=400,
-            detail="Type de fichier invalide. Formats acceptes: PDF (Factur-X), XML (CII/EN16931)"
-        )
-
-    # Read file content
-    content = await file.read()
-    if not content:
-        raise HTTPException(status_code=400, detail="Fichier vide")
+    try:
+        upload_type = get_upload_type(file.filename)
 
-    xml_content = None
-    pdf_bytes = None
+        # Read in chunks: large files are spooled to disk, never loaded in memory
+        upload = await spool_upload(file)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
-    if ext == 'pdf':
-        # Extract XML from PDF
-        try:
-            xml_content = extract_xml_from_pdf(content)
-            if not xml_content:
-                raise HTTPException(
-                    status_code=422,
-                    detail="Impossible d'extraire le XML Factur-X du PDF. Le fichier n'est peut-etre pas un PDF Factur-X valide."
-                )
-            pdf_bytes = content
-        except ImportError:
-            raise HTTPException(
-                status_code=500,
-                detail="La bibliotheque facturx n'est pas installee. Impossible de traiter les PDF."
-            )
-        except Exception as e:
-            raise HTTPException(status_code=422, detail=f"Erreur lors de l'extraction XML: {str(e)}")
-
-    else:  # XML file
-        # Decode XML content
+    try:
         try:
-            xml_content = content.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                xml_content = content.decode('iso-8859-1')
-            except Exception:
-                raise HTTPException(status_code=422, detail="Impossible de decoder le fichier XML")
+            # Extraction, parsing, validation and metadata extraction are CPU-bound
+            metadata, xml_content = await render_pool.run(process_upload, file.filename, upload.source)
+        except UploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
 
-        # Validate CII structure
-        is_valid, error_msg = validate_cii_xml(xml_content)
-        if not is_valid:
+        # Check for duplicate
+        storage = get_storage()
+        existing = await asyncio.to_thread(storage.get_invoice_metadata, metadata['id'])
+        if existing:
             raise HTTPException(
-                status_code=422,
-                detail=f"XML non conforme CII/EN16931: {error_msg}"
+                status_code=409,
+                detail=f"Une facture avec le numero '{metadata['id']}' existe deja"
             )
 
-    # Extract metadata from XML
-    metadata = extract_metadata_from_xml(xml_content)
-
-    # Validate that we extracted meaningful data
-    if not metadata.get('_valid', False):
-        missing_fields = []
-        if not metadata.get('id'):
-            missing_fields.append("numero de facture")
-        if not metadata.get('seller_name'):
-            missing_fields.append("nom du vendeur")
-        if not metadata.get('buyer_name'):
-            missing_fields.append("nom de l'acheteur")
-
-        raise HTTPException(
-            status_code=422,
-            detail=f"Impossible d'extraire les donnees essentielles du XML: {', '.join(missing_fields)}. Verifiez que le fichier est bien un Factur-X/CII valide."
-        )
+        # Save the invoice, copying the uploaded file from the spool. XML-only
+        # uploads are stored without a PDF until their placeholder is rendered
+        pdf_bytes = None
+        try:
+            with upload.open() as uploaded:
+                if upload_type == 'pdf':
+                    pdf_bytes = uploaded
+                elif xml_content is None:
+                    xml_content = uploaded
+                await asyncio.to_thread(storage.save_invoice, metadata['id'], pdf_bytes, xml_content, metadata)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Erreur lors de la sauvegarde: {str(e)}")
+    finally:
+        upload.close()
 
-    # Remove internal validation flag before saving
-    metadata.pop('_valid', None)
+    if upload_type == 'xml':
+        placeholders.schedule([metadata['id']])
+    return JSONResponse(content=metadata)
 
-    # Check for duplicate
-    storage = get_storage()
-    existing = storage.get_invoice_metadata(metadata['id'])
-    if existing:
-        raise HTTPException(
-            status_code=409,
-            detail=f"Une facture avec le numero '{metadata['id']}' existe deja"
-        )
 
-    # For XML-only uploads, create a placeholder PDF
-    if pdf_bytes is None:
-        try:
-            pdf_bytes = create_placeholder_pdf(xml_content, metadata)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erreur lors de la creation du PDF: {str(e)}")
+@app.post("/invoices/upload-bulk")
+async def upload_invoices_bulk(files: List[UploadFile] = File(...)):
+    """
+    Upload many Factur-X PDF and CII XML invoice files at once, as ZIP archives
+    and/or as separate files.
 
-    # Save the invoice
+    Files are processed in parallel and stored in groups; one NDJSON status line
+    is streamed back per file. A rejected file does not abort the others.
+    """
+    # Spooled before answering: the uploaded files are closed once the endpoint returns
+    uploads = []
     try:
-        storage.save_invoice(metadata['id'], pdf_bytes, xml_content, metadata)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erreur lors de la sauvegarde: {str(e)}")
+        for file in files:
+            max_bytes = UPLOAD_BULK_MAX_BYTES if is_archive(file.filename) else UPLOAD_MAX_BYTES
+            try:
+                uploads.append((file.filename, await spool_upload(file, max_bytes)))
+            except UploadError as e:
+                uploads.append((file.filename, e))
+    except BaseException:
+        for _, upload in uploads:
+            if not isinstance(upload, UploadError):
+                upload.close()
+        raise
 
-    return JSONResponse(content=metadata)
+    return StreamingResponse(upload_batch(iter_bulk_uploads(uploads)), media_type="application/x-ndjson")
 
 
 @app.get("/invoices")
-async def list_invoices():
+async def list_invoices(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    seller_name: Optional[str] = None,
+    buyer_name: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    currency: Optional[str] = None,
+    source: Optional[str] = None,
+    sort: str = "created_at",
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+):
+    """
+    List invoice metadata, one page at a time.
+
+    The cursor of the next page is returned in the X-Next-Cursor header
+    (and as a Link rel="next"); it is absent on the last page.
+    """
+    filters = {
+        "seller_name": seller_name,
+        "buyer_name": buyer_name,
+        "date_from": date_from,
+        "date_to": date_to,
+        "currency": currency,
+        "source": source,
+    }
     try:
         storage = get_storage()
-        invoices = storage.list_invoices()
-        return JSONResponse(content=invoices)
+        invoices, next_cursor = await asyncio.to_thread(
+            storage.query_invoices, limit=limit, cursor=cursor, filters=filters, sort=sort, descending=(order == "desc")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    headers = {}
+    if next_cursor:
+        params = {k: v for k, v in filters.items() if v}
+        params.update(limit=limit, sort=sort, order=order, cursor=next_cursor)
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'</invoices?{urlencode(params)}>; rel="next"'
+    return JSONResponse(content=invoices, headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    """Counters of the service caches and queues."""
+    storage = get_storage()
+    return {
+        "storage_cache": storage.cache_stats() if isinstance(storage, CachedStorage) else None,
+        "outbox": await asyncio.to_thread(outbox.get_outbox().stats),
+        "jobs": await asyncio.to_thread(jobs.get_job_queue().stats),
+        "render_cache": await asyncio.to_thread(get_render_cache().stats),
+        "placeholders": placeholders.get_placeholder_renderer().stats(),
+    }
+
+@app.get("/jobs/{job_id}", responses={303: {"description": "Job done, redirects to the PDF"}})
+async def get_job(job_id: str):
+    """
+    Status and timings of a generation job. Once the invoice is stored the
+    response is 303 See Other, redirecting to its PDF.
+    """
+    job = await asyncio.to_thread(jobs.get_job_queue().get_status, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == jobs.DONE:
+        return JSONResponse(status_code=303, content=job, headers={"Location": f"/invoices/{quote(job['invoice_number'])}"})
+    return job
+
 @app.get("/invoices/{invoice_number}")
-async def get_invoice(invoice_number: str, accept: str = Header(default="application/pdf")):
+async def get_invoice(invoice_number: str, request: Request, accept: str = Header(default="application/pdf")):
     storage = get_storage()
-    result = storage.get_invoice(invoice_number)
-    
-    if not result:
+    kind = "xml" if "xml" in accept else "pdf"
+    # Only the requested file is looked up, and streamed from disk; the index
+    # lookup and the file stat block, so they run off the event loop
+    document = await asyncio.to_thread(storage.get_document, invoice_number, kind)
+    if document is None and kind == "pdf":
+        # Invoices uploaded as XML get their placeholder PDF on the first download
+        try:
+            document = await placeholders.get_placeholder_renderer().get_pdf(invoice_number)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Placeholder PDF rendering failed: {e}")
+
+    if document is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
-        
-    pdf_bytes, xml_content = result
 
-    if "xml" in accept:
-        return Response(content=xml_content, media_type="application/xml")
-    else:
-        return Response(content=pdf_bytes, media_type="application/pdf")
+    media_type = "application/xml" if kind == "xml" else "application/pdf"
+    return document_response(request, document, media_type, headers={"Vary": "Accept"})
 
 @app.delete("/invoices/{invoice_number}")
 async def delete_invoice(invoice_number: str):
     storage = get_storage()
-    metadata = storage.get_invoice_metadata(invoice_number)
+    metadata = await asyncio.to_thread(storage.get_invoice_metadata, invoice_number)
     if not metadata:
         raise HTTPException(status_code=404, detail="Invoice not found")
 
-    storage.delete_invoice(invoice_number)
+    await asyncio.to_thread(storage.delete_invoice, invoice_number)
     return Response(status_code=204)
 
-@app.post("/invoices/{invoice_number}/send")
+@app.post("/invoices/{invoice_number}/send", status_code=202)
 async def send_existing_invoice(invoice_number: str):
+    """
+    Queue the invoice in the outbox; it is sent in the background, with retries.
+    Follow the send with GET /invoices/{invoice_number}/send-status.
+    """
     storage = get_storage()
-    metadata = storage.get_invoice_metadata(invoice_number)
+    metadata = await asyncio.to_thread(storage.get_invoice_metadata, invoice_number)
     if not metadata:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    # Extract date
-    try:
-        # metadata['date'] is str(date) -> YYYY-MM-DD
-        invoice_date = datetime.strptime(metadata['date'], "%Y-%m-%d").date()
-    except (KeyError, ValueError):
-        # Fallback to current date if missing or malformed
-        invoice_date = datetime.now().date()
-    
+
+    # The remote side would reject it: refused now rather than dead-lettered later
     try:
-        success = send_invoice_task(invoice_number, invoice_date, f"{invoice_number}.pdf")
-        if success:
-             return {"message": "Invoice sent successfully"}
-        else:
-             raise HTTPException(status_code=500, detail="Failed to send invoice (unknown error)")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send invoice: {str(e)}")
+        await cii_validation.check_stored_invoice(invoice_number)
+    except cii_validation.InvalidInvoiceError as e:
+        raise HTTPException(status_code=422, detail=f"Invoice XML is not valid EN16931: {e}")
+
+    invoice_date = invoice_date_from_metadata(metadata)
+    status = await asyncio.to_thread(outbox.queue_send, invoice_number, invoice_date)
+    return {"message": "Invoice queued for sending", **status}
+
+@app.get("/invoices/{invoice_number}/send-status")
+async def get_send_status(invoice_number: str):
+    """Status of the latest send of the invoice: pending, sending, sent or dead."""
+    status = await asyncio.to_thread(outbox.get_outbox().get_status, invoice_number)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No send queued for this invoice")
+    return status
 
 @app.get("/documents/{invoice_number}")
-async def get_invoice_document(invoice_number: str):
+async def get_invoice_document(invoice_number: str, request: Request):
     """
     Endpoint exposed for remote integration to fetch the Factur-X XML.
     Returns Content-Type: application/xml
     """
     storage = get_storage()
-    result = storage.get_invoice(invoice_number)
-    
-    if not result:
+    document = await asyncio.to_thread(storage.get_document, invoice_number, "xml")
+
+    if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
-        
-    _, xml_content = result
-    return Response(content=xml_content, media_type="application/xml")
+
+    return document_response(request, document, "application/xml")
 
 
 if __name__ == "__main__":
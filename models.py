@@ -38,3 +38,16 @@ class InvoiceRequest(BaseModel):
     payment: Optional[Payment] = None
     references: Optional[References] = None
     currency: str = "EUR"
+
+class InvoiceFilter(BaseModel):
+    seller_name: Optional[str] = None
+    buyer_name: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    currency: Optional[str] = None
+    source: Optional[str] = None
+
+class SendBatchRequest(BaseModel):
+    # Either the invoices to send, or a filter selecting them
+    invoice_numbers: Optional[List[str]] = None
+    filter: Optional[InvoiceFilter] = None
@@ -0,0 +1,362 @@
+"""
+Durable outbox for the invoices sent to the remote API.
+
+POST /invoices/{id}/send and POST /invoices/send-batch only record the sends
+in a local SQLite outbox and answer right away. A background dispatcher
+drains the outbox in batches and retries failed sends with an exponential
+backoff. A send that keeps failing, or fails for a reason retrying cannot
+fix, is moved to a dead-letter table.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import date
+from typing import Dict, List, Optional
+
+import httpx
+
+import db
+from api.rate_limiter import AsyncRateLimiter
+from cii_validation import InvalidInvoiceError
+from invoice_sender import send_invoice_async
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DB = os.environ.get("OUTBOX_DB", os.path.join("invoices", "outbox.sqlite3"))
+# Sends claimed at once by the dispatcher
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "20"))
+# Attempts before a send is moved to the dead-letter table
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+# Delay before the n-th retry: OUTBOX_BACKOFF_BASE * 2^(n-1) seconds, capped, plus jitter
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "300"))
+# The dispatcher checks for due sends at least this often (seconds)
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+# A claimed send whose dispatcher died is retried after this delay (seconds)
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "120"))
+# Invoices sent to the remote API at once, and sends per second (0: no limit)
+SEND_MAX_CONCURRENCY = int(os.environ.get("SEND_MAX_CONCURRENCY", "8"))
+SEND_RATE_LIMIT = float(os.environ.get("SEND_RATE_LIMIT", "10"))
+# On shutdown, seconds left to the sends in progress before they are interrupted
+OUTBOX_STOP_TIMEOUT = float(os.environ.get("OUTBOX_STOP_TIMEOUT", "10"))
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_number TEXT NOT NULL,
+    invoice_date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_invoice ON outbox (invoice_number, id);
+CREATE TABLE IF NOT EXISTS outbox_dead_letter (
+    id INTEGER PRIMARY KEY,
+    invoice_number TEXT NOT NULL,
+    invoice_date TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_dead_letter_invoice ON outbox_dead_letter (invoice_number, id);
+"""
+
+# Statuses of the outbox rows; "dead" is reported for the dead-letter rows
+PENDING, SENDING, SENT, DEAD = "pending", "sending", "sent", "dead"
+
+
+class PermanentSendError(Exception):
+    """A send that retrying cannot fix: it goes straight to the dead-letter table."""
+
+
+def is_permanent(error: Exception) -> bool:
+    """Invalid invoices and client errors of the remote API (4xx but 408 and 429) are not retried."""
+    if isinstance(error, (PermanentSendError, InvalidInvoiceError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (408, 429)
+    return False
+
+
+def backoff_delay(attempts: int) -> float:
+    """Delay before the next attempt of a send that failed `attempts` times."""
+    delay = min(OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX)
+    return delay + random.uniform(0, delay / 2)
+
+
+class Outbox:
+    """The SQLite outbox: enqueue, claim, acknowledge and report sends."""
+
+    def __init__(self, path: str = OUTBOX_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with db.transaction(self.path) as conn:
+            conn.executescript(OUTBOX_SCHEMA)
+
+    def enqueue(self, invoice_number: str, invoice_date: date) -> Dict:
+        """
+        Record a send. A send of the same invoice still waiting in the outbox
+        is reused instead of queueing a duplicate.
+
+        Returns:
+            The status of the send (see get_status)
+        """
+        now = time.time()
+        with db.transaction(self.path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM outbox WHERE invoice_number = ? AND status = ?",
+                (invoice_number, PENDING),
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO outbox (invoice_number, invoice_date, status, next_attempt_at, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (invoice_number, invoice_date.isoformat(), PENDING, now, now),
+                )
+        return self.get_status(invoice_number)
+
+    def claim(self, limit: int = OUTBOX_BATCH_SIZE) -> List[Dict]:
+        """
+        Claim up to `limit` due sends for this dispatcher. A claim expires after
+        OUTBOX_LEASE seconds, so the sends of a dispatcher that died are retried.
+        """
+        now = time.time()
+        with db.transaction(self.path) as conn:
+            # Immediate: two dispatchers never claim the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, invoice_number, invoice_date, attempts FROM outbox"
+                " WHERE status IN (?, ?) AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (PENDING, SENDING, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = ?, next_attempt_at = ? WHERE id = ?",
+                [(SENDING, now + OUTBOX_LEASE, row["id"]) for row in rows],
+            )
+        return [dict(row) for row in rows]
+
+    def release(self, ids: List[int]):
+        """Hand claimed sends back, due at once: their dispatcher stopped before sending them."""
+        with db.transaction(self.path) as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, next_attempt_at = ? WHERE id = ? AND status = ?",
+                [(PENDING, time.time(), send_id, SENDING) for send_id in ids],
+            )
+
+    def record_results(self, results: List[Dict]):
+        """
+        Record the outcome of claimed sends in one transaction.
+
+        Args:
+            results: The claimed rows, with "error" (None when sent) and
+                     "permanent" (the error cannot be fixed by retrying)
+        """
+        now = time.time()
+        with db.transaction(self.path) as conn:
+            for result in results:
+                attempts = result["attempts"] + 1
+                if result["error"] is None:
+                    conn.execute(
+                        "UPDATE outbox SET status = ?, attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                        (SENT, attempts, now, result["id"]),
+                    )
+                elif result["permanent"] or attempts >= OUTBOX_MAX_ATTEMPTS:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO outbox_dead_letter"
+                        " (id, invoice_number, invoice_date, attempts, last_error, created_at, failed_at)"
+                        " SELECT id, invoice_number, invoice_date, ?, ?, created_at, ? FROM outbox WHERE id = ?",
+                        (attempts, result["error"], now, result["id"]),
+                    )
+                    conn.execute("DELETE FROM outbox WHERE id = ?", (result["id"],))
+                else:
+                    conn.execute(
+                        "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (PENDING, attempts, now + backoff_delay(attempts), result["error"], result["id"]),
+                    )
+
+    def get_status(self, invoice_number: str) -> Optional[Dict]:
+        """
+        Returns the status of the latest send of an invoice, None if it was never sent:
+        {"invoice_number", "status", "attempts", "last_error", "next_attempt_at", "created_at", "sent_at"}
+        """
+        with db.transaction(self.path) as conn:
+            row = conn.execute(
+                "SELECT invoice_number, status, attempts, last_error, next_attempt_at, created_at, sent_at, id"
+                " FROM outbox WHERE invoice_number = ? ORDER BY id DESC LIMIT 1",
+                (invoice_number,),
+            ).fetchone()
+            dead = conn.execute(
+                "SELECT invoice_number, attempts, last_error, created_at, failed_at, id"
+                " FROM outbox_dead_letter WHERE invoice_number = ? ORDER BY id DESC LIMIT 1",
+                (invoice_number,),
+            ).fetchone()
+
+        if dead is not None and (row is None or dead["id"] > row["id"]):
+            return {
+                "invoice_number": dead["invoice_number"],
+                "status": DEAD,
+                "attempts": dead["attempts"],
+                "last_error": dead["last_error"],
+                "next_attempt_at": None,
+                "created_at": dead["created_at"],
+                "sent_at": None,
+            }
+        if row is None:
+            return None
+        status = dict(row)
+        del status["id"]
+        if status["status"] == SENT:
+            status["next_attempt_at"] = None
+        return status
+
+    def stats(self) -> Dict[str, int]:
+        """Number of sends per status"""
+        with db.transaction(self.path) as conn:
+            counts = {row["status"]: row["n"] for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM outbox GROUP BY status"
+            )}
+            counts[DEAD] = conn.execute("SELECT COUNT(*) FROM outbox_dead_letter").fetchone()[0]
+        return {status: counts.get(status, 0) for status in (PENDING, SENDING, SENT, DEAD)}
+
+
+class OutboxDispatcher:
+    """Background task draining the outbox into the remote API."""
+
+    def __init__(self, outbox: Outbox):
+        self.outbox = outbox
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping = False
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = OUTBOX_STOP_TIMEOUT):
+        """
+        Stop once the batch in progress is sent and recorded, waiting at most
+        `timeout` seconds. Past it, the sends still in progress are interrupted
+        and handed back to the outbox, to be sent again on the next start.
+        Unsent rows stay in the outbox.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def notify(self):
+        """Wake the dispatcher up: a send was just queued. Safe to call from any thread."""
+        if self._wakeup is not None:
+            # queue_send runs in a worker thread: asyncio.Event is only set from its loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        limiter = AsyncRateLimiter(SEND_RATE_LIMIT)
+        in_flight = asyncio.Semaphore(max(SEND_MAX_CONCURRENCY, 1))
+
+        async def send(row: Dict) -> Dict:
+            async with in_flight:
+                await limiter.acquire()
+                try:
+                    # The remote API fetches the document back: a deleted invoice cannot be sent
+                    if not await asyncio.to_thread(get_storage().get_invoice_metadata, row["invoice_number"]):
+                        raise PermanentSendError("Invoice not found")
+                    await send_invoice_async(
+                        row["invoice_number"], date.fromisoformat(row["invoice_date"]), f"{row['invoice_number']}.pdf"
+                    )
+                    return dict(row, error=None, permanent=False)
+                except Exception as e:
+                    return dict(row, error=str(e), permanent=is_permanent(e))
+
+        while not self._stopping:
+            try:
+                rows = await asyncio.to_thread(self.outbox.claim)
+                if rows:
+                    sends = [asyncio.ensure_future(send(row)) for row in rows]
+                    try:
+                        results = await asyncio.gather(*sends)
+                    except asyncio.CancelledError:
+                        # Interrupted by stop(): record what was sent, release the others
+                        # rather than leaving them claimed until OUTBOX_LEASE expires
+                        done = [task.result() for task in sends if task.done() and not task.cancelled()]
+                        await asyncio.to_thread(self._record_interrupted, rows, done)
+                        raise
+                    await asyncio.to_thread(self.outbox.record_results, results)
+                    failed = sum(1 for r in results if r["error"])
+                    if failed:
+                        logger.warning(f"Outbox: {failed}/{len(results)} sends failed, will retry or dead-letter")
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+
+            if self._stopping:
+                break
+            # Nothing due: sleep until a send is queued or the next poll
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _record_interrupted(self, rows: List[Dict], results: List[Dict]):
+        self.outbox.record_results(results)
+        finished = {result["id"] for result in results}
+        self.outbox.release([row["id"] for row in rows if row["id"] not in finished])
+
+
+_outbox: Optional[Outbox] = None
+_dispatcher: Optional[OutboxDispatcher] = None
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox()
+    return _outbox
+
+
+def start_dispatcher():
+    """Start the background dispatcher (application startup)."""
+    global _dispatcher
+    _dispatcher = OutboxDispatcher(get_outbox())
+    _dispatcher.start()
+
+
+async def stop_dispatcher():
+    """Stop the background dispatcher (application shutdown)."""
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+        _dispatcher = None
+
+
+def queue_send(invoice_number: str, invoice_date: date) -> Dict:
+    """Queue the send of an invoice and wake the dispatcher up; returns its status."""
+    status = get_outbox().enqueue(invoice_number, invoice_date)
+    if _dispatcher is not None:
+        _dispatcher.notify()
+    return status
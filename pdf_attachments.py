@@ -0,0 +1,511 @@
+"""
+Targeted extraction of the Factur-X XML attachment of a PDF.
+
+Rather than loading the document, the reader follows the cross-reference data
+from the trailer to the catalog, then to its /Names /EmbeddedFiles tree and its
+/AF array, and decompresses only the stream of the XML file. It reads a
+memory-mapped file: only the parts of the file it looks at are read from disk,
+whatever the size of the images the PDF holds.
+
+What it does not handle (encryption, filters other than FlateDecode, broken
+cross-references, an XML attachment under another name) raises UnsupportedPdf:
+the caller then falls back to the full parser.
+"""
+import mmap
+import re
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+# Names of the invoice attachment (Factur-X, ZUGFeRD 1.0, XRechnung), in order of preference
+FACTURX_FILENAMES = ("factur-x.xml", "zugferd-invoice.xml", "xrechnung.xml")
+
+Buffer = Union[bytes, mmap.mmap, memoryview]
+
+_WS = rb"\x00\t\n\x0c\r "
+_REGULAR = rb"[^\x00\t\n\x0c\r ()<>\[\]{}/%]"
+
+_SKIP = re.compile(rb"(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*")
+_REF = re.compile(rb"(\d+)[%s]+(\d+)[%s]+R(?!%s)" % (_WS, _WS, _REGULAR))
+_NUMBER = re.compile(rb"[+-]?(?:\d+\.?\d*|\.\d+)")
+_NAME = re.compile(rb"/(%s*)" % _REGULAR)
+_NAME_ESCAPE = re.compile(rb"#([0-9A-Fa-f]{2})")
+_KEYWORD = re.compile(rb"[A-Za-z]+")
+_HEX_STRING = re.compile(rb"<([0-9A-Fa-f%s]*)>" % _WS)
+_LITERAL_SPECIAL = re.compile(rb"[()\\]")
+_OBJ_HEADER = re.compile(rb"[%s]*(\d+)[%s]+(\d+)[%s]+obj" % (_WS, _WS, _WS))
+_STREAM = re.compile(rb"[%s]*stream(?:\r\n|\n|\r)" % _WS)
+_STARTXREF = re.compile(rb"startxref[%s]+(\d+)" % _WS)
+_XREF_SUBSECTION = re.compile(rb"(\d+)[ \t]+(\d+)")
+_XREF_ENTRY = re.compile(rb"[%s]*(\d+)[ \t]+(\d+)[ \t]+([nf])" % _WS)
+
+_ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f"}
+
+# Bounds of the walks, against malformed or hostile files
+_MAX_DEPTH = 32
+# Largest decoded stream, unless the caller gives its own limit (compression bombs)
+DEFAULT_MAX_STREAM_BYTES = 64 * 1024 * 1024
+
+
+class UnsupportedPdf(Exception):
+    """The PDF cannot be read by this reader: the full parser has to be used."""
+
+
+class StreamTooLarge(Exception):
+    """A compressed stream decodes to more than the limit: the PDF must be rejected, not parsed again."""
+
+
+class Name(str):
+    """A PDF name (/Type), as opposed to a string."""
+
+
+class Ref(NamedTuple):
+    num: int
+    gen: int
+
+
+class Stream(NamedTuple):
+    dict: dict
+    start: int
+    length: int
+
+
+def _parse(data: Buffer, pos: int, depth: int = 0):
+    """Parses the direct object at pos. Returns (object, position after it)."""
+    if depth > _MAX_DEPTH:
+        raise UnsupportedPdf("Objects nested too deeply")
+    pos = _SKIP.match(data, pos).end()
+    head = bytes(data[pos:pos + 2])
+
+    if head == b"<<":
+        result = {}
+        pos += 2
+        while True:
+            pos = _SKIP.match(data, pos).end()
+            if bytes(data[pos:pos + 2]) == b">>":
+                return result, pos + 2
+            key = _NAME.match(data, pos)
+            if key is None:
+                raise UnsupportedPdf(f"Expected a name at offset {pos}")
+            result[_name(key.group(1))], pos = _parse(data, key.end(), depth + 1)
+    if head[:1] == b"[":
+        result = []
+        pos += 1
+        while True:
+            pos = _SKIP.match(data, pos).end()
+            if bytes(data[pos:pos + 1]) == b"]":
+                return result, pos + 1
+            value, pos = _parse(data, pos, depth + 1)
+            result.append(value)
+    if head[:1] == b"(":
+        return _literal_string(data, pos + 1)
+    if head[:1] == b"<":
+        match = _HEX_STRING.match(data, pos)
+        if match is None:
+            raise UnsupportedPdf(f"Invalid hex string at offset {pos}")
+        digits = re.sub(rb"[%s]" % _WS, b"", match.group(1))
+        return bytes.fromhex((digits + b"0" * (len(digits) % 2)).decode("ascii")), match.end()
+    if head[:1] == b"/":
+        match = _NAME.match(data, pos)
+        return Name(_name(match.group(1))), match.end()
+
+    match = _REF.match(data, pos)
+    if match:
+        return Ref(int(match.group(1)), int(match.group(2))), match.end()
+    match = _NUMBER.match(data, pos)
+    if match:
+        text = match.group()
+        return (float(text) if b"." in text else int(text)), match.end()
+    match = _KEYWORD.match(data, pos)
+    if match and match.group() in (b"true", b"false", b"null"):
+        return {b"true": True, b"false": False, b"null": None}[match.group()], match.end()
+    raise UnsupportedPdf(f"Unexpected token at offset {pos}")
+
+
+def _name(raw: bytes) -> str:
+    return _NAME_ESCAPE.sub(lambda m: bytes.fromhex(m.group(1).decode("ascii")), raw).decode("latin-1")
+
+
+def _literal_string(data: Buffer, pos: int) -> Tuple[bytes, int]:
+    """Parses a (literal string) whose opening parenthesis is before pos."""
+    result = bytearray()
+    depth = 1
+    while True:
+        match = _LITERAL_SPECIAL.search(data, pos)
+        if match is None:
+            raise UnsupportedPdf("Unterminated string")
+        result += data[pos:match.start()]
+        char = data[match.start()]
+        pos = match.end()
+        if char == ord("\\"):
+            escaped = data[pos] if pos < len(data) else None
+            if escaped is None:
+                raise UnsupportedPdf("Unterminated string")
+            if escaped in _ESCAPES:
+                result += _ESCAPES[escaped]
+                pos += 1
+            elif 0x30 <= escaped <= 0x37:
+                octal = re.match(rb"[0-7]{1,3}", bytes(data[pos:pos + 3])).group()
+                result.append(int(octal, 8) & 0xFF)
+                pos += len(octal)
+            elif escaped in (0x0A, 0x0D):
+                # Line continuation
+                pos += 2 if bytes(data[pos:pos + 2]) == b"\r\n" else 1
+            else:
+                result.append(escaped)
+                pos += 1
+        elif char == ord("("):
+            depth += 1
+            result += b"("
+        else:
+            depth -= 1
+            if depth == 0:
+                return bytes(result), pos
+            result += b")"
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _unpredict(data: bytes, parms: dict) -> bytes:
+    """Reverses the PNG predictors of a FlateDecode stream (cross-reference streams use them)."""
+    predictor = parms.get("Predictor", 1)
+    if predictor == 1:
+        return data
+    if predictor < 10:
+        raise UnsupportedPdf(f"Unsupported predictor {predictor}")
+
+    colors = parms.get("Colors", 1)
+    bits = parms.get("BitsPerComponent", 8)
+    row_length = (parms.get("Columns", 1) * colors * bits + 7) // 8
+    bpp = max(1, colors * bits // 8)
+
+    output = bytearray()
+    previous = bytearray(row_length)
+    for start in range(0, len(data), row_length + 1):
+        filter_type = data[start]
+        row = bytearray(data[start + 1:start + 1 + row_length])
+        if filter_type == 1:
+            for i in range(bpp, len(row)):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif filter_type == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xFF
+        elif filter_type == 3:
+            for i in range(len(row)):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xFF
+        elif filter_type == 4:
+            for i in range(len(row)):
+                left = row[i - bpp] if i >= bpp else 0
+                up_left = previous[i - bpp] if i >= bpp else 0
+                estimate = left + previous[i] - up_left
+                distances = (abs(estimate - left), abs(estimate - previous[i]), abs(estimate - up_left))
+                row[i] = (row[i] + (left, previous[i], up_left)[distances.index(min(distances))]) & 0xFF
+        elif filter_type != 0:
+            raise UnsupportedPdf(f"Invalid PNG predictor {filter_type}")
+        output += row
+        previous = row
+    return bytes(output)
+
+
+class PdfAttachmentReader:
+    """
+    Reads the cross-reference data of a PDF, then the objects asked for, and only those.
+
+    Usage:
+        xml_bytes = PdfAttachmentReader(data).read_attachment(FACTURX_FILENAMES)
+    """
+
+    def __init__(self, data: Buffer, max_stream_bytes: int = DEFAULT_MAX_STREAM_BYTES):
+        """
+        Args:
+            data: The PDF content: bytes, or a memory-mapped file
+            max_stream_bytes: Largest decoded stream (see stream_data)
+
+        Raises:
+            UnsupportedPdf: If the cross-reference data cannot be read, or the PDF is encrypted
+            StreamTooLarge: If a cross-reference stream decodes to more than max_stream_bytes
+        """
+        self.data = data
+        self.max_stream_bytes = max_stream_bytes
+        # Object number -> file offset, (object stream number, index), or None for a free object
+        self._locations: Dict[int, Union[int, Tuple[int, int], None]] = {}
+        self._objects: Dict[int, object] = {}
+        self._object_streams: Dict[int, Tuple[bytes, int, List[int]]] = {}
+        self.trailer = self._read_cross_references()
+        if "Encrypt" in self.trailer:
+            raise UnsupportedPdf("Encrypted PDF")
+
+    # Cross-references
+
+    def _read_cross_references(self) -> dict:
+        tail_start = max(0, len(self.data) - 2048)
+        matches = list(_STARTXREF.finditer(bytes(self.data[tail_start:])))
+        if not matches:
+            raise UnsupportedPdf("startxref not found")
+
+        offset = int(matches[-1].group(1))
+        trailer = None
+        seen = set()
+        # The newest section comes first: the entries of the older ones (Prev) do not override it
+        while offset is not None:
+            if offset in seen or offset >= len(self.data):
+                raise UnsupportedPdf(f"Invalid cross-reference offset {offset}")
+            seen.add(offset)
+            offset = _SKIP.match(self.data, offset).end()
+            if bytes(self.data[offset:offset + 4]) == b"xref":
+                section = self._read_xref_table(offset + 4)
+                # Hybrid files: the objects of a cross-reference stream complete the table
+                if isinstance(section.get("XRefStm"), int):
+                    self._read_xref_stream(section["XRefStm"])
+            else:
+                section = self._read_xref_stream(offset)
+            if trailer is None:
+                trailer = section
+            offset = section.get("Prev")
+            if offset is not None and not isinstance(offset, int):
+                raise UnsupportedPdf("Invalid Prev offset")
+        return trailer
+
+    def _read_xref_table(self, pos: int) -> dict:
+        while True:
+            pos = _SKIP.match(self.data, pos).end()
+            if bytes(self.data[pos:pos + 7]) == b"trailer":
+                trailer, _ = _parse(self.data, pos + 7)
+                if not isinstance(trailer, dict):
+                    raise UnsupportedPdf("Invalid trailer")
+                return trailer
+            match = _XREF_SUBSECTION.match(self.data, pos)
+            if match is None:
+                raise UnsupportedPdf(f"Invalid cross-reference table at offset {pos}")
+            first, count = int(match.group(1)), int(match.group(2))
+            pos = match.end()
+            for num in range(first, first + count):
+                entry = _XREF_ENTRY.match(self.data, pos)
+                if entry is None:
+                    raise UnsupportedPdf(f"Invalid cross-reference entry at offset {pos}")
+                self._locations.setdefault(num, int(entry.group(1)) if entry.group(3) == b"n" else None)
+                pos = entry.end()
+
+    def _read_xref_stream(self, offset: int) -> dict:
+        stream = self._object_at(offset)
+        if not isinstance(stream, Stream) or stream.dict.get("Type") != "XRef":
+            raise UnsupportedPdf(f"No cross-reference stream at offset {offset}")
+        widths = stream.dict.get("W")
+        size = stream.dict.get("Size")
+        if not isinstance(widths, list) or len(widths) != 3 or not isinstance(size, int):
+            raise UnsupportedPdf("Invalid cross-reference stream")
+
+        data = self.stream_data(stream)
+        index = stream.dict.get("Index", [0, size])
+        pos = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for num in range(first, first + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], "big") if width else None)
+                    pos += width
+                kind = fields[0] if widths[0] else 1
+                if kind == 1:
+                    self._locations.setdefault(num, fields[1])
+                elif kind == 2:
+                    self._locations.setdefault(num, (fields[1], fields[2] or 0))
+                else:
+                    self._locations.setdefault(num, None)
+        return stream.dict
+
+    # Objects
+
+    def _object_at(self, offset: int, num: Optional[int] = None):
+        header = _OBJ_HEADER.match(self.data, offset)
+        if header is None or (num is not None and int(header.group(1)) != num):
+            raise UnsupportedPdf(f"Object {num} not found at offset {offset}")
+        obj, pos = _parse(self.data, header.end())
+        if isinstance(obj, dict):
+            stream = _STREAM.match(self.data, pos)
+            if stream:
+                length = self.resolve(obj.get("Length"))
+                if not isinstance(length, int) or stream.end() + length > len(self.data):
+                    raise UnsupportedPdf(f"Invalid stream length in object {num}")
+                return Stream(obj, stream.end(), length)
+        return obj
+
+    def _from_object_stream(self, stream_num: int, index: int):
+        cached = self._object_streams.get(stream_num)
+        if cached is None:
+            stream = self.get(stream_num)
+            if not isinstance(stream, Stream):
+                raise UnsupportedPdf(f"Object stream {stream_num} not found")
+            data = self.stream_data(stream)
+            first = self.resolve(stream.dict.get("First"))
+            if not isinstance(first, int):
+                raise UnsupportedPdf(f"Invalid object stream {stream_num}")
+            offsets = [int(n) for n in re.findall(rb"\d+", data[:first])][1::2]
+            cached = self._object_streams[stream_num] = (data, first, offsets)
+        data, first, offsets = cached
+        if index >= len(offsets):
+            raise UnsupportedPdf(f"Object {index} not found in object stream {stream_num}")
+        obj, _ = _parse(data, first + offsets[index])
+        return obj
+
+    def get(self, num: int):
+        """Returns the object of this number, None if there is none."""
+        if num not in self._objects:
+            location = self._locations.get(num)
+            if location is None:
+                obj = None
+            elif isinstance(location, int):
+                obj = self._object_at(location, num)
+            else:
+                obj = self._from_object_stream(*location)
+            self._objects[num] = obj
+        return self._objects[num]
+
+    def resolve(self, obj):
+        """Follows indirect references."""
+        for _ in range(_MAX_DEPTH):
+            if not isinstance(obj, Ref):
+                return obj
+            obj = self.get(obj.num)
+        raise UnsupportedPdf("Reference loop")
+
+    def stream_data(self, stream: Stream) -> bytes:
+        """
+        Returns the decoded content of a stream.
+
+        Raises:
+            StreamTooLarge: If it decodes to more than max_stream_bytes
+        """
+        data = self.data[stream.start:stream.start + stream.length]
+        filters = _as_list(self.resolve(stream.dict.get("Filter")))
+        parms = _as_list(self.resolve(stream.dict.get("DecodeParms")))
+        if not filters:
+            return bytes(data)
+        for i, name in enumerate(filters):
+            if name not in ("FlateDecode", "Fl"):
+                raise UnsupportedPdf(f"Unsupported filter {name}")
+            decompressor = zlib.decompressobj()
+            try:
+                # Tolerates a missing end of stream, like PDF readers do
+                data = decompressor.decompress(data, self.max_stream_bytes + 1)
+            except zlib.error as e:
+                raise UnsupportedPdf(f"Invalid compressed stream: {e}")
+            if len(data) > self.max_stream_bytes or decompressor.unconsumed_tail:
+                raise StreamTooLarge(f"Compressed stream larger than {self.max_stream_bytes} bytes once decoded")
+            parm = self.resolve(parms[i]) if i < len(parms) else None
+            if isinstance(parm, dict):
+                data = _unpredict(data, {k: self.resolve(v) for k, v in parm.items()})
+        return data
+
+    # Attachments
+
+    def _filespecs(self) -> Iterator[Tuple[str, dict]]:
+        """Yields (lowercased file name, file specification) for each attachment of the document."""
+        root = self.resolve(self.trailer.get("Root"))
+        if not isinstance(root, dict):
+            raise UnsupportedPdf("Catalog not found")
+
+        names = self.resolve(root.get("Names"))
+        if isinstance(names, dict):
+            yield from self._name_tree(self.resolve(names.get("EmbeddedFiles")), set(), 0)
+        for spec in _as_list(self.resolve(root.get("AF"))):
+            spec = self.resolve(spec)
+            if isinstance(spec, dict):
+                yield _filespec_name(spec, b""), spec
+
+    def _name_tree(self, node, visited: set, depth: int) -> Iterator[Tuple[str, dict]]:
+        if not isinstance(node, dict) or id(node) in visited or depth > _MAX_DEPTH:
+            return
+        visited.add(id(node))
+        entries = _as_list(self.resolve(node.get("Names")))
+        for key, spec in zip(entries[0::2], entries[1::2]):
+            spec = self.resolve(spec)
+            if isinstance(spec, dict):
+                yield _filespec_name(spec, self.resolve(key)), spec
+        for kid in _as_list(self.resolve(node.get("Kids"))):
+            yield from self._name_tree(self.resolve(kid), visited, depth + 1)
+
+    def read_attachment(self, filenames=FACTURX_FILENAMES) -> Optional[bytes]:
+        """
+        Returns the content of the first attachment named after filenames, in
+        their order; None if the document has no XML attachment.
+
+        Raises:
+            UnsupportedPdf: If the document has XML attachments, but none of these names
+        """
+        specs = {}
+        for name, spec in self._filespecs():
+            specs.setdefault(name, spec)
+        for filename in filenames:
+            spec = specs.get(filename)
+            if spec is None:
+                continue
+            embedded = self.resolve(spec.get("EF"))
+            stream = self.resolve(embedded.get("UF") or embedded.get("F")) if isinstance(embedded, dict) else None
+            if not isinstance(stream, Stream):
+                raise UnsupportedPdf(f"Attachment {filename} has no content")
+            return self.stream_data(stream)
+        if any(name.endswith(".xml") for name in specs):
+            raise UnsupportedPdf("XML attachment under another name")
+        return None
+
+
+def _decode_text(value) -> str:
+    if not isinstance(value, bytes):
+        return ""
+    if value.startswith(b"\xfe\xff"):
+        return value[2:].decode("utf-16-be", "replace")
+    if value.startswith(b"\xef\xbb\xbf"):
+        return value[3:].decode("utf-8", "replace")
+    return value.decode("latin-1")
+
+
+def _filespec_name(spec: dict, key) -> str:
+    name = _decode_text(spec.get("UF")) or _decode_text(spec.get("F")) or _decode_text(key)
+    return name.rsplit("/", 1)[-1].lower()
+
+
+@contextmanager
+def mapped(pdf_file: BinaryIO) -> Iterator[Buffer]:
+    """
+    The content of a PDF file object, without reading it: a memory map of a
+    file on disk, the buffer of an in-memory file.
+    """
+    if hasattr(pdf_file, "getbuffer"):
+        view = pdf_file.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+    try:
+        fileno = pdf_file.fileno()
+    except (AttributeError, OSError):
+        pdf_file.seek(0)
+        yield pdf_file.read()
+        return
+    try:
+        mapping = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty file
+        raise UnsupportedPdf("Empty file")
+    try:
+        yield mapping
+    finally:
+        mapping.close()
+
+
+def read_facturx_attachment(pdf_file: BinaryIO, max_stream_bytes: int = DEFAULT_MAX_STREAM_BYTES) -> Optional[bytes]:
+    """
+    Returns the Factur-X XML embedded in a PDF file object, None if it has no XML attachment.
+
+    Raises:
+        UnsupportedPdf: If the full parser has to be used
+        StreamTooLarge: If a stream read decodes to more than max_stream_bytes
+    """
+    with mapped(pdf_file) as data:
+        return PdfAttachmentReader(data, max_stream_bytes).read_attachment()
@@ -0,0 +1,157 @@
+"""
+Placeholder PDFs of the invoices uploaded as CII XML only.
+
+Most of them are never downloaded, so uploads store the XML alone: the
+placeholder is rendered (WeasyPrint, in the render pool) the first time
+GET /invoices/{id} asks for the PDF, then stored like any other PDF. With
+PLACEHOLDER_PDF=background, uploads also queue it for a background worker,
+so that it is usually ready by then. The queue is kept in memory only: a
+render lost on restart is done on the first download instead.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+import render_pool
+from storage import LocalStorage, StoredDocument, get_storage
+from xml_processor import create_placeholder_pdf
+
+logger = logging.getLogger(__name__)
+
+# "lazy": rendered on the first download; "background": also queued at upload
+PLACEHOLDER_PDF = os.environ.get("PLACEHOLDER_PDF", "lazy").lower()
+# Placeholders rendered at once in the background
+PLACEHOLDER_WORKERS = int(os.environ.get("PLACEHOLDER_WORKERS", "1"))
+# Placeholders waiting at most; beyond, they are left to the first download
+PLACEHOLDER_QUEUE_MAX = int(os.environ.get("PLACEHOLDER_QUEUE_MAX", "10000"))
+
+PLACEHOLDER_MODES = ("lazy", "background")
+
+
+def check_config():
+    """
+    Raises:
+        ValueError: On an unknown PLACEHOLDER_PDF
+    """
+    if PLACEHOLDER_PDF not in PLACEHOLDER_MODES:
+        raise ValueError(f"Unknown PLACEHOLDER_PDF '{PLACEHOLDER_PDF}', expected one of {', '.join(PLACEHOLDER_MODES)}")
+
+
+class PlaceholderRenderer:
+    """Renders and stores the missing placeholder PDFs, once per invoice."""
+
+    def __init__(self, workers: int = PLACEHOLDER_WORKERS, max_queued: int = PLACEHOLDER_QUEUE_MAX):
+        self.workers = max(workers, 1)
+        self.max_queued = max_queued
+        self.rendered = 0
+        self.failed = 0
+        self.dropped = 0
+        # Renders in progress by invoice key: concurrent downloads wait for the same one
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_queued)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; the placeholders still queued are rendered on their first download."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def schedule(self, invoice_ids: Iterable[str]):
+        """Queue placeholders for the background workers (PLACEHOLDER_PDF=background)."""
+        if self._queue is None:
+            return
+        for invoice_id in invoice_ids:
+            try:
+                self._queue.put_nowait(invoice_id)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def _run(self):
+        while True:
+            invoice_id = await self._queue.get()
+            try:
+                await self.get_pdf(invoice_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Placeholder PDF of {invoice_id} failed: {e}")
+
+    async def get_pdf(self, invoice_id: str) -> Optional[StoredDocument]:
+        """
+        Returns the stored PDF of an invoice, rendering its placeholder first if
+        it was uploaded as XML only. None if the invoice does not exist.
+        """
+        storage = get_storage()
+        key = LocalStorage._safe_id(invoice_id)
+        while True:
+            document = await asyncio.to_thread(storage.get_document, invoice_id, "pdf")
+            if document is not None:
+                return document
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                break
+            await asyncio.shield(in_flight)
+
+        done = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = done
+        try:
+            metadata = await asyncio.to_thread(storage.get_invoice_metadata, invoice_id)
+            # Only uploads are stored without a PDF
+            if metadata is None or metadata.get("source") != "upload":
+                return None
+            try:
+                pdf_bytes = await render_pool.run(create_placeholder_pdf, None, metadata)
+            except Exception:
+                self.failed += 1
+                raise
+            await asyncio.to_thread(storage.save_pdf, invoice_id, pdf_bytes)
+            self.rendered += 1
+            return await asyncio.to_thread(storage.get_document, invoice_id, "pdf")
+        finally:
+            del self._in_flight[key]
+            done.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        """Placeholders rendered, failed, waiting in the queue, and not queued because it was full"""
+        return {
+            "rendered": self.rendered,
+            "failed": self.failed,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "dropped": self.dropped,
+        }
+
+
+_renderer: Optional[PlaceholderRenderer] = None
+
+
+def get_placeholder_renderer() -> PlaceholderRenderer:
+    global _renderer
+    if _renderer is None:
+        _renderer = PlaceholderRenderer()
+    return _renderer
+
+
+def start_workers():
+    """Start the background workers if PLACEHOLDER_PDF=background (application startup)."""
+    if PLACEHOLDER_PDF == "background":
+        get_placeholder_renderer().start()
+
+
+async def stop_workers():
+    """Stop the background workers (application shutdown)."""
+    if _renderer is not None:
+        await _renderer.stop()
+
+
+def schedule(invoice_ids: Iterable[str]):
+    """Pre-render the placeholders of XML uploads just stored, if PLACEHOLDER_PDF=background."""
+    if _renderer is not None:
+        _renderer.schedule(invoice_ids)
@@ -0,0 +1,153 @@
+"""
+Idempotent rendering for POST /invoices.
+
+Each stored invoice records the hash of the canonical request it was rendered
+from (metadata "request_hash"). A request whose hash matches the stored
+invoice of the same number gets the stored PDF back instead of a new render,
+so a client retrying after a timeout does not pay for WeasyPrint again.
+
+An Idempotency-Key header binds a key to one request: replaying the key with
+the same request returns the stored PDF, with a different request it is
+refused. Keys expire after IDEMPOTENCY_KEY_TTL seconds, and only the
+IDEMPOTENCY_MAX_KEYS most recent are kept.
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import db
+from storage import StoredDocument, get_storage
+
+# "off" always renders, the Idempotency-Key header still being honoured
+RENDER_CACHE = os.environ.get("RENDER_CACHE", "on").lower()
+IDEMPOTENCY_DB = os.environ.get("IDEMPOTENCY_DB", os.path.join("invoices", "idempotency.sqlite3"))
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+IDEMPOTENCY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    request_hash TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+"""
+
+
+class IdempotencyKeyConflict(Exception):
+    """The Idempotency-Key was already used for a different request."""
+
+
+class RenderCache:
+    """Finds the stored render of a request, and remembers idempotency keys."""
+
+    def __init__(
+        self,
+        path: str = IDEMPOTENCY_DB,
+        enabled: bool = RENDER_CACHE != "off",
+        key_ttl: float = IDEMPOTENCY_KEY_TTL,
+        max_keys: int = IDEMPOTENCY_MAX_KEYS,
+    ):
+        self.path = path
+        self.enabled = enabled
+        self.key_ttl = key_ttl
+        self.max_keys = max_keys
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with db.transaction(self.path) as conn:
+            conn.executescript(IDEMPOTENCY_SCHEMA)
+
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.renders_saved = 0
+        # Request hash -> future of the render in progress
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @asynccontextmanager
+    async def exclusive(self, digest: str) -> AsyncIterator[None]:
+        """
+        Identical requests arriving together are handled one after the other:
+        the first one renders, the next ones then find its stored render.
+        """
+        while digest in self._in_flight:
+            await asyncio.shield(self._in_flight[digest])
+        done = asyncio.get_running_loop().create_future()
+        self._in_flight[digest] = done
+        try:
+            yield
+        finally:
+            del self._in_flight[digest]
+            done.set_result(None)
+
+    def find(self, invoice_number: str, digest: str, idempotency_key: Optional[str] = None) -> Optional[StoredDocument]:
+        """
+        Returns the stored PDF rendered from this request, None if it must be rendered.
+
+        Raises:
+            IdempotencyKeyConflict: If idempotency_key was used for another request
+        """
+        replay = self.enabled
+        if idempotency_key:
+            with db.transaction(self.path) as conn:
+                row = conn.execute(
+                    "SELECT request_hash FROM idempotency_keys WHERE key = ? AND created_at > ?",
+                    (idempotency_key, time.time() - self.key_ttl),
+                ).fetchone()
+            if row is not None:
+                if row["request_hash"] != digest:
+                    raise IdempotencyKeyConflict(idempotency_key)
+                replay = True
+
+        if replay:
+            storage = get_storage()
+            metadata = storage.get_invoice_metadata(invoice_number)
+            # The invoice may have been deleted, or overwritten from another request
+            if metadata and metadata.get("request_hash") == digest:
+                document = storage.get_document(invoice_number, "pdf")
+                if document is not None:
+                    with self._lock:
+                        self.renders_saved += 1
+                    return document
+        return None
+
+    def record_render(self, invoice_number: str, digest: str, idempotency_key: Optional[str] = None):
+        """Count a render, and bind the idempotency key to the request."""
+        with self._lock:
+            self.renders += 1
+        if not idempotency_key or self.max_keys <= 0:
+            return
+
+        now = time.time()
+        with db.transaction(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (key, request_hash, invoice_number, created_at)"
+                " VALUES (?, ?, ?, ?)",
+                (idempotency_key, digest, invoice_number, now),
+            )
+            # Eviction: expired keys, then the oldest beyond max_keys
+            conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (now - self.key_ttl,))
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE key IN"
+                " (SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_keys,),
+            )
+
+    def stats(self) -> Dict:
+        """Renders done and avoided since startup, and idempotency keys kept."""
+        with db.transaction(self.path) as conn:
+            keys = conn.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0]
+        with self._lock:
+            return {"renders": self.renders, "renders_saved": self.renders_saved, "idempotency_keys": keys}
+
+
+_render_cache: Optional[RenderCache] = None
+
+
+def get_render_cache() -> RenderCache:
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = RenderCache()
+    return _render_cache
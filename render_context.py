@@ -0,0 +1,93 @@
+"""
+Long-lived rendering state reused across renders: compiled Jinja templates,
+parsed stylesheets and the WeasyPrint font configuration.
+
+Building these is a large part of a small invoice's render time, so they are
+built once per worker (one context per thread: render processes have a single
+rendering thread, and RENDER_WORKERS=0 renders in a thread pool) and reused.
+"""
+import os
+import threading
+from typing import Dict, Optional
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+# Compiled templates shared by the worker processes and kept across restarts.
+# Empty: a per-user directory under the system temporary directory; "off": disabled
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "")
+
+
+class RenderContext:
+    """Templates, stylesheets and fonts of one rendering worker."""
+
+    def __init__(self, templates_dir: str = TEMPLATES_DIR, bytecode_cache_dir: str = TEMPLATE_CACHE_DIR):
+        """
+        Args:
+            templates_dir: Directory of the templates and of their stylesheets
+            bytecode_cache_dir: Directory of the Jinja bytecode cache ("" default, "off" disabled)
+        """
+        self.templates_dir = templates_dir
+        bytecode_cache = None
+        if bytecode_cache_dir != "off":
+            if bytecode_cache_dir:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir or None)
+        # auto_reload off: templates are not stat'ed on every render
+        self.env = Environment(
+            loader=FileSystemLoader(templates_dir),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+        )
+        self._templates: Dict[str, Template] = {}
+        self._stylesheets: Dict[str, CSS] = {}
+        self._font_config: Optional[FontConfiguration] = None
+
+    @property
+    def font_config(self) -> FontConfiguration:
+        if self._font_config is None:
+            self._font_config = FontConfiguration()
+        return self._font_config
+
+    def template(self, name: str) -> Template:
+        """Returns a compiled template of templates_dir."""
+        template = self._templates.get(name)
+        if template is None:
+            template = self._templates[name] = self.env.get_template(name)
+        return template
+
+    def stylesheet(self, name: str) -> CSS:
+        """Returns a parsed stylesheet of templates_dir."""
+        stylesheet = self._stylesheets.get(name)
+        if stylesheet is None:
+            stylesheet = self._stylesheets[name] = CSS(
+                filename=os.path.join(self.templates_dir, name), font_config=self.font_config
+            )
+        return stylesheet
+
+    def write_pdf(self, html: str, stylesheet: Optional[str] = None) -> bytes:
+        """
+        Render an HTML document to PDF.
+
+        Args:
+            html: The HTML document
+            stylesheet: Name of the stylesheet of templates_dir to apply, if any
+
+        Returns:
+            PDF bytes
+        """
+        stylesheets = [self.stylesheet(stylesheet)] if stylesheet else None
+        return HTML(string=html).write_pdf(stylesheets=stylesheets, font_config=self.font_config)
+
+
+_local = threading.local()
+
+
+def get_render_context() -> RenderContext:
+    """Returns the render context of the calling thread, created on first use."""
+    context = getattr(_local, "context", None)
+    if context is None:
+        context = _local.context = RenderContext()
+    return context
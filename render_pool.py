@@ -0,0 +1,106 @@
+"""
+Process pool running the CPU-bound rendering work (WeasyPrint, Factur-X embedding,
+PDF/XML extraction) outside of the asyncio event loop.
+
+The pool is sized with RENDER_WORKERS (default: number of CPUs). RENDER_WORKERS=0
+disables the pool and runs the work in the event loop's thread pool instead.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def pool_size() -> int:
+    """Number of worker processes, from RENDER_WORKERS or the CPU count."""
+    configured = os.environ.get("RENDER_WORKERS")
+    if configured:
+        return max(0, int(configured))
+    return os.cpu_count() or 1
+
+
+def _warm_up_worker():
+    """
+    Worker initializer: import the rendering modules, prepare the worker's render
+    context, render a tiny document and compile the validation rules so that the
+    first real invoice does not pay for library, template, stylesheet, font and
+    rules loading.
+    """
+    try:
+        import invoice_generator  # noqa: F401
+        import xml_processor  # noqa: F401
+        import cii_validation
+        from render_context import get_render_context
+        # Compiles the templates, parses the stylesheets and loads the fonts once
+        context = get_render_context()
+        for name in ("invoice.html", "upload-placeholder.html"):
+            context.template(name)
+        context.stylesheet("upload-placeholder.css")
+        context.write_pdf("<p>warm-up</p>", "invoice.css")
+        # Compiles the EN16931 schema and Schematron
+        cii_validation.warm_up()
+    except Exception as e:
+        # A failing initializer would break the whole pool
+        logger.warning(f"Render worker warm-up failed: {e}")
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _create_executor(size: int) -> ProcessPoolExecutor:
+    # spawn: forking a process that runs an event loop and threads is unsafe
+    return ProcessPoolExecutor(
+        max_workers=size,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_warm_up_worker,
+    )
+
+
+async def start():
+    """Start the pool and wait until every worker is up and warmed."""
+    global _executor
+    size = pool_size()
+    if size == 0:
+        logger.info("Render pool disabled, rendering in threads")
+        return
+
+    _executor = _create_executor(size)
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*[loop.run_in_executor(_executor, _ping) for _ in range(size)])
+    logger.info(f"Render pool started with {len(set(pids))} workers")
+
+
+def shutdown():
+    """Stop the pool, letting the renders in progress finish."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+        logger.info("Render pool stopped")
+
+
+async def run(fn: Callable, *args: Any) -> Any:
+    """
+    Run fn(*args) in the render pool and return its result.
+
+    fn and its arguments must be picklable (module-level functions, pydantic models, bytes...).
+    """
+    global _executor
+    loop = asyncio.get_running_loop()
+    executor = _executor
+    try:
+        return await loop.run_in_executor(executor, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory): replace the pool for the next calls
+        if executor is not None and executor is _executor:
+            logger.error("Render pool is broken, restarting it")
+            _executor = _create_executor(pool_size())
+        raise
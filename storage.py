@@ -1,103 +1,755 @@
 import os
 import json
 import abc
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import db
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Optional, Tuple, Dict
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Dict, Union
 from models import InvoiceRequest
 
+# Metadata index kept next to the files so listing never has to scan the directory.
+# "key" is the sanitized invoice id used for the file names.
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    key TEXT PRIMARY KEY,
+    date TEXT,
+    seller_name TEXT,
+    buyer_name TEXT,
+    currency TEXT,
+    source TEXT,
+    created_at TEXT,
+    total_ht REAL,
+    total_ttc REAL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices (date, key);
+CREATE INDEX IF NOT EXISTS idx_invoices_created_at ON invoices (created_at, key);
+CREATE INDEX IF NOT EXISTS idx_invoices_seller_name ON invoices (seller_name, key);
+CREATE INDEX IF NOT EXISTS idx_invoices_buyer_name ON invoices (buyer_name, key);
+CREATE INDEX IF NOT EXISTS idx_invoices_total_ttc ON invoices (total_ttc, key);
+"""
+
+INDEX_UPSERT = """
+INSERT OR REPLACE INTO invoices
+    (key, date, seller_name, buyer_name, currency, source, created_at, total_ht, total_ttc, metadata)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Sort keys accepted by query_invoices, mapped to index columns
+SORT_KEYS = {
+    "id": "key",
+    "date": "date",
+    "created_at": "created_at",
+    "seller_name": "seller_name",
+    "buyer_name": "buyer_name",
+    "total_ht": "total_ht",
+    "total_ttc": "total_ttc",
+}
+
+# Filters accepted by query_invoices
+INVOICE_FILTERS = ("seller_name", "buyer_name", "date_from", "date_to", "currency", "source")
+
+
+def encode_cursor(sort: str, descending: bool, value, key: str) -> str:
+    """Builds the opaque cursor pointing after the row (value, key)."""
+    raw = json.dumps([sort, descending, value, key]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool) -> Tuple[object, str]:
+    """Returns the (value, key) position stored in a cursor built by encode_cursor."""
+    try:
+        cursor_sort, cursor_desc, value, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or cursor_desc != descending:
+        raise ValueError("Cursor does not match the requested sort order")
+    return value, key
+
+
+# File content accepted by save_invoice: bytes, text (XML, written as UTF-8) or a
+# binary file object, copied in chunks so that large uploads are never loaded in memory
+FileContent = Union[bytes, str, BinaryIO]
+
+
+class StoredDocument(NamedTuple):
+    """One stored invoice file: a file on disk (path, stat) or its content in memory."""
+    etag: str
+    last_modified: Optional[float] = None
+    path: Optional[str] = None
+    stat: Optional[os.stat_result] = None
+    content: Optional[bytes] = None
+
+
+# Permissions of the stored files, as open() would create them (mkstemp uses 0600)
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o666 & ~_umask
+
+# Ids looked up per query, below SQLite's limit on the number of parameters
+_LOOKUP_CHUNK_SIZE = 500
+
+# "sharded": the files of an invoice are kept in one of 4096 subdirectories
+# named after the hash of its id (invoices/3fa/{id}.pdf): about 250 files each
+# at a million files. Files still in the flat layout of earlier versions are
+# read from there until they are migrated (see migrate_file).
+# "flat": all the files directly in the storage directory.
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "sharded").lower()
+STORAGE_LAYOUTS = ("flat", "sharded")
+
+_FILE_SUFFIXES = (".pdf", ".xml", ".meta.json")
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """
+    Strong ETag of a file. Files are replaced atomically, so any new content
+    also gets a new inode and modification time.
+    """
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
 class InvoiceStorage(abc.ABC):
     @abc.abstractmethod
-    def save_invoice(self, invoice_id: str, pdf_bytes: bytes, xml_content: str, metadata: dict):
+    def save_invoice(self, invoice_id: str, pdf_bytes: Optional[FileContent], xml_content: FileContent, metadata: dict):
+        """pdf_bytes is None for XML uploads, until their placeholder PDF is rendered (see save_pdf)"""
         pass
 
+    def save_invoices(self, invoices: List[Tuple[str, Optional[FileContent], FileContent, dict]]):
+        """Saves several (invoice_id, pdf_bytes, xml_content, metadata) at once"""
+        for invoice_id, pdf_bytes, xml_content, metadata in invoices:
+            self.save_invoice(invoice_id, pdf_bytes, xml_content, metadata)
+
+    def save_pdf(self, invoice_id: str, pdf_bytes: bytes):
+        """Adds the PDF of an invoice stored without one; does nothing if the invoice was deleted meanwhile"""
+        metadata = self.get_invoice_metadata(invoice_id)
+        xml = self.get_document(invoice_id, "xml")
+        if metadata is None or xml is None:
+            return
+        if xml.content is not None:
+            self.save_invoice(invoice_id, pdf_bytes, xml.content, metadata)
+        else:
+            with open(xml.path, "rb") as xml_file:
+                self.save_invoice(invoice_id, pdf_bytes, xml_file, metadata)
+
     @abc.abstractmethod
-    def get_invoice(self, invoice_id: str) -> Tuple[bytes, str]:
-        """Returns (pdf_bytes, xml_content)"""
+    def get_invoice(self, invoice_id: str) -> Tuple[bytes, bytes]:
+        """Returns (pdf_bytes, xml_bytes); the XML is returned as stored, in its declared encoding"""
         pass
 
+    def get_document(self, invoice_id: str, kind: str) -> Optional[StoredDocument]:
+        """
+        Returns the stored PDF (kind="pdf") or XML (kind="xml") of an invoice, None if missing.
+
+        This default goes through get_invoice; storages keeping the files on disk
+        return their path instead so that they can be streamed.
+        """
+        result = self.get_invoice(invoice_id)
+        if not result:
+            return None
+        content = result[0] if kind == "pdf" else result[1]
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return StoredDocument(etag=f'"{hashlib.sha256(content).hexdigest()[:32]}"', content=content)
+
     @abc.abstractmethod
     def list_invoices(self) -> List[Dict]:
         """Returns list of invoice metadata dicts"""
         pass
 
+    @abc.abstractmethod
+    def query_invoices(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        filters: Optional[Dict] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Returns one page of invoice metadata dicts and the cursor of the next page
+        (None on the last page).
+
+        filters may contain the keys of INVOICE_FILTERS, sort one of SORT_KEYS.
+        Raises ValueError on an unknown sort key or an invalid cursor.
+        """
+        pass
+
     @abc.abstractmethod
     def get_invoice_metadata(self, invoice_id: str) -> Optional[Dict]:
         """Returns metadata dict for a specific invoice"""
         pass
 
+    def existing_invoice_ids(self, invoice_ids: Iterable[str]) -> Set[str]:
+        """Returns the ids among invoice_ids of the invoices already stored"""
+        return {invoice_id for invoice_id in invoice_ids if self.get_invoice_metadata(invoice_id)}
+
     @abc.abstractmethod
     def delete_invoice(self, invoice_id: str):
         pass
 
 class LocalStorage(InvoiceStorage):
-    def __init__(self, directory: str = "invoices"):
+    INDEX_FILENAME = "index.sqlite3"
+
+    def __init__(self, directory: str = "invoices", layout: str = STORAGE_LAYOUT):
+        if layout not in STORAGE_LAYOUTS:
+            raise ValueError(f"Unknown storage layout '{layout}', expected one of {', '.join(STORAGE_LAYOUTS)}")
         self.directory = directory
+        self.layout = layout
         os.makedirs(self.directory, exist_ok=True)
+        # Shard directories known to exist: they are never removed
+        self._directories: Set[str] = {self.directory}
+        # Files are looked up at their flat path too until none is left there.
+        # Only the new layout is written, so none reappears until a restart
+        self._flat_fallback = layout == "sharded" and next(self.flat_files(), None) is not None
+        self.index_path = os.path.join(self.directory, self.INDEX_FILENAME)
+        self._init_index()
 
-    def _get_paths(self, invoice_id: str):
+    def _init_index(self):
+        is_new = not os.path.exists(self.index_path)
+        with db.transaction(self.index_path) as conn:
+            conn.executescript(INDEX_SCHEMA)
+        if is_new:
+            # First start on an existing archive: backfill from the .meta.json files
+            self.rebuild_index()
+
+    @staticmethod
+    def _safe_id(invoice_id: str) -> str:
         safe_id = "".join([c for c in invoice_id if c.isalnum() or c in ('-', '_')])
         if not safe_id:
              raise ValueError("Invalid invoice ID")
-        base = os.path.join(self.directory, safe_id)
+        return safe_id
+
+    def _shard(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest()[:3])
+
+    def _get_paths(self, invoice_id: str):
+        """Paths the files of an invoice are written to (see _find for reading them)"""
+        key = self._safe_id(invoice_id)
+        directory = self._shard(key) if self.layout == "sharded" else self.directory
+        base = os.path.join(directory, key)
         return f"{base}.pdf", f"{base}.xml", f"{base}.meta.json"
 
-    def save_invoice(self, invoice_id: str, pdf_bytes: bytes, xml_content: str, metadata: dict):
-        pdf_path, xml_path, meta_path = self._get_paths(invoice_id)
-        
-        with open(pdf_path, "wb") as f:
-            f.write(pdf_bytes)
-        
-        with open(xml_path, "w", encoding="utf-8") as f:
-            f.write(xml_content)
-            
-        with open(meta_path, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, default=str)
-
-    def get_invoice(self, invoice_id: str) -> Tuple[bytes, str]:
+    def _flat_path(self, path: str) -> str:
+        return os.path.join(self.directory, os.path.basename(path))
+
+    def _find(self, path: str) -> Optional[Tuple[str, os.stat_result]]:
+        """
+        Returns the actual path and stat of a file of _get_paths, None if missing:
+        in the sharded layout, a file not migrated yet is still at its flat path.
+        """
+        if not self._flat_fallback:
+            candidates = (path,)
+        else:
+            # Looked up in the shard again last: the migration may have just moved it there
+            candidates = (path, self._flat_path(path), path)
+        for candidate in candidates:
+            try:
+                return candidate, os.stat(candidate)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def _remove(self, path: str):
+        # The flat copy first: the migration could otherwise move it back to the shard
+        for candidate in dict.fromkeys((self._flat_path(path), path)):
+            try:
+                os.remove(candidate)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _index_row(key: str, metadata: dict) -> tuple:
+        # Columns are never NULL so that keyset pagination can compare them directly.
+        # Invoices created through POST /invoices predate the "source" field.
+        return (
+            key,
+            str(metadata.get("date") or ""),
+            metadata.get("seller_name") or "",
+            metadata.get("buyer_name") or "",
+            metadata.get("currency") or "",
+            metadata.get("source") or "generated",
+            str(metadata.get("created_at") or ""),
+            metadata.get("total_ht") or 0,
+            metadata.get("total_ttc") or 0,
+            json.dumps(metadata, default=str),
+        )
+
+    def _write_file(self, path: str, content: FileContent):
+        # Written aside then renamed: a download in progress keeps reading the
+        # previous file, and the new one gets a new inode (see file_etag)
+        directory = os.path.dirname(path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            os.fchmod(fd, _FILE_MODE)
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(content, str):
+                    f.write(content.encode("utf-8"))
+                elif isinstance(content, (bytes, bytearray)):
+                    f.write(content)
+                else:
+                    shutil.copyfileobj(content, f, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if self._flat_fallback:
+            # An older copy not migrated yet is no longer read, and must not be migrated
+            try:
+                os.remove(self._flat_path(path))
+            except FileNotFoundError:
+                pass
+
+    def save_invoice(self, invoice_id: str, pdf_bytes: Optional[FileContent], xml_content: FileContent, metadata: dict):
+        self.save_invoices([(invoice_id, pdf_bytes, xml_content, metadata)])
+
+    def save_invoices(self, invoices: List[Tuple[str, Optional[FileContent], FileContent, dict]]):
+        # The index rows are committed only once all the files are written
+        with db.transaction(self.index_path) as conn:
+            for invoice_id, pdf_bytes, xml_content, metadata in invoices:
+                pdf_path, xml_path, meta_path = self._get_paths(invoice_id)
+                conn.execute(INDEX_UPSERT, self._index_row(self._safe_id(invoice_id), metadata))
+
+                if pdf_bytes is not None:
+                    self._write_file(pdf_path, pdf_bytes)
+                else:
+                    # The placeholder of a previous XML would no longer match
+                    self._remove(pdf_path)
+                self._write_file(xml_path, xml_content)
+
+                self._write_file(meta_path, json.dumps(metadata, default=str))
+
+    def save_pdf(self, invoice_id: str, pdf_bytes: bytes):
+        pdf_path, _, meta_path = self._get_paths(invoice_id)
+        if self._find(meta_path) is not None:
+            self._write_file(pdf_path, pdf_bytes)
+
+    def get_invoice(self, invoice_id: str) -> Tuple[bytes, bytes]:
         pdf_path, xml_path, _ = self._get_paths(invoice_id)
-        if not os.path.exists(pdf_path) or not os.path.exists(xml_path):
+        pdf_found, xml_found = self._find(pdf_path), self._find(xml_path)
+        if pdf_found is None or xml_found is None:
             return None
-            
-        with open(pdf_path, "rb") as f:
+
+        with open(pdf_found[0], "rb") as f:
             pdf_bytes = f.read()
-            
-        with open(xml_path, "r", encoding="utf-8") as f:
+
+        with open(xml_found[0], "rb") as f:
             xml_content = f.read()
-            
+
         return pdf_bytes, xml_content
 
+    def get_document(self, invoice_id: str, kind: str) -> Optional[StoredDocument]:
+        pdf_path, xml_path, _ = self._get_paths(invoice_id)
+        found = self._find(pdf_path if kind == "pdf" else xml_path)
+        if found is None:
+            return None
+        path, stat = found
+        return StoredDocument(etag=file_etag(stat), last_modified=stat.st_mtime, path=path, stat=stat)
+
     def list_invoices(self) -> List[Dict]:
-        invoices = []
-        if not os.path.exists(self.directory):
-            return []
-            
-        for filename in os.listdir(self.directory):
-            if filename.endswith(".meta.json"):
-                try:
-                    with open(os.path.join(self.directory, filename), "r") as f:
-                        meta = json.load(f)
-                        invoices.append(meta)
-                except Exception:
-                    continue # Skip broken files
-        return invoices
+        with db.transaction(self.index_path) as conn:
+            rows = conn.execute("SELECT metadata FROM invoices").fetchall()
+        return [json.loads(row["metadata"]) for row in rows]
+
+    def query_invoices(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        filters: Optional[Dict] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        column = SORT_KEYS[sort]
+        filters = filters or {}
+
+        where, params = [], []
+        for name in ("seller_name", "buyer_name"):
+            if filters.get(name):
+                # Case-insensitive "contains" match, with LIKE wildcards escaped
+                escaped = filters[name].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                where.append(f"{name} LIKE ? ESCAPE '\\'")
+                params.append(f"%{escaped}%")
+        if filters.get("date_from"):
+            where.append("date >= ?")
+            params.append(str(filters["date_from"]))
+        if filters.get("date_to"):
+            where.append("date <= ?")
+            params.append(str(filters["date_to"]))
+        for name in ("currency", "source"):
+            if filters.get(name):
+                where.append(f"{name} = ?")
+                params.append(filters[name])
+
+        if cursor:
+            value, key = decode_cursor(cursor, sort, descending)
+            where.append(f"({column}, key) {'<' if descending else '>'} (?, ?)")
+            params.extend([value, key])
+
+        direction = "DESC" if descending else "ASC"
+        sql = f"SELECT key, {column} AS sort_value, metadata FROM invoices"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Fetch one extra row to know whether there is a next page
+        sql += f" ORDER BY {column} {direction}, key {direction} LIMIT ?"
+        params.append(limit + 1)
+
+        with db.transaction(self.index_path) as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(sort, descending, last["sort_value"], last["key"])
+        return [json.loads(row["metadata"]) for row in rows], next_cursor
 
     def get_invoice_metadata(self, invoice_id: str) -> Optional[Dict]:
-        _, _, meta_path = self._get_paths(invoice_id)
-        if not os.path.exists(meta_path):
-            return None
-        try:
-            with open(meta_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return None
+        with db.transaction(self.index_path) as conn:
+            row = conn.execute(
+                "SELECT metadata FROM invoices WHERE key = ?", (self._safe_id(invoice_id),)
+            ).fetchone()
+        return json.loads(row["metadata"]) if row else None
+
+    def existing_invoice_ids(self, invoice_ids: Iterable[str]) -> Set[str]:
+        # One query per chunk of ids instead of one per invoice; invalid ids never exist
+        ids_by_key: Dict[str, List[str]] = {}
+        for invoice_id in invoice_ids:
+            try:
+                ids_by_key.setdefault(self._safe_id(invoice_id), []).append(invoice_id)
+            except ValueError:
+                pass
+        keys = list(ids_by_key)
+        existing = set()
+        with db.transaction(self.index_path) as conn:
+            for start in range(0, len(keys), _LOOKUP_CHUNK_SIZE):
+                chunk = keys[start:start + _LOOKUP_CHUNK_SIZE]
+                rows = conn.execute(
+                    f"SELECT key FROM invoices WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                for row in rows:
+                    existing.update(ids_by_key[row["key"]])
+        return existing
 
     def delete_invoice(self, invoice_id: str):
         pdf_path, xml_path, meta_path = self._get_paths(invoice_id)
-        for p in [pdf_path, xml_path, meta_path]:
-            if os.path.exists(p):
-                os.remove(p)
+        with db.transaction(self.index_path) as conn:
+            conn.execute("DELETE FROM invoices WHERE key = ?", (self._safe_id(invoice_id),))
+            for p in [pdf_path, xml_path, meta_path]:
+                self._remove(p)
+
+    def rebuild_index(self) -> int:
+        """
+        Rebuild the metadata index from the *.meta.json files of the directory
+        and of its shards.
+
+        Returns:
+            The number of invoices indexed
+        """
+        rows = {}
+        for directory in self._directories_to_scan():
+            for filename in os.listdir(directory):
+                if filename.endswith(".meta.json"):
+                    try:
+                        with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+                            meta = json.load(f)
+                    except Exception:
+                        continue # Skip broken files
+                    # The flat directory comes first: a copy in a shard is the newer one
+                    key = filename[:-len(".meta.json")]
+                    rows[key] = self._index_row(key, meta)
+
+        with db.transaction(self.index_path) as conn:
+            conn.execute("DELETE FROM invoices")
+            conn.executemany(INDEX_UPSERT, rows.values())
+        return len(rows)
+
+    def _directories_to_scan(self) -> Iterator[str]:
+        yield self.directory
+        if self.layout != "sharded":
+            return
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if len(name) == 3 and os.path.isdir(path):
+                yield path
+
+    def flat_files(self) -> Iterator[str]:
+        """Names of the invoice files still in the flat layout, read as the directory is scanned"""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(_FILE_SUFFIXES) and not entry.name.startswith(".") and entry.is_file():
+                    yield entry.name
+
+    def migrate_file(self, filename: str) -> bool:
+        """
+        Move a file of the flat layout to its shard, while the service is running.
+
+        The file is hard-linked into the shard, which never replaces a newer copy
+        written there meanwhile, then unlinked: it can be read at either path all
+        along, and keeps its inode and so its ETag.
+
+        Returns:
+            True if the file was moved, False if it was stale or already gone
+        """
+        source = os.path.join(self.directory, filename)
+        shard = self._shard(filename.split(".", 1)[0])
+        if shard not in self._directories:
+            os.makedirs(shard, exist_ok=True)
+            self._directories.add(shard)
+        try:
+            os.link(source, os.path.join(shard, filename))
+            moved = True
+        except FileExistsError:
+            moved = False
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+        return moved
+
+
+# In-memory cache of the hot documents (see CachedStorage). 0 disables it.
+STORAGE_CACHE_BYTES = int(os.environ.get("STORAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Documents larger than this are always read from the storage
+STORAGE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("STORAGE_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+
+
+class CachedStorage(InvoiceStorage):
+    """
+    LRU cache of PDF and XML in front of another storage, bounded by the total
+    size of the cached entries.
+
+    The cache is kept per process: with several processes (uvicorn --workers),
+    another one may replace or delete a file. A cached document is therefore
+    checked against the wrapped storage before it is served (its ETag: one
+    stat() for LocalStorage), and dropped if it changed. Metadata is not cached:
+    it is read from the index, shared by the processes.
+
+    The entries of an invoice are dropped when it is written or deleted through
+    this storage; the least recently used ones once max_bytes is exceeded.
+    Anything else (listing, attributes of the wrapped storage) goes straight
+    to the wrapped storage.
+    """
+
+    def __init__(
+        self,
+        inner: InvoiceStorage,
+        max_bytes: int = STORAGE_CACHE_BYTES,
+        max_entry_bytes: int = STORAGE_CACHE_MAX_ENTRY_BYTES,
+    ):
+        self.inner = inner
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (kind, key) -> (value, size), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        # Bumped on every invalidation: a value read before it must not be cached
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    @staticmethod
+    def _key(invoice_id: str) -> str:
+        # Ids are normalized the way files are named, so that aliases are invalidated together
+        return LocalStorage._safe_id(invoice_id)
+
+    def _get(self, kind: str, key: str):
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is None:
+                return None
+            self._entries.move_to_end((kind, key))
+            return entry[0]
+
+    def _drop(self, kind: str, key: str):
+        with self._lock:
+            entry = self._entries.pop((kind, key), None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def _put(self, kind: str, key: str, value, size: int, version: int):
+        if size > self.max_entry_bytes:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            previous = self._entries.pop((kind, key), None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[(kind, key)] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def _invalidate(self, invoice_ids: List[str]):
+        with self._lock:
+            self._version += 1
+            for invoice_id in invoice_ids:
+                key = self._key(invoice_id)
+                for kind in ("pdf", "xml"):
+                    entry = self._entries.pop((kind, key), None)
+                    if entry is not None:
+                        self._size -= entry[1]
+
+    def cache_stats(self) -> Dict:
+        """Hit/miss counters and current size of the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def save_invoice(self, invoice_id: str, pdf_bytes: Optional[FileContent], xml_content: FileContent, metadata: dict):
+        try:
+            self.inner.save_invoice(invoice_id, pdf_bytes, xml_content, metadata)
+        finally:
+            self._invalidate([invoice_id])
+
+    def save_invoices(self, invoices: List[Tuple[str, Optional[FileContent], FileContent, dict]]):
+        try:
+            self.inner.save_invoices(invoices)
+        finally:
+            self._invalidate([invoice[0] for invoice in invoices])
+
+    def save_pdf(self, invoice_id: str, pdf_bytes: bytes):
+        try:
+            self.inner.save_pdf(invoice_id, pdf_bytes)
+        finally:
+            self._invalidate([invoice_id])
+
+    def delete_invoice(self, invoice_id: str):
+        try:
+            self.inner.delete_invoice(invoice_id)
+        finally:
+            self._invalidate([invoice_id])
+
+    def get_document(self, invoice_id: str, kind: str) -> Optional[StoredDocument]:
+        key = self._key(invoice_id)
+        version = self._version
+        cached = self._get(kind, key)
+        # Revalidated on every hit: another process may have replaced or deleted the file
+        document = self.inner.get_document(invoice_id, kind)
+        if document is None:
+            if cached is not None:
+                self._drop(kind, key)
+            return None
+        if cached is not None:
+            if cached.etag == document.etag:
+                with self._lock:
+                    self.hits += 1
+                return cached
+            self._drop(kind, key)
+        with self._lock:
+            self.misses += 1
+
+        if document.content is None:
+            if document.stat is not None and document.stat.st_size > self.max_entry_bytes:
+                return document
+            # Keep the path too: byte ranges are still served from the file
+            try:
+                with open(document.path, "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    content = f.read()
+            except FileNotFoundError:
+                # Replaced, or moved by the layout migration: looked up again, not cached
+                return self.inner.get_document(invoice_id, kind)
+            document = StoredDocument(
+                etag=file_etag(stat), last_modified=stat.st_mtime, path=document.path, stat=stat, content=content
+            )
+        self._put(kind, key, document, len(document.content), version)
+        return document
+
+    def get_invoice(self, invoice_id: str) -> Tuple[bytes, bytes]:
+        pdf = self.get_document(invoice_id, "pdf")
+        xml = self.get_document(invoice_id, "xml")
+        if pdf is None or xml is None:
+            return None
+        return pdf.content, xml.content
+
+    def get_invoice_metadata(self, invoice_id: str) -> Optional[Dict]:
+        return self.inner.get_invoice_metadata(invoice_id)
+
+    def list_invoices(self) -> List[Dict]:
+        return self.inner.list_invoices()
+
+    def query_invoices(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        filters: Optional[Dict] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        return self.inner.query_invoices(limit, cursor, filters, sort, descending)
+
+    def existing_invoice_ids(self, invoice_ids: Iterable[str]) -> Set[str]:
+        return self.inner.existing_invoice_ids(invoice_ids)
+
+
+_storage: Optional[InvoiceStorage] = None
 
 
 def get_storage() -> InvoiceStorage:
     # Always use LocalStorage as GCS support has been removed
-    return LocalStorage()
+    global _storage
+    if _storage is None:
+        storage = LocalStorage()
+        _storage = CachedStorage(storage) if STORAGE_CACHE_BYTES > 0 else storage
+    return _storage
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Invoice storage maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild-index", help="Backfill the metadata index from *.meta.json files")
+    rebuild.add_argument("--directory", default="invoices")
+    migrate = subparsers.add_parser(
+        "migrate-layout", help="Move the files of the flat layout to the sharded one, while the service runs"
+    )
+    migrate.add_argument("--directory", default="invoices")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="Files moved between two pauses")
+    migrate.add_argument("--pause", type=float, default=0.1, help="Seconds to wait between batches")
+    args = parser.parse_args()
+
+    if args.command == "rebuild-index":
+        count = LocalStorage(args.directory).rebuild_index()
+        print(f"Indexed {count} invoices in {args.directory}")
+    elif args.command == "migrate-layout":
+        import time
+
+        storage = LocalStorage(args.directory, layout="sharded")
+        moved = skipped = 0
+        for filename in storage.flat_files():
+            if storage.migrate_file(filename):
+                moved += 1
+            else:
+                skipped += 1
+            if (moved + skipped) % args.batch_size == 0:
+                print(f"Moved {moved} files ({skipped} stale or gone)", flush=True)
+                time.sleep(args.pause)
+        print(f"Moved {moved} files of {args.directory} to the sharded layout ({skipped} stale or gone)")
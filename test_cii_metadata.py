@@ -0,0 +1,60 @@
+import sys
+from datetime import date
+from io import BytesIO
+
+from cii_writer import cii_xml_bytes
+from invoice_generator import compute_totals
+from models import Address, InvoiceRequest, LineItem, Party
+from xml_processor import extract_metadata_from_xml, parse_cii_stream
+
+invoice = InvoiceRequest(
+    invoice_number="META-001",
+    date=date(2023, 10, 27),
+    seller=Party(
+        name="Metadata Corp",
+        address=Address(street="1 Rue de Paris", zip_code="75001", city="Paris", country_code="FR"),
+        vat_id="FR123456789",
+    ),
+    buyer=Party(
+        name="Client Corp",
+        address=Address(street="2 Rue de Lyon", zip_code="69002", city="Lyon", country_code="FR"),
+        vat_id="FR987654321",
+    ),
+    items=[
+        LineItem(description="Consulting", quantity=2, unit_price=500, vat_rate=20.0),
+        LineItem(description="Books", quantity=3, unit_price=12.5, vat_rate=5.5),
+        LineItem(description="Export", quantity=1, unit_price=100, vat_rate=0.0),
+    ],
+)
+generated = cii_xml_bytes(invoice, compute_totals(invoice))
+
+# Documents where the fields are not at their usual place: only the
+# document-wide fallback paths find them
+SAMPLES = {
+    "generated": generated,
+    "summation under another name": generated.replace(
+        b"SpecifiedTradeSettlementHeaderMonetarySummation", b"SpecifiedTradeSettlementMonetarySummation"
+    ),
+    "parties outside the header agreement": generated.replace(
+        b"ApplicableHeaderTradeAgreement", b"ApplicableTradeAgreement"
+    ),
+}
+
+print("1. Extracting the metadata of the sample documents with both parsers...")
+failed = False
+for name, xml_bytes in SAMPLES.items():
+    from_tree = extract_metadata_from_xml(xml_bytes)
+    from_stream, error = parse_cii_stream(BytesIO(xml_bytes))
+    if from_tree != from_stream:
+        differences = {k: (from_tree.get(k), from_stream.get(k)) for k in from_tree if from_tree.get(k) != from_stream.get(k)}
+        print(f"Failed: {name}: tree and streaming metadata differ: {differences}")
+        failed = True
+    elif not from_tree["total_ttc"]:
+        print(f"Failed: {name}: no total_ttc found")
+        failed = True
+    else:
+        print(f"{name}: identical (total_ttc {from_stream['total_ttc']}, error: {error})")
+
+if failed:
+    sys.exit(1)
+print("Success: both parsers return the same metadata.")
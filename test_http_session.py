@@ -0,0 +1,105 @@
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from api.http_session import create_session
+
+SENDS = 50
+# Simulated TLS handshake cost of a new connection to the remote API
+HANDSHAKE_DELAY = 0.01
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Stand-in for the remote API: counts the TCP connections it accepts."""
+    protocol_version = "HTTP/1.1"
+    # As real servers do: headers and body are separate writes
+    disable_nagle_algorithm = True
+    connections = 0
+    failures_left = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+        time.sleep(HANDSHAKE_DELAY)
+
+    def _answer(self, status: int, body: bytes = b'{"ok": true}'):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer_or_fail(self):
+        # Temporary failures first, to exercise the retries
+        if type(self).failures_left > 0:
+            type(self).failures_left -= 1
+            self._answer(503, b"{}")
+        else:
+            self._answer(200)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._answer_or_fail()
+
+    def do_GET(self):
+        self._answer_or_fail()
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f"http://127.0.0.1:{server.server_address[1]}"
+message = {"routingKey": "facture.entrant", "message": {"payload": "{}"}}
+
+
+def burst(post) -> float:
+    start = time.perf_counter()
+    for _ in range(SENDS):
+        resp = post(f"{base_url}/api/messages?type=nouveau", json=message)
+        resp.raise_for_status()
+    return time.perf_counter() - start
+
+
+print(f"1. Sending {SENDS} messages without a session...")
+StandInHandler.connections = 0
+unpooled = burst(requests.post)
+unpooled_connections = StandInHandler.connections
+print(f"{unpooled_connections} connections, {unpooled * 1000:.0f} ms")
+
+print(f"2. Sending {SENDS} messages with the pooled session...")
+session = create_session()
+StandInHandler.connections = 0
+pooled = burst(session.post)
+pooled_connections = StandInHandler.connections
+print(f"{pooled_connections} connections, {pooled * 1000:.0f} ms (x{unpooled / pooled:.1f})")
+
+if pooled_connections != 1:
+    print(f"Failed: expected the pooled session to reuse 1 connection, got {pooled_connections}")
+    sys.exit(1)
+print("Success: connection reused.")
+
+print("3. GET after two 503 responses...")
+StandInHandler.failures_left = 2
+retry_session = create_session(backoff_factor=0.01, backoff_jitter=0.01)
+resp = retry_session.get(f"{base_url}/api/status")
+if resp.status_code == 200 and StandInHandler.failures_left == 0:
+    print("Success: GET retried until it succeeded.")
+else:
+    print(f"Failed: {resp.status_code}")
+    sys.exit(1)
+
+print("4. POST answered 503...")
+StandInHandler.failures_left = 2
+resp = retry_session.post(f"{base_url}/api/messages?type=nouveau", json=message)
+if resp.status_code == 503 and StandInHandler.failures_left == 1:
+    print("Success: POST not retried (not idempotent).")
+else:
+    print(f"Failed: {resp.status_code}, {2 - StandInHandler.failures_left} attempts")
+    sys.exit(1)
+
+server.shutdown()
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+import time
+from datetime import date
+
+# In-process stand-in unless a broker is configured (SEND_TRANSPORT=amqp AMQP_URL=...)
+os.environ.setdefault("SEND_TRANSPORT", "memory")
+
+import send_transport
+from invoice_sender import AsyncInvoiceSender
+
+SENDS = 200
+
+
+async def count_received(queue, expected: int, timeout: float = 10) -> int:
+    received = 0
+    deadline = time.monotonic() + timeout
+    while received < expected and time.monotonic() < deadline:
+        message = await queue.get(fail=False)
+        if message is None:
+            await asyncio.sleep(0.05)
+        else:
+            await message.ack()
+            received += 1
+    return received
+
+
+async def main():
+    transport = send_transport.get_transport()
+    sender = AsyncInvoiceSender()
+    print(f"Transport: {send_transport.SEND_TRANSPORT}")
+
+    queue = None
+    if isinstance(transport, send_transport.AmqpTransport):
+        # Temporary queue bound to the routing key, to check the messages arrive
+        import aio_pika
+        connection = await aio_pika.connect_robust(transport.url)
+        channel = await connection.channel()
+        queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await queue.bind(transport.exchange_name, routing_key=sender.routing_key)
+
+    print(f"1. Publishing {SENDS} invoices concurrently...")
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[sender.send_invoice(f"TEST-{i}", date(2023, 10, 27), f"TEST-{i}.pdf") for i in range(SENDS)],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    failures = [r for r in results if r is not True]
+    print(f"{SENDS - len(failures)} confirmed in {elapsed * 1000:.0f} ms")
+    if failures:
+        print(f"Failed: {failures[0]}")
+        sys.exit(1)
+
+    if isinstance(transport, send_transport.MemoryTransport):
+        print(f"Confirm groups: {transport.batches}")
+        if len(transport.messages) != SENDS or len(transport.batches) >= SENDS:
+            print("Failed: expected every message, confirmed in groups")
+            sys.exit(1)
+    if queue is not None:
+        received = await count_received(queue, SENDS)
+        await connection.close()
+        if received != SENDS:
+            print(f"Failed: {received}/{SENDS} messages received from the broker")
+            sys.exit(1)
+
+    await send_transport.close_transport()
+    print("Success: all messages published and confirmed.")
+
+
+asyncio.run(main())
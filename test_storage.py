@@ -9,7 +9,8 @@ payload = {
     "date": "2023-12-01",
     "seller": {
         "name": "Storage Corp",
-        "address": { "street": "Cloud Av", "zip_code": "10000", "city": "Cloud City", "country_code": "US" }
+        "address": { "street": "Cloud Av", "zip_code": "10000", "city": "Cloud City", "country_code": "US" },
+        "vat_id": "US123456789"
     },
     "buyer": {
         "name": "Local User",
@@ -29,7 +30,7 @@ if resp.status_code != 200:
 print("Created.")
 
 print("2. Listing invoices...")
-resp_list = requests.get(f"{base_url}/invoices")
+resp_list = requests.get(f"{base_url}/invoices", params={"seller_name": "Storage Corp"})
 if resp_list.status_code == 200:
     invoices = resp_list.json()
     print(f"Received {len(invoices)} invoices.")
@@ -55,7 +56,7 @@ else:
     sys.exit(1)
 
 print("4. Verifying deletion (List)...")
-resp_list_2 = requests.get(f"{base_url}/invoices")
+resp_list_2 = requests.get(f"{base_url}/invoices", params={"seller_name": "Storage Corp"})
 invoices_2 = resp_list_2.json()
 for inv in invoices_2:
     if inv["id"] == invoice_id:
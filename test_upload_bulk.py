@@ -0,0 +1,76 @@
+import io
+import json
+import sys
+import zipfile
+
+import requests
+
+base_url = "http://localhost:8000"
+invoice_ids = ["FV-BULK-TEST-1", "FV-BULK-TEST-2"]
+
+
+def make_payload(invoice_id):
+    return {
+        "invoice_number": invoice_id,
+        "date": "2023-12-01",
+        "seller": {
+            "name": "Bulk Corp",
+            "address": { "street": "Archive St", "zip_code": "75001", "city": "Paris", "country_code": "FR" },
+            "vat_id": "FR123456789"
+        },
+        "buyer": {
+            "name": "Import User",
+            "address": { "street": "Upload Av", "zip_code": "69002", "city": "Lyon", "country_code": "FR" }
+        },
+        "items": [
+            { "description": "Migration", "quantity": 1, "unit_price": 100.0, "vat_rate": 20.0 }
+        ],
+        "currency": "EUR"
+    }
+
+
+print("1. Creating invoices to export...")
+archive = io.BytesIO()
+with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+    for invoice_id in invoice_ids:
+        resp = requests.post(f"{base_url}/invoices", json=make_payload(invoice_id))
+        if resp.status_code != 200:
+            print(f"Failed to create {invoice_id}: {resp.status_code}")
+            sys.exit(1)
+        zf.writestr(f"export/{invoice_id}.pdf", resp.content)
+        xml = requests.get(f"{base_url}/invoices/{invoice_id}", headers={"Accept": "application/xml"})
+        zf.writestr(f"export/{invoice_id}.xml", xml.content)
+        requests.delete(f"{base_url}/invoices/{invoice_id}")
+    zf.writestr("export/readme.txt", "not an invoice")
+print("Created and deleted, archive ready.")
+
+print("2. Uploading the archive...")
+resp = requests.post(
+    f"{base_url}/invoices/upload-bulk",
+    files=[("files", ("export.zip", archive.getvalue(), "application/zip"))],
+)
+if resp.status_code != 200:
+    print(f"Failed to upload: {resp.status_code} {resp.text}")
+    sys.exit(1)
+lines = [json.loads(line) for line in resp.text.splitlines()]
+for line in sorted(lines, key=lambda line: line["index"]):
+    print(line)
+
+# Each invoice is there as a PDF and as an XML: one of them is stored, the other is a duplicate
+results = {invoice_id: [line["status"] for line in lines if line["id"] == invoice_id] for invoice_id in invoice_ids}
+if any(sorted(statuses) != ["error", "ok"] for statuses in results.values()):
+    print(f"Error: expected one stored file and one duplicate per invoice, got {results}")
+    sys.exit(1)
+if not any(line["file"] == "export/readme.txt" and line["status"] == "error" for line in lines):
+    print("Error: the text file was not rejected.")
+    sys.exit(1)
+print("Report OK.")
+
+print("3. Checking the stored invoices...")
+for invoice_id in invoice_ids:
+    resp = requests.get(f"{base_url}/invoices/{invoice_id}")
+    if resp.status_code != 200:
+        print(f"Error: {invoice_id} not stored ({resp.status_code})")
+        sys.exit(1)
+    requests.delete(f"{base_url}/invoices/{invoice_id}")
+print("Verification successful: invoices imported.")
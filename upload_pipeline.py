@@ -0,0 +1,412 @@
+"""
+Upload pipeline for Factur-X PDF and CII XML invoice files.
+
+Uploads are read in chunks into a SpooledUpload: kept in memory while small,
+written to a temporary file beyond UPLOAD_SPOOL_MEMORY_BYTES and rejected past
+UPLOAD_MAX_BYTES. The pipeline then reads the file where it is: the XML is
+validated and its metadata extracted in a single streaming pass, and an XML
+upload is stored by copying the file, so memory use per upload stays bounded
+whatever the size of the file.
+
+Bulk uploads may be ZIP archives: their invoice files are extracted one at a
+time into SpooledUploads, the same way.
+"""
+import asyncio
+import codecs
+import os
+import tempfile
+import zipfile
+from io import BytesIO
+from typing import AsyncIterator, BinaryIO, List, Optional, Tuple, Union
+
+from fastapi import UploadFile
+from lxml import etree
+
+from cii_validation import validate_en16931
+from xml_processor import extract_xml_bytes_from_pdf, parse_cii_stream
+
+ALLOWED_EXTENSIONS = ('pdf', 'xml')
+
+# Uploads larger than this are rejected with 413
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+# Uploads up to this size stay in memory, larger ones are spooled to a temporary file
+UPLOAD_SPOOL_MEMORY_BYTES = int(os.environ.get("UPLOAD_SPOOL_MEMORY_BYTES", str(1024 * 1024)))
+# Directory of the spooled uploads (default: the system temporary directory)
+UPLOAD_TMP_DIR = os.environ.get("UPLOAD_TMP_DIR") or None
+# Largest ZIP archive accepted by the bulk upload, also the limit of its total uncompressed size
+UPLOAD_BULK_MAX_BYTES = int(os.environ.get("UPLOAD_BULK_MAX_BYTES", str(500 * 1024 * 1024)))
+# Files accepted in one ZIP archive
+UPLOAD_BULK_MAX_FILES = int(os.environ.get("UPLOAD_BULK_MAX_FILES", "10000"))
+
+_CHUNK_SIZE = 1024 * 1024
+_LATIN1_DECLARATION = b'<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+
+
+class UploadError(Exception):
+    """An uploaded file was rejected; carries the HTTP status code to answer with."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def get_upload_type(filename: Optional[str]) -> str:
+    """
+    Returns the type of an uploaded file ('pdf' or 'xml') from its name.
+
+    Raises:
+        UploadError: If the extension is not supported
+    """
+    filename = filename or ""
+    ext = filename.lower().rsplit('.', 1)[-1] if '.' in filename else ''
+
+    if ext not in ALLOWED_EXTENSIONS:
+        raise UploadError(
+            400, "Type de fichier invalide. Formats acceptes: PDF (Factur-X), XML (CII/EN16931)"
+        )
+    return ext
+
+
+class SpooledUpload:
+    """
+    An uploaded file, held in memory up to memory_bytes and in a temporary file
+    on disk beyond that.
+
+    `source` is what the pipeline is given: the bytes, or the path of the
+    temporary file. Unlike an open file, both can be sent to the render pool.
+    """
+
+    def __init__(self, max_bytes: int = UPLOAD_MAX_BYTES, memory_bytes: int = UPLOAD_SPOOL_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.size = 0
+        self.path: Optional[str] = None
+        self._buffer = bytearray()
+        self._file = None
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        return self.path if self.path else bytes(self._buffer)
+
+    def write(self, chunk: bytes):
+        """
+        Raises:
+            UploadError: If the upload exceeds max_bytes
+        """
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadError(413, f"Fichier trop volumineux (maximum {self.max_bytes} octets)")
+
+        if self._file is None and self.size > self.memory_bytes:
+            fd, self.path = tempfile.mkstemp(prefix="upload-", dir=UPLOAD_TMP_DIR)
+            self._file = os.fdopen(fd, "wb")
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._buffer += chunk
+
+    def finish(self):
+        """Ends writing: the upload can now be read back."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def open(self) -> BinaryIO:
+        """Opens the upload for reading."""
+        return _open(self.source)
+
+    def close(self):
+        """Discards the upload and its temporary file."""
+        self.finish()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self._buffer = bytearray()
+
+
+async def spool_upload(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """
+    Reads an uploaded file chunk by chunk into a SpooledUpload.
+
+    Raises:
+        UploadError: If the file exceeds max_bytes (413)
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadError(413, f"Fichier trop volumineux (maximum {max_bytes} octets)")
+
+    spooled = SpooledUpload(max_bytes=max_bytes)
+    try:
+        while True:
+            chunk = await upload.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            if spooled.path:
+                await asyncio.to_thread(spooled.write, chunk)
+            else:
+                spooled.write(chunk)
+        spooled.finish()
+    except BaseException:
+        spooled.close()
+        raise
+    return spooled
+
+
+def is_archive(filename: Optional[str]) -> bool:
+    return (filename or "").lower().endswith(".zip")
+
+
+def _is_ignored_member(info: zipfile.ZipInfo) -> bool:
+    # Directories, and the metadata added by macOS and file managers
+    parts = info.filename.split("/")
+    return info.is_dir() or parts[0] == "__MACOSX" or any(part.startswith(".") for part in parts)
+
+
+class ArchiveReader:
+    """
+    The files of an uploaded ZIP archive, extracted one at a time into SpooledUploads.
+
+    Members are read in chunks, so the sizes declared by the archive are never
+    trusted: each file is bounded by UPLOAD_MAX_BYTES and all of them together
+    by max_bytes.
+    """
+
+    def __init__(
+        self,
+        source: Union[bytes, str],
+        max_bytes: int = UPLOAD_BULK_MAX_BYTES,
+        max_files: int = UPLOAD_BULK_MAX_FILES,
+    ):
+        """
+        Raises:
+            UploadError: If the archive is not a valid ZIP (400) or has more than max_files files (413)
+        """
+        self.max_bytes = max_bytes
+        self.extracted_bytes = 0
+        self._file = _open(source)
+        try:
+            self._zip = zipfile.ZipFile(self._file)
+        except (zipfile.BadZipFile, OSError):
+            self._file.close()
+            raise UploadError(400, "Archive ZIP invalide")
+
+        self.members: List[zipfile.ZipInfo] = [
+            info for info in self._zip.infolist() if not _is_ignored_member(info)
+        ]
+        if len(self.members) > max_files:
+            self.close()
+            raise UploadError(413, f"Archive trop volumineuse (maximum {max_files} fichiers)")
+
+    def extract(self, info: zipfile.ZipInfo) -> SpooledUpload:
+        """
+        Raises:
+            UploadError: If the file is too large (413) or cannot be read from the archive (422)
+        """
+        spooled = SpooledUpload()
+        try:
+            try:
+                with self._zip.open(info) as member:
+                    for chunk in iter(lambda: member.read(_CHUNK_SIZE), b''):
+                        self.extracted_bytes += len(chunk)
+                        if self.extracted_bytes > self.max_bytes:
+                            raise UploadError(
+                                413, f"Archive trop volumineuse une fois decompressee (maximum {self.max_bytes} octets)"
+                            )
+                        spooled.write(chunk)
+                spooled.finish()
+            except (zipfile.BadZipFile, NotImplementedError, RuntimeError, OSError, EOFError) as e:
+                # Corrupted member, unsupported compression method, encrypted file
+                raise UploadError(422, f"Erreur lors de la lecture de l'archive: {str(e)}")
+        except BaseException:
+            spooled.close()
+            raise
+        return spooled
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+
+
+async def iter_bulk_uploads(
+    uploads: List[Tuple[Optional[str], Union[SpooledUpload, UploadError]]],
+) -> AsyncIterator[Tuple[Optional[str], Union[SpooledUpload, UploadError]]]:
+    """
+    Yields (filename, upload) for each invoice file of a bulk upload, the files
+    of the ZIP archives in place of the archives. upload is the UploadError of a
+    file that was rejected before processing.
+
+    The caller owns the yielded uploads; the archives are closed here.
+    """
+    remaining = list(uploads)
+    try:
+        while remaining:
+            filename, upload = remaining.pop(0)
+            if isinstance(upload, UploadError) or not is_archive(filename):
+                yield filename, upload
+                continue
+
+            try:
+                try:
+                    archive = await asyncio.to_thread(ArchiveReader, upload.source)
+                except UploadError as e:
+                    yield filename, e
+                    continue
+                try:
+                    for info in archive.members:
+                        try:
+                            # Decompression runs in a thread, alongside the processing of the previous files
+                            entry = await asyncio.to_thread(archive.extract, info)
+                        except UploadError as e:
+                            entry = e
+                        yield info.filename, entry
+                finally:
+                    archive.close()
+            finally:
+                upload.close()
+    finally:
+        for _, upload in remaining:
+            if isinstance(upload, SpooledUpload):
+                upload.close()
+
+
+def _open(source: Union[bytes, str]) -> BinaryIO:
+    return BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+
+
+class UploadPipeline:
+    """
+    Processes one uploaded invoice file: XML extraction (PDF only), then a single
+    streaming pass for CII validation (XML only) and metadata extraction, then
+    the EN16931 validation (see cii_validation).
+
+    Usage:
+        metadata, xml_bytes = UploadPipeline(filename, source).run()
+    """
+
+    def __init__(self, filename: Optional[str], source: Union[bytes, str]):
+        """
+        Args:
+            filename: Name of the uploaded file
+            source: The file content, or the path of the spooled upload
+        """
+        self.upload_type = get_upload_type(filename)
+        self.source = source
+        self.xml_bytes: Optional[bytes] = None
+        self.metadata: Optional[dict] = None
+        self.error: Optional[str] = None
+
+    def run(self) -> Tuple[dict, Optional[bytes]]:
+        """
+        Returns:
+            Tuple of (metadata, xml_bytes to store). xml_bytes is None when an XML
+            upload is to be stored as it is.
+
+        Raises:
+            UploadError: If the file is rejected
+        """
+        if not self.source:
+            raise UploadError(400, "Fichier vide")
+
+        if self.upload_type == 'pdf':
+            self.extract_xml()
+            self.parse(self.xml_bytes)
+        else:
+            self.parse(self.source)
+            self.validate()
+        metadata = self.extract_metadata()
+        self.check_rules()
+        return metadata, self.xml_bytes
+
+    def extract_xml(self):
+        try:
+            with _open(self.source) as pdf_file:
+                # Nothing decoded from the PDF may be larger than the upload itself could be
+                self.xml_bytes = extract_xml_bytes_from_pdf(pdf_file, UPLOAD_MAX_BYTES)
+        except ImportError:
+            raise UploadError(
+                500, "La bibliotheque facturx n'est pas installee. Impossible de traiter les PDF."
+            )
+        except Exception as e:
+            raise UploadError(422, f"Erreur lors de l'extraction XML: {str(e)}")
+        if not self.xml_bytes:
+            raise UploadError(
+                422,
+                "Impossible d'extraire le XML Factur-X du PDF. Le fichier n'est peut-etre pas un PDF Factur-X valide."
+            )
+
+    def parse(self, source: Union[bytes, str]):
+        try:
+            with _open(source) as stream:
+                self.metadata, self.error = parse_cii_stream(stream)
+        except etree.XMLSyntaxError as e:
+            if not _is_undeclared_latin1(source):
+                raise UploadError(422, f"XML non conforme CII/EN16931: XML syntax error: {str(e)}")
+            # Legacy exports in ISO-8859-1 without an XML declaration
+            try:
+                with _open(source) as stream:
+                    self.metadata, self.error = parse_cii_stream(stream, encoding='iso-8859-1')
+            except etree.XMLSyntaxError as e:
+                raise UploadError(422, f"XML non conforme CII/EN16931: XML syntax error: {str(e)}")
+            # Stored with a declaration so that it reads back with the right encoding
+            with _open(source) as stream:
+                self.xml_bytes = _LATIN1_DECLARATION + stream.read()
+
+    def validate(self):
+        if self.error:
+            raise UploadError(422, f"XML non conforme CII/EN16931: {self.error}")
+
+    def check_rules(self):
+        error = validate_en16931(self.xml_bytes if self.xml_bytes is not None else self.source)
+        if error:
+            raise UploadError(422, f"XML non conforme EN16931: {error}")
+
+    def extract_metadata(self) -> dict:
+        metadata = self.metadata
+
+        # Validate that we extracted meaningful data
+        if not metadata.get('_valid', False):
+            missing_fields = []
+            if not metadata.get('id'):
+                missing_fields.append("numero de facture")
+            if not metadata.get('seller_name'):
+                missing_fields.append("nom du vendeur")
+            if not metadata.get('buyer_name'):
+                missing_fields.append("nom de l'acheteur")
+
+            raise UploadError(
+                422,
+                f"Impossible d'extraire les donnees essentielles du XML: {', '.join(missing_fields)}. Verifiez que le fichier est bien un Factur-X/CII valide."
+            )
+
+        # Remove internal validation flag before saving
+        metadata.pop('_valid', None)
+        return metadata
+
+
+def _is_utf8(source: Union[bytes, str]) -> bool:
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with _open(source) as stream:
+            for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def _is_undeclared_latin1(source: Union[bytes, str]) -> bool:
+    with _open(source) as stream:
+        declared = stream.read(64).lstrip().startswith(b'<?xml')
+    return not declared and not _is_utf8(source)
+
+
+def process_upload(filename: Optional[str], source: Union[bytes, str]) -> Tuple[dict, Optional[bytes]]:
+    """Runs the upload pipeline; module-level so that it can run in the render pool."""
+    return UploadPipeline(filename, source).run()
@@ -2,16 +2,27 @@
 XML Processor module for extracting and validating Factur-X/CII XML from invoices.
 Supports both PDF Factur-X files (with embedded XML) and standalone CII XML files.
 """
+import logging
+import os
+import threading
 from lxml import etree
-from typing import Optional, Tuple
+from typing import BinaryIO, Optional, Tuple, Union
 from io import BytesIO
 
+from pdf_attachments import DEFAULT_MAX_STREAM_BYTES, StreamTooLarge, UnsupportedPdf, read_facturx_attachment
+
+logger = logging.getLogger(__name__)
+
 # Factur-X uses the facturx library for PDF/XML extraction
 try:
     from facturx import get_xml_from_pdf
 except ImportError:
     get_xml_from_pdf = None
 
+# "targeted" reads only the Factur-X attachment of the PDF, falling back to the
+# full facturx parser when it cannot; "full" always uses the full parser
+PDF_EXTRACTION = os.environ.get("PDF_EXTRACTION", "targeted").lower()
+
 # CII XML namespaces
 NAMESPACES = {
     'rsm': 'urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100',
@@ -20,22 +31,115 @@ NAMESPACES = {
     'qdt': 'urn:un:unece:uncefact:data:standard:QualifiedDataType:100',
 }
 
+# lxml parsers must not be shared between threads
+_thread_local = threading.local()
 
-def extract_xml_from_pdf(pdf_bytes: bytes) -> Optional[str]:
+
+def secure_parser() -> etree.XMLParser:
+    """
+    Returns this thread's hardened XML parser: no entity resolution, no DTD
+    loading and no network access (XXE / billion laughs protection).
+    """
+    parser = getattr(_thread_local, 'parser', None)
+    if parser is None:
+        parser = etree.XMLParser(resolve_entities=False, load_dtd=False, no_network=True, huge_tree=False)
+        _thread_local.parser = parser
+    return parser
+
+
+def parse_xml(xml_content: Union[str, bytes]):
+    """
+    Parse XML with the hardened parser.
+
+    Args:
+        xml_content: The XML as bytes (encoding taken from the XML declaration) or string
+
+    Returns:
+        The root element
+
+    Raises:
+        etree.XMLSyntaxError: If the XML is not well-formed
+    """
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode('utf-8')
+    return etree.fromstring(xml_content, parser=secure_parser())
+
+
+def _as_root(xml_content):
+    """Accepts XML as string, bytes or an already parsed root element."""
+    if isinstance(xml_content, (str, bytes)):
+        return parse_xml(xml_content)
+    return xml_content
+
+
+def _checks(*pairs):
+    """Compiles (direct path, document-wide path) pairs for validate_cii_xml."""
+    return [
+        (etree.XPath(path, namespaces=NAMESPACES), etree.XPath(fallback, namespaces=NAMESPACES))
+        for path, fallback in pairs
+    ]
+
+
+# Structural checks of validate_cii_xml, compiled once. The direct path is tried
+# first so that a valid document is never searched as a whole.
+_REQUIRED_ELEMENTS = _checks(
+    ('rsm:ExchangedDocumentContext', '//rsm:ExchangedDocumentContext'),
+    ('rsm:ExchangedDocument', '//rsm:ExchangedDocument'),
+    ('rsm:SupplyChainTradeTransaction', '//rsm:SupplyChainTradeTransaction'),
+)
+_INVOICE_ID, _SELLER_NAME, _BUYER_NAME = _checks(
+    ('rsm:ExchangedDocument/ram:ID/text()', '//rsm:ExchangedDocument/ram:ID/text()'),
+    ('rsm:SupplyChainTradeTransaction/ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:Name/text()',
+     '//ram:SellerTradeParty/ram:Name/text()'),
+    ('rsm:SupplyChainTradeTransaction/ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:Name/text()',
+     '//ram:BuyerTradeParty/ram:Name/text()'),
+)
+
+
+def _found(check, root) -> bool:
+    path, fallback = check
+    return bool(path(root)) or bool(fallback(root))
+
+
+def extract_xml_bytes_from_pdf(
+    pdf_bytes: Union[bytes, BinaryIO], max_stream_bytes: int = DEFAULT_MAX_STREAM_BYTES
+) -> Optional[bytes]:
     """
     Extract embedded Factur-X XML from a PDF file.
 
     Args:
-        pdf_bytes: The PDF file content as bytes
+        pdf_bytes: The PDF file content as bytes, or a seekable binary file object
+        max_stream_bytes: Largest compressed stream of the PDF once decoded
 
     Returns:
-        The XML content as string, or None if extraction failed
+        The raw XML bytes, or None if extraction failed
+
+    Raises:
+        StreamTooLarge: If a compressed stream decodes to more than max_stream_bytes
     """
     if get_xml_from_pdf is None:
         raise ImportError("facturx library is required for PDF extraction")
 
     try:
-        result = get_xml_from_pdf(BytesIO(pdf_bytes))
+        # A file object is read where it is, without loading the whole PDF
+        pdf_file = BytesIO(pdf_bytes) if isinstance(pdf_bytes, bytes) else pdf_bytes
+        if PDF_EXTRACTION != "full":
+            try:
+                xml_bytes = read_facturx_attachment(pdf_file, max_stream_bytes)
+            except StreamTooLarge:
+                raise
+            except UnsupportedPdf:
+                pass
+            except Exception as e:
+                # A file the targeted reader trips over: the full parser decides
+                logger.warning(f"Targeted Factur-X extraction failed, using the full parser: {e!r}")
+            else:
+                if xml_bytes is None or _is_valid_facturx(xml_bytes):
+                    return xml_bytes
+            # The full parser also looks at the other attachments
+            pdf_file.seek(0)
+
+        result = get_xml_from_pdf(pdf_file)
 
         if result is None:
             return None
@@ -47,57 +151,78 @@ def extract_xml_from_pdf(pdf_bytes: bytes) -> Optional[str]:
             xml_data = result
 
         if isinstance(xml_data, bytes):
-            return xml_data.decode('utf-8')
-        elif isinstance(xml_data, str):
             return xml_data
+        elif isinstance(xml_data, str):
+            return xml_data.encode('utf-8')
         else:
             return None
 
+    except StreamTooLarge:
+        raise
+    except Exception:
+        return None
+
+
+def _is_valid_facturx(xml_bytes: bytes) -> bool:
+    # The checks get_xml_from_pdf applies to the attachments it finds, with the compiled schemas
+    from cii_validation import profile, schema_error
+    try:
+        level = profile(xml_bytes)
+        return level is not None and schema_error(xml_bytes, level) is None
     except Exception:
+        return False
+
+
+def extract_xml_from_pdf(pdf_bytes: bytes) -> Optional[str]:
+    """
+    Extract embedded Factur-X XML from a PDF file.
+
+    Args:
+        pdf_bytes: The PDF file content as bytes
+
+    Returns:
+        The XML content as string, or None if extraction failed
+    """
+    xml_bytes = extract_xml_bytes_from_pdf(pdf_bytes)
+    if xml_bytes is None:
+        return None
+    try:
+        return xml_bytes.decode('utf-8')
+    except UnicodeDecodeError:
         return None
 
 
-def validate_cii_xml(xml_content: str) -> Tuple[bool, Optional[str]]:
+def validate_cii_xml(xml_content) -> Tuple[bool, Optional[str]]:
     """
     Validate that the XML content is a valid CII/EN16931 invoice.
     Performs structural validation (not schema validation).
 
     Args:
-        xml_content: The XML content as string
+        xml_content: The XML content as string, bytes or parsed root element
 
     Returns:
         Tuple of (is_valid, error_message)
     """
     try:
-        root = etree.fromstring(xml_content.encode('utf-8'))
+        root = _as_root(xml_content)
 
         # Check root element is CrossIndustryInvoice
         if not root.tag.endswith('CrossIndustryInvoice'):
             return False, "Root element is not CrossIndustryInvoice"
 
         # Check for required CII structure elements
-        required_elements = [
-            '//rsm:ExchangedDocumentContext',
-            '//rsm:ExchangedDocument',
-            '//rsm:SupplyChainTradeTransaction',
-        ]
-
-        for xpath in required_elements:
-            if root.xpath(xpath, namespaces=NAMESPACES) is None or len(root.xpath(xpath, namespaces=NAMESPACES)) == 0:
-                return False, f"Missing required element: {xpath}"
+        for check in _REQUIRED_ELEMENTS:
+            if not _found(check, root):
+                return False, f"Missing required element: {check[1].path}"
 
         # Check for invoice ID
-        invoice_id = root.xpath('//rsm:ExchangedDocument/ram:ID/text()', namespaces=NAMESPACES)
-        if not invoice_id:
+        if not _found(_INVOICE_ID, root):
             return False, "Missing invoice ID (ExchangedDocument/ID)"
 
         # Check for seller and buyer
-        seller = root.xpath('//ram:SellerTradeParty/ram:Name/text()', namespaces=NAMESPACES)
-        buyer = root.xpath('//ram:BuyerTradeParty/ram:Name/text()', namespaces=NAMESPACES)
-
-        if not seller:
+        if not _found(_SELLER_NAME, root):
             return False, "Missing seller name"
-        if not buyer:
+        if not _found(_BUYER_NAME, root):
             return False, "Missing buyer name"
 
         return True, None
@@ -108,159 +233,152 @@ def validate_cii_xml(xml_content: str) -> Tuple[bool, Optional[str]]:
         return False, f"Validation error: {str(e)}"
 
 
-def extract_metadata_from_xml(xml_content: str) -> dict:
+# Header sections of a CII invoice, located once per document
+_SECTIONS = {
+    'document': etree.XPath('/rsm:CrossIndustryInvoice/rsm:ExchangedDocument', namespaces=NAMESPACES),
+    'agreement': etree.XPath(
+        '/rsm:CrossIndustryInvoice/rsm:SupplyChainTradeTransaction/ram:ApplicableHeaderTradeAgreement',
+        namespaces=NAMESPACES),
+    'settlement': etree.XPath(
+        '/rsm:CrossIndustryInvoice/rsm:SupplyChainTradeTransaction/ram:ApplicableHeaderTradeSettlement',
+        namespaces=NAMESPACES),
+}
+
+# Metadata extraction plan: field -> (section, path relative to the section,
+# fallback path searching the whole document when the first one finds nothing)
+_FIELD_PATHS = {
+    'id': ('document', 'ram:ID', '//rsm:ExchangedDocument/ram:ID'),
+    'date': ('document', 'ram:IssueDateTime/udt:DateTimeString', '//ram:IssueDateTime/udt:DateTimeString'),
+    'seller_name': ('agreement', 'ram:SellerTradeParty/ram:Name', '//ram:SellerTradeParty/ram:Name'),
+    'seller_street': ('agreement', 'ram:SellerTradeParty/ram:PostalTradeAddress/ram:LineOne',
+                      '//ram:SellerTradeParty/ram:PostalTradeAddress/ram:LineOne'),
+    'seller_city': ('agreement', 'ram:SellerTradeParty/ram:PostalTradeAddress/ram:CityName',
+                    '//ram:SellerTradeParty/ram:PostalTradeAddress/ram:CityName'),
+    'seller_zip': ('agreement', 'ram:SellerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode',
+                   '//ram:SellerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode'),
+    'seller_country': ('agreement', 'ram:SellerTradeParty/ram:PostalTradeAddress/ram:CountryID',
+                       '//ram:SellerTradeParty/ram:PostalTradeAddress/ram:CountryID'),
+    'seller_vat': ('agreement', 'ram:SellerTradeParty/ram:SpecifiedTaxRegistration/ram:ID',
+                   '//ram:SellerTradeParty/ram:SpecifiedTaxRegistration/ram:ID'),
+    'buyer_name': ('agreement', 'ram:BuyerTradeParty/ram:Name', '//ram:BuyerTradeParty/ram:Name'),
+    'buyer_street': ('agreement', 'ram:BuyerTradeParty/ram:PostalTradeAddress/ram:LineOne',
+                     '//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:LineOne'),
+    'buyer_city': ('agreement', 'ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CityName',
+                   '//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CityName'),
+    'buyer_zip': ('agreement', 'ram:BuyerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode',
+                  '//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode'),
+    'buyer_country': ('agreement', 'ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CountryID',
+                      '//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CountryID'),
+    'buyer_vat': ('agreement', 'ram:BuyerTradeParty/ram:SpecifiedTaxRegistration/ram:ID',
+                  '//ram:BuyerTradeParty/ram:SpecifiedTaxRegistration/ram:ID'),
+    'currency': ('settlement', 'ram:InvoiceCurrencyCode', '//ram:InvoiceCurrencyCode'),
+    'total_ht': ('settlement', 'ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:TaxBasisTotalAmount',
+                 '//ram:TaxBasisTotalAmount'),
+    'total_ttc': ('settlement', 'ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:GrandTotalAmount',
+                  '//ram:GrandTotalAmount'),
+    'total_tax': ('settlement', 'ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:TaxTotalAmount',
+                  '//ram:TaxTotalAmount'),
+}
+
+# Amounts also fall back to the document-wide search when they are 0
+_AMOUNT_FIELDS = ('total_ht', 'total_ttc', 'total_tax')
+
+# The plan compiled once at import: field -> (section, XPath, fallback XPath)
+_METADATA_PLAN = {
+    field: (
+        section,
+        etree.XPath(f'{path}/text()', namespaces=NAMESPACES),
+        etree.XPath(f'{fallback}/text()', namespaces=NAMESPACES),
+    )
+    for field, (section, path, fallback) in _FIELD_PATHS.items()
+}
+
+
+def _to_float(text: str, default: float = 0.0) -> float:
+    if text:
+        try:
+            return float(text)
+        except ValueError:
+            pass
+    return default
+
+
+def _first_text(xpath: etree.XPath, node) -> str:
+    result = xpath(node)
+    if result:
+        return str(result[0]).strip()
+    return ''
+
+
+def _extract_fields(root) -> dict:
+    """Runs the extraction plan on a parsed document and returns the raw text of every field."""
+    sections = {}
+    for name, xpath in _SECTIONS.items():
+        found = xpath(root)
+        sections[name] = found[0] if found else None
+
+    values = {}
+    for field, (section, xpath, fallback) in _METADATA_PLAN.items():
+        node = sections[section]
+        text = _first_text(xpath, node) if node is not None else ''
+        if not text or (field in _AMOUNT_FIELDS and _to_float(text) == 0):
+            text = _first_text(fallback, root) or text
+        values[field] = text
+    return values
+
+
+def _build_metadata(values: dict) -> dict:
+    """Builds the invoice metadata dict from the raw field values."""
+    # Convert YYYYMMDD to YYYY-MM-DD if needed
+    date_str = values['date']
+    if date_str and len(date_str) == 8 and date_str.isdigit():
+        date_str = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
+
+    def address(prefix: str) -> str:
+        parts = [
+            values[f'{prefix}_street'],
+            f"{values[f'{prefix}_zip']} {values[f'{prefix}_city']}".strip(),
+            values[f'{prefix}_country'],
+        ]
+        return ', '.join(p for p in parts if p)
+
+    metadata = {
+        'id': values['id'],
+        'date': date_str,
+        'seller_name': values['seller_name'],
+        'seller_address': address('seller'),
+        'seller_vat': values['seller_vat'],
+        'buyer_name': values['buyer_name'],
+        'buyer_address': address('buyer'),
+        'buyer_vat': values['buyer_vat'],
+        'currency': values['currency'] or 'EUR',
+        'total_ht': round(_to_float(values['total_ht']), 2),
+        'total_ttc': round(_to_float(values['total_ttc']), 2),
+        'total_tax': round(_to_float(values['total_tax']), 2),
+        'created_at': date_str,
+        'source': 'upload'
+    }
+
+    # Mark as valid only if we got essential fields
+    metadata['_valid'] = bool(metadata['id'] and metadata['seller_name'] and metadata['buyer_name'])
+
+    return metadata
+
+
+def extract_metadata_from_xml(xml_content) -> dict:
     """
     Extract invoice metadata from CII XML content.
+    All fields are filled from a single parse with the precompiled extraction plan.
 
     Args:
-        xml_content: The XML content as string
+        xml_content: The XML content as string, bytes or parsed root element
 
     Returns:
         Dictionary with extracted metadata
     """
     try:
-        # Handle both bytes and string input
-        if isinstance(xml_content, bytes):
-            xml_bytes = xml_content
-        else:
-            xml_bytes = xml_content.encode('utf-8')
-
-        root = etree.fromstring(xml_bytes)
-
-        # Get namespaces from the document itself
-        nsmap = root.nsmap.copy()
-        # Handle default namespace
-        if None in nsmap:
-            del nsmap[None]
-
-        # Merge with our known namespaces, preferring document's
-        namespaces = {**NAMESPACES, **nsmap}
-
-        def get_text(xpath: str, default: str = '') -> str:
-            result = root.xpath(xpath, namespaces=namespaces)
-            if result and len(result) > 0:
-                return str(result[0]).strip()
-            return default
-
-        def get_float(xpath: str, default: float = 0.0) -> float:
-            text = get_text(xpath)
-            if text:
-                try:
-                    return float(text)
-                except ValueError:
-                    pass
-            return default
-
-        # Extract invoice ID
-        invoice_id = get_text('//rsm:ExchangedDocument/ram:ID/text()')
-
-        # Extract date - try multiple formats
-        date_str = get_text('//rsm:ExchangedDocument/ram:IssueDateTime/udt:DateTimeString/text()')
-        # Convert YYYYMMDD to YYYY-MM-DD if needed
-        if date_str and len(date_str) == 8 and date_str.isdigit():
-            date_str = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-        elif not date_str:
-            # Try alternative date location
-            date_str = get_text('//ram:IssueDateTime/udt:DateTimeString/text()')
-            if date_str and len(date_str) == 8 and date_str.isdigit():
-                date_str = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-
-        # Extract seller and buyer names - they are under ApplicableHeaderTradeAgreement
-        seller_name = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:Name/text()')
-        if not seller_name:
-            seller_name = get_text('//ram:SellerTradeParty/ram:Name/text()')
-
-        buyer_name = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:Name/text()')
-        if not buyer_name:
-            buyer_name = get_text('//ram:BuyerTradeParty/ram:Name/text()')
-
-        # Extract currency - under ApplicableHeaderTradeSettlement
-        currency = get_text('//ram:ApplicableHeaderTradeSettlement/ram:InvoiceCurrencyCode/text()')
-        if not currency:
-            currency = get_text('//ram:InvoiceCurrencyCode/text()', 'EUR')
-
-        # Extract totals from SpecifiedTradeSettlementHeaderMonetarySummation
-        total_ht = get_float('//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:TaxBasisTotalAmount/text()')
-        if total_ht == 0:
-            total_ht = get_float('//ram:TaxBasisTotalAmount/text()')
-
-        total_ttc = get_float('//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:GrandTotalAmount/text()')
-        if total_ttc == 0:
-            total_ttc = get_float('//ram:GrandTotalAmount/text()')
-
-        total_tax = get_float('//ram:SpecifiedTradeSettlementHeaderMonetarySummation/ram:TaxTotalAmount/text()')
-        if total_tax == 0:
-            total_tax = get_float('//ram:TaxTotalAmount/text()')
-
-        # Extract seller address - under ApplicableHeaderTradeAgreement/SellerTradeParty
-        seller_street = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:PostalTradeAddress/ram:LineOne/text()')
-        if not seller_street:
-            seller_street = get_text('//ram:SellerTradeParty/ram:PostalTradeAddress/ram:LineOne/text()')
-
-        seller_city = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:PostalTradeAddress/ram:CityName/text()')
-        if not seller_city:
-            seller_city = get_text('//ram:SellerTradeParty/ram:PostalTradeAddress/ram:CityName/text()')
-
-        seller_zip = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode/text()')
-        if not seller_zip:
-            seller_zip = get_text('//ram:SellerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode/text()')
-
-        seller_country = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:PostalTradeAddress/ram:CountryID/text()')
-        if not seller_country:
-            seller_country = get_text('//ram:SellerTradeParty/ram:PostalTradeAddress/ram:CountryID/text()')
-
-        seller_vat = get_text('//ram:ApplicableHeaderTradeAgreement/ram:SellerTradeParty/ram:SpecifiedTaxRegistration/ram:ID/text()')
-        if not seller_vat:
-            seller_vat = get_text('//ram:SellerTradeParty/ram:SpecifiedTaxRegistration/ram:ID/text()')
-
-        seller_address_parts = [p for p in [seller_street, f"{seller_zip} {seller_city}".strip(), seller_country] if p]
-        seller_address = ', '.join(seller_address_parts) if seller_address_parts else ''
-
-        # Extract buyer address - under ApplicableHeaderTradeAgreement/BuyerTradeParty
-        buyer_street = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:PostalTradeAddress/ram:LineOne/text()')
-        if not buyer_street:
-            buyer_street = get_text('//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:LineOne/text()')
-
-        buyer_city = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CityName/text()')
-        if not buyer_city:
-            buyer_city = get_text('//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CityName/text()')
-
-        buyer_zip = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode/text()')
-        if not buyer_zip:
-            buyer_zip = get_text('//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:PostcodeCode/text()')
-
-        buyer_country = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CountryID/text()')
-        if not buyer_country:
-            buyer_country = get_text('//ram:BuyerTradeParty/ram:PostalTradeAddress/ram:CountryID/text()')
-
-        buyer_vat = get_text('//ram:ApplicableHeaderTradeAgreement/ram:BuyerTradeParty/ram:SpecifiedTaxRegistration/ram:ID/text()')
-        if not buyer_vat:
-            buyer_vat = get_text('//ram:BuyerTradeParty/ram:SpecifiedTaxRegistration/ram:ID/text()')
-
-        buyer_address_parts = [p for p in [buyer_street, f"{buyer_zip} {buyer_city}".strip(), buyer_country] if p]
-        buyer_address = ', '.join(buyer_address_parts) if buyer_address_parts else ''
-
-        metadata = {
-            'id': invoice_id,
-            'date': date_str,
-            'seller_name': seller_name,
-            'seller_address': seller_address,
-            'seller_vat': seller_vat,
-            'buyer_name': buyer_name,
-            'buyer_address': buyer_address,
-            'buyer_vat': buyer_vat,
-            'currency': currency,
-            'total_ht': round(total_ht, 2),
-            'total_ttc': round(total_ttc, 2),
-            'total_tax': round(total_tax, 2),
-            'created_at': date_str,
-            'source': 'upload'
-        }
-
-        # Mark as valid only if we got essential fields
-        metadata['_valid'] = bool(invoice_id and seller_name and buyer_name)
-
-        return metadata
+        root = _as_root(xml_content)
+        return _build_metadata(_extract_fields(root))
 
     except Exception:
         return {
@@ -276,31 +394,138 @@ def extract_metadata_from_xml(xml_content: str) -> dict:
         }
 
 
-def create_placeholder_pdf(xml_content: str, metadata: dict) -> bytes:
+def _qname(prefix: str, local: str) -> str:
+    return f'{{{NAMESPACES[prefix]}}}{local}'
+
+
+# Streaming counterparts of the checks and sections above, matched by tag
+_SECTION_TAGS = {
+    _qname('rsm', 'ExchangedDocument'): 'document',
+    _qname('ram', 'ApplicableHeaderTradeAgreement'): 'agreement',
+    _qname('ram', 'ApplicableHeaderTradeSettlement'): 'settlement',
+}
+_TRANSACTION_TAG = _qname('rsm', 'SupplyChainTradeTransaction')
+_REQUIRED_TAGS = {
+    _qname('rsm', 'ExchangedDocumentContext'): '//rsm:ExchangedDocumentContext',
+    _qname('rsm', 'ExchangedDocument'): '//rsm:ExchangedDocument',
+    _qname('rsm', 'SupplyChainTradeTransaction'): '//rsm:SupplyChainTradeTransaction',
+}
+
+
+def _fallback_steps(fallback: str) -> list:
+    """'//ram:A/ram:B' -> the tags, innermost first: [B, A]"""
+    return [_qname(*step.split(':')) for step in reversed(fallback[2:].split('/'))]
+
+
+# The fallback paths of the plan, matched as elements end: last tag -> [(field, ancestor tags, innermost first)]
+_FALLBACK_TAGS = {}
+for _field, (_, _, _fallback) in _FIELD_PATHS.items():
+    _tag, *_ancestors = _fallback_steps(_fallback)
+    _FALLBACK_TAGS.setdefault(_tag, []).append((_field, _ancestors))
+
+
+def _has_ancestors(elem, tags: list) -> bool:
+    for tag in tags:
+        elem = elem.getparent()
+        if elem is None or elem.tag != tag:
+            return False
+    return True
+
+
+def parse_cii_stream(source, encoding: Optional[str] = None) -> Tuple[dict, Optional[str]]:
+    """
+    Validate a CII invoice and extract its metadata in a single streaming pass.
+
+    Only the header section being read is kept in memory: every block of the
+    document (line items included) is discarded once it has been read, so memory
+    use does not grow with the size of the file. Checks and fields are the ones
+    of validate_cii_xml and extract_metadata_from_xml, each header section being
+    looked up wherever it is in the document.
+
+    Args:
+        source: A file name or a binary file object
+        encoding: Overrides the encoding of the document (for undeclared legacy encodings)
+
+    Returns:
+        Tuple of (metadata, error_message); error_message is None for a valid invoice
+
+    Raises:
+        etree.XMLSyntaxError: If the XML is not well-formed
+    """
+    values = {field: '' for field in _METADATA_PLAN}
+    # First match of each fallback path in document order, as _extract_fields finds it
+    fallbacks = {}
+    sections_read = set()
+    tags_seen = set()
+    depth = 0
+
+    context = etree.iterparse(
+        source, events=('start', 'end'), encoding=encoding,
+        resolve_entities=False, load_dtd=False, no_network=True, huge_tree=False,
+    )
+    for event, elem in context:
+        if event == 'start':
+            if depth == 0 and not elem.tag.endswith('CrossIndustryInvoice'):
+                return _build_metadata(values), "Root element is not CrossIndustryInvoice"
+            depth += 1
+            continue
+
+        depth -= 1
+        tag = elem.tag
+        if tag in _REQUIRED_TAGS:
+            tags_seen.add(tag)
+        for field, ancestors in _FALLBACK_TAGS.get(tag, ()):
+            if field not in fallbacks and _has_ancestors(elem, ancestors):
+                fallbacks[field] = (elem.text or '').strip()
+        section = _SECTION_TAGS.get(tag)
+        if section and section not in sections_read:
+            sections_read.add(section)
+            for field, (field_section, xpath, _) in _METADATA_PLAN.items():
+                if field_section == section:
+                    values[field] = _first_text(xpath, elem)
+
+        # Blocks of the root and of the trade transaction (line items) are dropped once read
+        parent = elem.getparent()
+        if depth == 1 or (depth == 2 and parent.tag == _TRANSACTION_TAG):
+            elem.clear(keep_tail=False)
+            while elem.getprevious() is not None:
+                del parent[0]
+
+    for field, text in values.items():
+        if not text or (field in _AMOUNT_FIELDS and _to_float(text) == 0):
+            values[field] = fallbacks.get(field) or text
+    metadata = _build_metadata(values)
+    for tag, path in _REQUIRED_TAGS.items():
+        if tag not in tags_seen:
+            return metadata, f"Missing required element: {path}"
+    if not values['id']:
+        return metadata, "Missing invoice ID (ExchangedDocument/ID)"
+    if not values['seller_name']:
+        return metadata, "Missing seller name"
+    if not values['buyer_name']:
+        return metadata, "Missing buyer name"
+    return metadata, None
+
+
+def create_placeholder_pdf(xml_content: Optional[str], metadata: dict) -> bytes:
     """
     Create a placeholder PDF for XML-only uploads.
     Uses WeasyPrint to generate a simple PDF displaying invoice metadata.
 
     Args:
-        xml_content: The original XML content
+        xml_content: The original XML content (not rendered, may be None)
         metadata: Extracted metadata dictionary
 
     Returns:
         PDF bytes
     """
-    from jinja2 import Environment, FileSystemLoader
-    from weasyprint import HTML
-    import os
-
-    # Setup Jinja2 environment
-    templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
-    env = Environment(loader=FileSystemLoader(templates_dir))
+    from render_context import get_render_context
 
+    context = get_render_context()
     try:
-        template = env.get_template('upload-placeholder.html')
+        template = context.template('upload-placeholder.html')
         html_content = template.render(metadata=metadata)
-        pdf_bytes = HTML(string=html_content).write_pdf()
-        return pdf_bytes
+        return context.write_pdf(html_content, 'upload-placeholder.css')
     except Exception:
         # Fallback to a very simple PDF
         simple_html = f"""
@@ -319,4 +544,4 @@ def create_placeholder_pdf(xml_content: str, metadata: dict) -> bytes:
         </body>
         </html>
         """
-        return HTML(string=simple_html).write_pdf()
+        return context.write_pdf(simple_html)